@@ -0,0 +1,164 @@
+import re
+import heapq
+import bisect
+import unicodedata
+from array import array
+
+# In-memory autocomplete index of the author names.
+# Every name is split in normalized tokens (lower case, without accents), and the pairs
+# (token, author) are kept in one sorted array: the authors with a token starting with a prefix
+# are one contiguous range found by binary search. A query matches the authors having, for every
+# query token, a name token starting with it ('jo sm' matches 'John Smith' and 'Smith, Joanna').
+# The matches are ranked by number of articles. The short prefixes match many authors:
+# their top authors are precomputed, so every lookup reads a few entries only.
+# The index is updated in place when the API inserts authors and links them to articles.
+
+TOKEN_SPLIT = re.compile(r'[^\w]+')
+
+
+def normalize_tokens(text):
+    """
+    Normalized tokens of a text: lower case, accents removed, split on non-alphanumeric characters
+    :param text: author name or query
+    """
+
+    text = unicodedata.normalize('NFKD', text.casefold())
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return [token for token in TOKEN_SPLIT.split(text) if token]
+
+
+class AuthorIndex:
+    """
+    Prefix-of-any-token index of the author names, ranked by article count
+    """
+
+    def __init__(self, short_prefix_length=2, short_prefix_top=50):
+        """
+        :param short_prefix_length: prefixes up to this length get their top authors precomputed
+        :param short_prefix_top: number of top authors kept per short prefix, the maximum limit of a lookup
+        """
+
+        self.short_prefix_length = short_prefix_length
+        self.short_prefix_top = short_prefix_top
+        self._reset()
+
+    def _reset(self):
+        self.author_ids = array('q')
+        self.names = []
+        self.name_tokens = []
+        self.articles = array('q')
+        self.position_by_id = {}
+        self.tokens = []
+        self.token_authors = array('l')
+        self.short_prefixes = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def _rank(self, position):
+        # Most articles first, then alphabetical
+        return (-self.articles[position], self.names[position])
+
+    def load(self, rows):
+        """
+        Build the index
+        :param rows: list of dicts with author_id, author_name and total_articles
+        """
+
+        self._reset()
+        pairs = []
+        for row in rows:
+            position = len(self.names)
+            tokens = normalize_tokens(row['author_name'] or '')
+            self.author_ids.append(row['author_id'])
+            self.names.append(row['author_name'])
+            self.name_tokens.append(tokens)
+            self.articles.append(row['total_articles'] or 0)
+            self.position_by_id[row['author_id']] = position
+            pairs.extend((token, position) for token in set(tokens))
+
+        pairs.sort()
+        self.tokens = [token for token, _ in pairs]
+        self.token_authors = array('l', (position for _, position in pairs))
+
+        short_prefixes = {}
+        for token, position in pairs:
+            for length in range(1, min(len(token), self.short_prefix_length) + 1):
+                short_prefixes.setdefault(token[:length], set()).add(position)
+        self.short_prefixes = {
+            prefix: heapq.nsmallest(self.short_prefix_top, positions, key=self._rank)
+            for prefix, positions in short_prefixes.items()
+        }
+
+    def _prefix_range(self, prefix):
+        start = bisect.bisect_left(self.tokens, prefix)
+        end = bisect.bisect_left(self.tokens, prefix + '\U0010ffff', start)
+        return start, end
+
+    def _update_short_prefixes(self, position):
+        for token in set(self.name_tokens[position]):
+            for length in range(1, min(len(token), self.short_prefix_length) + 1):
+                top = self.short_prefixes.setdefault(token[:length], [])
+                if position not in top:
+                    top.append(position)
+                top.sort(key=self._rank)
+                del top[self.short_prefix_top:]
+
+    def add_articles(self, author_id, author_name, articles=1):
+        """
+        Add an author, or add articles to an author already in the index
+        :param author_id: id of the author
+        :param author_name: name of the author
+        :param articles: number of new articles of the author
+        """
+
+        position = self.position_by_id.get(author_id)
+        if position is None:
+            position = len(self.names)
+            tokens = normalize_tokens(author_name or '')
+            self.author_ids.append(author_id)
+            self.names.append(author_name)
+            self.name_tokens.append(tokens)
+            self.articles.append(articles)
+            self.position_by_id[author_id] = position
+            for token in set(tokens):
+                index = bisect.bisect_left(self.tokens, token)
+                self.tokens.insert(index, token)
+                self.token_authors.insert(index, position)
+        else:
+            self.articles[position] += articles
+        self._update_short_prefixes(position)
+
+    def search(self, query, limit=5):
+        """
+        Authors having, for every token of the query, a name token starting with it.
+        Returns at most limit dicts with author_id, author_name and total_articles, most articles first
+        :param query: text typed by the user
+        :param limit: maximum number of authors returned
+        """
+
+        query_tokens = normalize_tokens(query)
+        if not query_tokens:
+            return []
+
+        if len(query_tokens) == 1 and len(query_tokens[0]) <= self.short_prefix_length and limit <= self.short_prefix_top:
+            positions = self.short_prefixes.get(query_tokens[0], [])[:limit]
+        else:
+            # Candidates from the query token with the fewest matches, checked against the other tokens
+            ranges = sorted((self._prefix_range(token) for token in query_tokens), key=lambda r: r[1] - r[0])
+            start, end = ranges[0]
+            candidates = set(self.token_authors[start:end])
+            matches = (
+                position for position in candidates
+                if all(any(name_token.startswith(token) for name_token in self.name_tokens[position]) for token in query_tokens)
+            )
+            positions = heapq.nsmallest(limit, matches, key=self._rank)
+
+        return [
+            {
+                'author_id': self.author_ids[position],
+                'author_name': self.names[position],
+                'total_articles': self.articles[position]
+            }
+            for position in positions
+        ]
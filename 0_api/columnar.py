@@ -0,0 +1,427 @@
+import string
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# In-process columnar engine of the aggregates over article ⋈ article_author ⋈ author.
+# The join is loaded once in NumPy arrays, one entry per (article, author) link: article id, author id,
+# section code, author name code and word count of the article. The aggregates of the endpoints are then
+# vectorized group-bys (bincount, unique) and top-k, instead of SQLite's row-at-a-time joins.
+# SQLite stays the source of truth: the engine is loaded from it, the rows inserted by the API are applied
+# as deltas (merged in the arrays at the next query), and it is reloaded when the database is replaced
+# or written by another process. Every method returns the rows of the SQL query it replaces, in its order:
+# - author names are matched like "author_name LIKE '%...%'": substring, case-insensitive for ASCII only
+# - GROUP BY author_name: one group per name, the authors without name are one group
+# - SUM(word_count) is NULL when all the word counts of the group are NULL
+# Needs numpy, see NUMPY_AVAILABLE.
+
+NUMPY_AVAILABLE = np is not None
+
+# Case folding of SQLite's LIKE
+ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def _take(values, position, found, missing):
+    # values[position] where found, missing elsewhere
+    result = np.full(len(position), missing, dtype=values.dtype)
+    result[found] = values[position[found]]
+    return result
+
+
+def _lookup(ids, keys):
+    # Positions of the keys in the sorted array of ids, and whether they are there
+    position = np.searchsorted(ids, keys)
+    found = position < len(ids)
+    found[found] = ids[position[found]] == keys[found]
+    return position, found
+
+
+def _section_winners(sections, values):
+    # Groups sorted by section: index of the group whose value is strictly greater than
+    # the values of the other groups of its section ("HAVING COUNT(*) <= 1" of a self join on value <=)
+    if not len(values):
+        return np.empty(0, dtype=np.int64)
+    starts = np.flatnonzero(np.r_[True, sections[1:] != sections[:-1]])
+    lengths = np.diff(np.r_[starts, len(sections)])
+    best = np.repeat(np.maximum.reduceat(values, starts), lengths)
+    at_best = values == best
+    single_best = np.repeat(np.add.reduceat(at_best.astype(np.int64), starts) == 1, lengths)
+    return np.flatnonzero(at_best & single_best)
+
+
+class ColumnarEngine:
+    """
+    NumPy arrays of the article-author links answering the author and section aggregates
+    """
+
+    def __init__(self):
+        self.article_ids = np.empty(0, dtype=np.int64)
+        self.article_sections = np.empty(0, dtype=np.int32)
+        self.article_words = np.empty(0, dtype=np.int64)
+        self.article_words_null = np.empty(0, dtype=bool)
+        self.author_ids = np.empty(0, dtype=np.int64)
+        self.author_names = np.empty(0, dtype=np.int32)
+
+        # Codes of the section names and author names, None included
+        self.sections = []
+        self.section_codes = {}
+        self.names = []
+        self.folded_names = []
+        self.name_codes = {}
+
+        # One entry per link, section -1 when the article is missing, name -1 when the author is missing
+        self.link_article_ids = np.empty(0, dtype=np.int64)
+        self.link_author_ids = np.empty(0, dtype=np.int64)
+        self.link_sections = np.empty(0, dtype=np.int32)
+        self.link_names = np.empty(0, dtype=np.int32)
+        self.link_words = np.empty(0, dtype=np.int64)
+        self.link_words_null = np.empty(0, dtype=bool)
+
+        # Inserted rows not merged in the arrays yet
+        self.pending_articles = {}
+        self.pending_authors = {}
+        self.pending_links = []
+
+        # Results of the aggregates without parameters, cleared by the inserts
+        self.results = {}
+
+    def __len__(self):
+        self._merge()
+        return len(self.link_article_ids)
+
+    def _section_code(self, section_name):
+        code = self.section_codes.get(section_name)
+        if code is None:
+            code = self.section_codes[section_name] = len(self.sections)
+            self.sections.append(section_name)
+        return code
+
+    def _name_code(self, author_name):
+        code = self.name_codes.get(author_name)
+        if code is None:
+            code = self.name_codes[author_name] = len(self.names)
+            self.names.append(author_name)
+            self.folded_names.append(author_name.translate(ASCII_LOWER) if author_name is not None else None)
+        return code
+
+    def _add_articles(self, article_ids, article_sections, article_words):
+        ids = np.array(article_ids, dtype=np.int64)
+        sections = np.array([self._section_code(section) for section in article_sections], dtype=np.int32)
+        words_null = np.array([words is None for words in article_words], dtype=bool)
+        words = np.array([int(words) if words is not None else 0 for words in article_words], dtype=np.int64)
+
+        appended = not len(self.article_ids) or not len(ids) or ids.min() > self.article_ids[-1]
+        self.article_ids = np.concatenate([self.article_ids, ids])
+        self.article_sections = np.concatenate([self.article_sections, sections])
+        self.article_words = np.concatenate([self.article_words, words])
+        self.article_words_null = np.concatenate([self.article_words_null, words_null])
+        if not (appended and np.all(ids[1:] > ids[:-1])):
+            order = np.argsort(self.article_ids, kind='stable')
+            self.article_ids = self.article_ids[order]
+            self.article_sections = self.article_sections[order]
+            self.article_words = self.article_words[order]
+            self.article_words_null = self.article_words_null[order]
+
+    def _add_authors(self, author_ids, author_names):
+        ids = np.array(author_ids, dtype=np.int64)
+        names = np.array([self._name_code(name) for name in author_names], dtype=np.int32)
+
+        appended = not len(self.author_ids) or not len(ids) or ids.min() > self.author_ids[-1]
+        self.author_ids = np.concatenate([self.author_ids, ids])
+        self.author_names = np.concatenate([self.author_names, names])
+        if not (appended and np.all(ids[1:] > ids[:-1])):
+            order = np.argsort(self.author_ids, kind='stable')
+            self.author_ids = self.author_ids[order]
+            self.author_names = self.author_names[order]
+
+    def _add_links(self, link_article_ids, link_author_ids):
+        article_ids = np.array(link_article_ids, dtype=np.int64)
+        author_ids = np.array(link_author_ids, dtype=np.int64)
+
+        position, found = _lookup(self.article_ids, article_ids)
+        sections = _take(self.article_sections, position, found, -1)
+        words = _take(self.article_words, position, found, 0)
+        words_null = _take(self.article_words_null, position, found, True)
+        position, found = _lookup(self.author_ids, author_ids)
+        names = _take(self.author_names, position, found, -1)
+
+        self.link_article_ids = np.concatenate([self.link_article_ids, article_ids])
+        self.link_author_ids = np.concatenate([self.link_author_ids, author_ids])
+        self.link_sections = np.concatenate([self.link_sections, sections])
+        self.link_names = np.concatenate([self.link_names, names])
+        self.link_words = np.concatenate([self.link_words, words])
+        self.link_words_null = np.concatenate([self.link_words_null, words_null])
+
+    def load(self, article_ids, article_sections, article_words, author_ids, author_names, link_article_ids, link_author_ids):
+        """
+        Load the tables, as columns. Only for an empty engine
+        :param article_ids: article.article_id
+        :param article_sections: article.section_name
+        :param article_words: article.word_count
+        :param author_ids: author.author_id
+        :param author_names: author.author_name
+        :param link_article_ids: article_author.article_id
+        :param link_author_ids: article_author.author_id
+        """
+
+        self._add_articles(article_ids, article_sections, article_words)
+        self._add_authors(author_ids, author_names)
+        self._add_links(link_article_ids, link_author_ids)
+
+    def _contains(self, ids, pending, id):
+        if id in pending:
+            return True
+        position = np.searchsorted(ids, id)
+        return position < len(ids) and ids[position] == id
+
+    def insert(self, articles, authors, links):
+        """
+        Apply the rows of new articles inserted in the database. Rows already in the engine are ignored,
+        and only the links of the articles applied by this call are kept
+        :param articles: list of (article_id, section_name, word_count)
+        :param authors: list of (author_id, author_name), new or not
+        :param links: list of (article_id, author_id) of the articles
+        """
+
+        new_articles = set()
+        for article_id, section_name, word_count in articles:
+            if not self._contains(self.article_ids, self.pending_articles, article_id):
+                self.pending_articles[article_id] = (section_name, word_count)
+                new_articles.add(article_id)
+
+        for author_id, author_name in authors:
+            if not self._contains(self.author_ids, self.pending_authors, author_id):
+                self.pending_authors[author_id] = author_name
+
+        self.pending_links.extend(link for link in links if link[0] in new_articles)
+        if new_articles:
+            self.results.clear()
+
+    def _merge(self):
+        if not (self.pending_articles or self.pending_authors or self.pending_links):
+            return
+        articles, self.pending_articles = self.pending_articles, {}
+        authors, self.pending_authors = self.pending_authors, {}
+        links, self.pending_links = self.pending_links, []
+
+        self._add_articles(list(articles), [section for section, _ in articles.values()], [words for _, words in articles.values()])
+        self._add_authors(list(authors), list(authors.values()))
+        self._add_links([article_id for article_id, _ in links], [author_id for _, author_id in links])
+
+    def statistics(self):
+        """
+        Number of rows in the engine
+        """
+
+        self._merge()
+        return {'articles': len(self.article_ids), 'authors': len(self.author_ids), 'links': len(self.link_article_ids)}
+
+    # --------------------------------------------
+    #  Query Authors
+    # --------------------------------------------
+
+    def _author_links(self, author):
+        # Links of the authors whose name contains the string, to an existing article
+        needle = author.translate(ASCII_LOWER)
+        matches = np.fromiter(
+            (name is not None and needle in name for name in self.folded_names), dtype=bool, count=len(self.folded_names)
+        )
+        # Name -1 (author missing) reads the last entry: False
+        matches = np.append(matches, False)
+        return matches[self.link_names] & (self.link_sections >= 0)
+
+    def articles_count_by_section_by_author(self, author):
+        """
+        Rows of the query 'articles_count_by_section_by_author'
+        :param author: string contained in the author names
+        """
+
+        self._merge()
+        return self._section_rows(np.bincount(self.link_sections[self._author_links(author)], minlength=len(self.sections)))
+
+    def _section_rows(self, counts):
+        # Rows of the article counts per section code, most articles first
+        rows = [
+            {'section_name': self.sections[code], 'total_articles_in_section': count}
+            for code, count in zip(np.flatnonzero(counts).tolist(), counts[counts > 0].tolist())
+        ]
+        rows.sort(key=lambda row: (-row['total_articles_in_section'], row['section_name'] is not None, row['section_name'] or ''))
+        return rows
+
+    def articles_count_by_author(self, author, limit=20):
+        """
+        Rows of the query 'articles_count_by_author'
+        :param author: string contained in the author names
+        :param limit: number of authors returned, most articles first
+        """
+
+        self._merge()
+        counts = np.bincount(self.link_names[self._author_links(author)], minlength=len(self.names))
+        codes = np.flatnonzero(counts)
+        if len(codes) > limit:
+            # Top-k: only the names reaching the count of the k-th are sorted
+            threshold = np.partition(counts[codes], len(codes) - limit)[len(codes) - limit]
+            codes = codes[counts[codes] >= threshold]
+        top = sorted(zip(counts[codes].tolist(), codes.tolist()), key=lambda item: (-item[0], self.names[item[1]]))
+        return [{'author_name': self.names[code], 'total_articles': count} for count, code in top[:limit]]
+
+    def _requested_names(self, authors, author_ids):
+        # Name codes of every requested author: the names containing each string, then the name of each author id
+        folded = [(code, name) for code, name in enumerate(self.folded_names) if name is not None]
+        requested = []
+        for author in authors:
+            needle = author.translate(ASCII_LOWER)
+            requested.append(np.array([code for code, name in folded if needle in name], dtype=np.int64))
+        position, found = _lookup(self.author_ids, np.array(author_ids, dtype=np.int64))
+        for code in _take(self.author_names, position, found, -1).tolist():
+            requested.append(np.array([code] if code >= 0 else [], dtype=np.int64))
+        return requested
+
+    def articles_count_by_author_batch(self, authors, author_ids, limit=20):
+        """
+        Rows of articles_count_by_author() for every requested author, in one pass over the links:
+        one list of rows per string of authors, then one per id of author_ids
+        :param authors: strings contained in the author names
+        :param author_ids: author ids
+        :param limit: number of authors returned per requested author, most articles first
+        """
+
+        self._merge()
+        linked = (self.link_sections >= 0) & (self.link_names >= 0)
+        counts = np.bincount(self.link_names[linked], minlength=len(self.names))
+        groups = []
+        for codes in self._requested_names(authors, author_ids):
+            codes = codes[counts[codes] > 0]
+            top = sorted(zip(counts[codes].tolist(), codes.tolist()), key=lambda item: (-item[0], self.names[item[1]] or ''))
+            groups.append([{'author_name': self.names[code], 'total_articles': count} for count, code in top[:limit]])
+        return groups
+
+    def articles_count_by_section_by_author_batch(self, authors, author_ids):
+        """
+        Rows of articles_count_by_section_by_author() for every requested author, in one pass over the links,
+        like articles_count_by_author_batch()
+        :param authors: strings contained in the author names
+        :param author_ids: author ids
+        """
+
+        self._merge()
+        linked = (self.link_sections >= 0) & (self.link_names >= 0)
+        sections = max(len(self.sections), 1)
+        # Article counts per (name, section), sorted by name
+        keys, counts = np.unique(self.link_names[linked].astype(np.int64) * sections + self.link_sections[linked], return_counts=True)
+        groups = []
+        for codes in self._requested_names(authors, author_ids):
+            starts = np.searchsorted(keys, codes * sections)
+            ends = np.searchsorted(keys, (codes + 1) * sections)
+            selected = np.concatenate([np.arange(start, end) for start, end in zip(starts.tolist(), ends.tolist())] or [np.empty(0, dtype=np.int64)])
+            section_counts = np.bincount(keys[selected] % sections, weights=counts[selected], minlength=len(self.sections))
+            groups.append(self._section_rows(section_counts.astype(np.int64)))
+        return groups
+
+    # --------------------------------------------
+    #  Info Authors
+    # --------------------------------------------
+
+    def _section_author_groups(self):
+        # Groups (section, author name) of the links, sorted by section: sections, names, link mask, group of every link
+        mask = (self.link_sections >= 0) & (self.link_names >= 0)
+        if None in self.section_codes:
+            mask &= self.link_sections != self.section_codes[None]
+        size = max(len(self.names), 1)
+        keys = self.link_sections[mask].astype(np.int64) * size + self.link_names[mask]
+        groups, inverse = np.unique(keys, return_inverse=True)
+        return groups // size, groups % size, mask, inverse.ravel()
+
+    def top_authors_by_section(self):
+        """
+        Rows of the query 'top_authors_by_section', in the order of its keyset
+        """
+
+        self._merge()
+        if 'top_authors_by_section' not in self.results:
+            sections, names, _, inverse = self._section_author_groups()
+            counts = np.bincount(inverse, minlength=len(sections))
+            winners = _section_winners(sections, counts)
+            rows = [
+                {'section_name': self.sections[section], 'top_author_name': self.names[name], 'article_count': count}
+                for section, name, count in zip(sections[winners].tolist(), names[winners].tolist(), counts[winners].tolist())
+            ]
+            rows.sort(key=lambda row: (row['section_name'], row['top_author_name'] or ''))
+            self.results['top_authors_by_section'] = rows
+        return self.results['top_authors_by_section']
+
+    def most_prolific_authors_by_section(self):
+        """
+        Rows of the query 'most_prolific_authors_by_section', in the order of its keyset
+        """
+
+        self._merge()
+        if 'most_prolific_authors_by_section' not in self.results:
+            sections, names, mask, inverse = self._section_author_groups()
+            totals = np.rint(np.bincount(inverse, weights=self.link_words[mask], minlength=len(sections))).astype(np.int64)
+            not_null = np.bincount(inverse, weights=~self.link_words_null[mask], minlength=len(sections)) > 0
+            # The NULL sums do not take part in the comparisons
+            sections, names, totals = sections[not_null], names[not_null], totals[not_null]
+            winners = _section_winners(sections, totals)
+            rows = [
+                {'section_name': self.sections[section], 'author_name': self.names[name], 'total_word_count': total}
+                for section, name, total in zip(sections[winners].tolist(), names[winners].tolist(), totals[winners].tolist())
+            ]
+            rows.sort(key=lambda row: (-row['total_word_count'], row['section_name'], row['author_name'] or ''))
+            self.results['most_prolific_authors_by_section'] = rows
+        return self.results['most_prolific_authors_by_section']
+
+    def count_pairs_authors_collaboration(self):
+        """
+        Rows of the query 'count_pairs_authors_collaboration', in the order of its keyset
+        """
+
+        self._merge()
+        if 'count_pairs_authors_collaboration' not in self.results:
+            mask = self.link_names >= 0
+            article_ids = self.link_article_ids[mask]
+            author_ids = self.link_author_ids[mask]
+            order = np.lexsort((author_ids, article_ids))
+            article_ids, author_ids = article_ids[order], author_ids[order]
+
+            # Links sorted by article then author: the pairs are the links 'distance' apart in the same article.
+            # A link without pair at a distance has none further
+            first, second = [], []
+            index = np.arange(len(article_ids))
+            distance = 1
+            while True:
+                index = index[index + distance < len(article_ids)]
+                index = index[article_ids[index] == article_ids[index + distance]]
+                if not len(index):
+                    break
+                first.append(author_ids[index])
+                second.append(author_ids[index + distance])
+                distance += 1
+
+            rows = []
+            if first:
+                size = len(self.author_ids)
+                keys = np.searchsorted(self.author_ids, np.concatenate(first)) * size + np.searchsorted(self.author_ids, np.concatenate(second))
+                pairs, counts = np.unique(keys, return_counts=True)
+                order = np.lexsort((pairs, -counts))
+                pairs, counts = pairs[order], counts[order]
+                first, second = pairs // size, pairs % size
+                names = self.author_names
+                rows = [
+                    {
+                        'author1_id': author1_id,
+                        'author1_name': self.names[name1],
+                        'author2_id': author2_id,
+                        'author2_name': self.names[name2],
+                        'coauthored_articles_count': count
+                    }
+                    for author1_id, name1, author2_id, name2, count in zip(
+                        self.author_ids[first].tolist(), names[first].tolist(),
+                        self.author_ids[second].tolist(), names[second].tolist(),
+                        counts.tolist()
+                    )
+                ]
+            self.results['count_pairs_authors_collaboration'] = rows
+        return self.results['count_pairs_authors_collaboration']
@@ -1,7 +1,33 @@
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, UploadFile, File, Form, Query, Request, HTTPException
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.middleware.cors import CORSMiddleware
-from databases import Database
+from fastapi.responses import JSONResponse, PlainTextResponse
+from pydantic import BaseModel
 from datetime import datetime
+import os
+import json
+import string
+from typing import List, Optional
+import sys
+import asyncio
+
+# Shared modules of the APIs, in the parent directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from api_common.profiling import profile_request
+from api_common.request_metrics import record_request, metrics, SlowQueryLog
+from api_common.http_cache import ConditionalGet
+from api_common.responses import FastJSONResponse, rows_response, GZIP_MINIMUM_SIZE
+from query_registry import QueryRegistry, QueryRejected, like_contains
+from sqlite_pool import QueryTimeout
+from sharded_pool import Merge, best_of_group, top_of_group
+from result_cache import ResultCache
+from pagination import Keyset, paged_response, paged_rows_response, MAX_PAGE_SIZE
+from write_queue import WriteQueue, WriteQueueFull
+from author_index import AuthorIndex
+from columnar import ColumnarEngine, NUMPY_AVAILABLE
+from warmup import WarmUp, asgi_get
+# The bylines are split in authors like create_db.py does
+from etl.authors import split_authors
 
 # --------------------------------------------
 # Initialization, groups
@@ -9,6 +35,7 @@ app = FastAPI(
                 title="Read NYT Archive API Results from a SQLite Database",
                 description="► Powered by FastAPI and SQLite.",
                 version="0.1",
+                default_response_class=FastJSONResponse,
                 openapi_tags=[
                                 {
                                     'name': 'Status',
@@ -26,6 +53,10 @@ app = FastAPI(
                                     'name': 'Info Authors',
                                     'description': 'Retrieve predefined info-queries about authors'
                                 },
+                                {
+                                    'name': 'Query Keywords',
+                                    'description': 'Query articles and authors by the keywords of the articles'
+                                },
                                 {
                                     'name': 'Test Insert Author',
                                     'description': 'Test the DB-Normalization inserting one article with a new author in the DB, and after checking the author table'
@@ -33,17 +64,223 @@ app = FastAPI(
                             ]
 )
 
-database = Database("sqlite:///../output_data/nyt_db.db")
+# Per-request profiling on demand, see api_common/profiling.py
+app.middleware("http")(profile_request)
+
+# ETags of the GETs tied to the content version of the database, 304 without running the query,
+# see api_common/http_cache.py
+async def content_version():
+    await queries.check_reload()
+    return queries.content_version()
+
+http_cache = ConditionalGet(content_version, no_store=['/', '/ready', '/metrics', '/query_stats', '/cache_stats', '/write_queue_stats'])
+app.middleware("http")(http_cache)
+
+# Latency histograms per route and slow-query log, see api_common/request_metrics.py
+app.middleware("http")(record_request)
+
+# Responses compressed when the client accepts gzip, see api_common/responses.py
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE)
+
+# SQLite database file, can be changed with the environment variable NYT_DB_PATH
+NYT_DB_PATH = os.environ.get('NYT_DB_PATH', '../output_data/nyt_db.db')
+
+# Cache of the query results, see result_cache.py. Can be changed with the environment variables:
+# NYT_CACHE_SIZE maximum number of cached results (0 disables the cache), NYT_CACHE_TTL_S seconds
+# a result is served (0: until the next insert or reload of the database file)
+NYT_CACHE_SIZE = int(os.environ.get('NYT_CACHE_SIZE', '1024'))
+NYT_CACHE_TTL_S = float(os.environ.get('NYT_CACHE_TTL_S', '0'))
+
+# Connections to the database, see sqlite_pool.py. Can be changed with the environment variables:
+# NYT_DB_READERS number of read connections and threads (default: number of CPUs),
+# NYT_DB_CACHE_SIZE_KB page cache of every connection, NYT_DB_MMAP_SIZE bytes read through mmap
+NYT_DB_READERS = int(os.environ.get('NYT_DB_READERS', '0')) or None
+NYT_DB_CACHE_SIZE_KB = int(os.environ.get('NYT_DB_CACHE_SIZE_KB', '65536'))
+NYT_DB_MMAP_SIZE = int(os.environ.get('NYT_DB_MMAP_SIZE', '268435456'))
+
+# Cost guard of the SELECTs, see query_registry.py. Can be changed with the environment variables:
+# NYT_QUERY_TIMEOUT_S time budget of every SELECT, NYT_HEAVY_QUERY_TIMEOUT_S time budget of the
+# aggregates over the whole archive, NYT_HEAVY_QUERY_CONCURRENCY maximum concurrent executions of
+# each of these aggregates (0: no limit). A SELECT over its budget is interrupted and answers 504,
+# an aggregate over its limit answers 503 at once
+NYT_QUERY_TIMEOUT_S = float(os.environ.get('NYT_QUERY_TIMEOUT_S', '10'))
+NYT_HEAVY_QUERY_TIMEOUT_S = float(os.environ.get('NYT_HEAVY_QUERY_TIMEOUT_S', '60'))
+NYT_HEAVY_QUERY_CONCURRENCY = int(os.environ.get('NYT_HEAVY_QUERY_CONCURRENCY', '2')) or None
+
+# When create_db publishes a new snapshot of the database, the API switches to it without a restart:
+# the requests in progress on the old snapshot get NYT_DRAIN_TIMEOUT_S seconds to end (0: no limit)
+NYT_DRAIN_TIMEOUT_S = float(os.environ.get('NYT_DRAIN_TIMEOUT_S', '120')) or None
+
+# Warm-up after the start, see warmup.py. Can be changed with the environment variables:
+# NYT_PREFETCH_TABLES tables read into memory with their indexes, comma separated (empty: none),
+# NYT_WARMUP_REQUESTS GET requests answered before the API reports ready, separated by spaces,
+# e.g. '/top_authors_by_section /articles_count_by_author?author=smith'
+NYT_PREFETCH_TABLES = [table.strip() for table in os.environ.get('NYT_PREFETCH_TABLES', 'article_author,author,article').split(',') if table.strip()]
+NYT_WARMUP_REQUESTS = os.environ.get('NYT_WARMUP_REQUESTS', '').split()
+
+# Registry of the parameterized SQL statements of every endpoint, see query_registry.py
+queries = QueryRegistry(
+    cache=ResultCache(NYT_CACHE_SIZE, NYT_CACHE_TTL_S),
+    default_timeout_s=NYT_QUERY_TIMEOUT_S,
+    drain_timeout_s=NYT_DRAIN_TIMEOUT_S,
+    prefetch_tables=NYT_PREFETCH_TABLES,
+    slow_log=SlowQueryLog('sqlite')
+)
+
+# Options of the registration of the expensive aggregates
+HEAVY_QUERY = {'timeout_s': NYT_HEAVY_QUERY_TIMEOUT_S, 'max_concurrent': NYT_HEAVY_QUERY_CONCURRENCY}
+
+# Group commit of the inserts, see write_queue.py. Can be changed with the environment variables:
+# NYT_WRITE_BATCH_SIZE maximum writes per transaction, NYT_WRITE_MAX_DELAY_MS maximum wait of a write
+# for the next ones, NYT_WRITE_QUEUE_SIZE maximum writes queued before the inserts answer 503
+NYT_WRITE_BATCH_SIZE = int(os.environ.get('NYT_WRITE_BATCH_SIZE', '256'))
+NYT_WRITE_MAX_DELAY_MS = float(os.environ.get('NYT_WRITE_MAX_DELAY_MS', '2'))
+NYT_WRITE_QUEUE_SIZE = int(os.environ.get('NYT_WRITE_QUEUE_SIZE', '10000'))
+
+write_queue = WriteQueue(
+    queries,
+    max_batch=NYT_WRITE_BATCH_SIZE,
+    max_delay_ms=NYT_WRITE_MAX_DELAY_MS,
+    max_pending=NYT_WRITE_QUEUE_SIZE
+)
+
+# Columnar engine of the author and section aggregates, see columnar.py.
+# Loaded at startup, updated by the inserts, reloaded when the database is replaced or written by
+# another process. Until it is loaded, and without numpy, the endpoints run their SQL query.
+# Switched off with the environment variable NYT_COLUMNAR=0
+NYT_COLUMNAR = os.environ.get('NYT_COLUMNAR', '1').lower() in ('1', 'true', 'yes') and NUMPY_AVAILABLE
+COLUMNAR_LOAD_BATCH_SIZE = 50000
+
+columnar = None
+columnar_generation = 0
+# Inserts made during the loads in progress, applied to the new engines once loaded
+columnar_replays = []
+
+queries.register('columnar_articles', '''
+            SELECT 
+                article_id, 
+                section_name, 
+                word_count
+            FROM 
+                article
+            ORDER BY 
+                article_id
+            ''', cacheable=False, timeout_s=0, merge=Merge(order_by=[('article_id', 'ASC')]))
+
+queries.register('columnar_authors', '''
+            SELECT 
+                author_id, 
+                author_name
+            FROM 
+                author
+            ORDER BY 
+                author_id
+            ''', cacheable=False, timeout_s=0, directory_only=True)
+
+queries.register('columnar_links', '''
+            SELECT 
+                article_id, 
+                author_id
+            FROM 
+                article_author
+            ''', cacheable=False, timeout_s=0)
+
+async def fetch_columns(name, columns):
+    values = {column: [] for column in columns}
+    async for rows in queries.stream(name, {}, COLUMNAR_LOAD_BATCH_SIZE):
+        for column in columns:
+            values[column].extend(row[column] for row in rows)
+    return [values[column] for column in columns]
+
+async def load_columnar(swapped=False):
+    global columnar, columnar_generation
+    if not NYT_COLUMNAR:
+        return
+
+    # The endpoints run their SQL query until the new engine is loaded. After a switch to a new snapshot
+    # the old engine answers meanwhile, like the old snapshot still read by the requests in progress.
+    # A load started later (e.g. the database was replaced again meanwhile) wins
+    if not swapped:
+        columnar = None
+    columnar_generation += 1
+    generation = columnar_generation
+    replay = []
+    columnar_replays.append(replay)
+    try:
+        articles = await fetch_columns('columnar_articles', ['article_id', 'section_name', 'word_count'])
+        authors = await fetch_columns('columnar_authors', ['author_id', 'author_name'])
+        links = await fetch_columns('columnar_links', ['article_id', 'author_id'])
+        engine = ColumnarEngine()
+        await asyncio.to_thread(engine.load, *articles, *authors, *links)
+        for inserted in replay:
+            engine.insert(*inserted)
+    finally:
+        columnar_replays.remove(replay)
+
+    if generation == columnar_generation:
+        columnar = engine
+        print(f"Columnar engine loaded: {engine.statistics()}")
+
+def columnar_insert(articles, authors, links):
+    """
+    Apply inserted rows to the columnar engine, see ColumnarEngine.insert()
+    """
+
+    if columnar is not None:
+        columnar.insert(articles, authors, links)
+    for replay in columnar_replays:
+        replay.append((articles, authors, links))
+
+queries.change_listeners.append(load_columnar)
+
+# --------------------------------------------
+@app.exception_handler(QueryTimeout)
+async def query_timeout(request: Request, exc: QueryTimeout):
+    return JSONResponse({'detail': str(exc)}, status_code=504)
+
+@app.exception_handler(QueryRejected)
+async def query_rejected(request: Request, exc: QueryRejected):
+    return JSONResponse({'detail': str(exc)}, status_code=503, headers={'Retry-After': '1'})
+
+# --------------------------------------------
+# The API serves at once, and reports ready on /ready once warmed up
+warmup = WarmUp()
+warmup_task = None
+
+async def warm_up_request(url):
+    status = await asgi_get(app, url)
+    if status != 200:
+        raise RuntimeError(f'GET {url} answered {status}')
+
+async def warm_up():
+    await warmup.run('prefetch_tables', queries.prefetch)
+    await warmup.run('author_index', load_author_index)
+    await warmup.run('columnar', load_columnar)
+    for url in NYT_WARMUP_REQUESTS:
+        await warmup.run(f'GET {url}', warm_up_request, url)
+    warmup.done()
 
 # --------------------------------------------
 @app.on_event("startup")
 async def database_connect():
-    await database.connect()
+    global warmup_task
+    await queries.connect(
+        NYT_DB_PATH,
+        readers=NYT_DB_READERS,
+        cache_size_kb=NYT_DB_CACHE_SIZE_KB,
+        mmap_size=NYT_DB_MMAP_SIZE
+    )
+    await write_queue.start()
+    warmup_task = asyncio.create_task(warm_up())
 
 # --------------------------------------------
 @app.on_event("shutdown")
 async def database_disconnect():
-    await database.disconnect()
+    if warmup_task is not None and not warmup_task.done():
+        warmup_task.cancel()
+        await asyncio.gather(warmup_task, return_exceptions=True)
+    await write_queue.stop()
+    await queries.disconnect()
 
     
 # ============================================
@@ -58,6 +295,16 @@ async def database_disconnect():
 async def get_index():
     return { 'API is running!': 'More info at: http://127.0.0.1:8000/docs' }
 
+# --------------------------------------------
+# Check if the api is warmed up and ready for the traffic: 503 until then
+@app.get(
+    "/ready",
+    name = "Check if the api is warmed up and ready for the traffic",
+    tags = ['Status']
+)
+async def get_ready():
+    return JSONResponse(warmup.state(), status_code=200 if warmup.ready else 503)
+
 
 # ============================================
 #  DB statistics
@@ -65,13 +312,16 @@ async def get_index():
 
 # --------------------------------------------
 # Retrieve the total number of rows per table
-@app.get(
-    "/rows_per_table",
-    name = "Total number of rows per table",
-    tags = ['Database Statistics']        
-)
-async def fetch_data():
-    query = '''
+def merge_rows_per_table(partials, values):
+    # On shards: the rows of the shard tables are added, the tables of the author directory
+    # (authors and keywords) are counted by every shard
+    rows = Merge(keys=['table_name'], sums=['total_rows'], order_by=[('table_name', 'ASC')])(partials, values)
+    for row in rows:
+        if row['table_name'] in ('author', 'keyword'):
+            row['total_rows'] = next(shard_row['total_rows'] for shard_row in partials[0] if shard_row['table_name'] == row['table_name'])
+    return rows
+
+queries.register('rows_per_table', '''
             SELECT 
                 'article' AS 'table_name',
                 COUNT(*) AS 'total_rows'
@@ -92,11 +342,83 @@ async def fetch_data():
                 'article_author' AS 'table_name', 
                 COUNT(*) AS 'total_rows'
             FROM 
-        	    article_author         
-            '''
-    query = query.format()
-    results = await database.fetch_all(query=query)
-    return  results
+        	    article_author
+
+            UNION
+
+            SELECT
+                'keyword' AS 'table_name', 
+                COUNT(*) AS 'total_rows'
+            FROM 
+        	    keyword
+
+            UNION
+
+            SELECT
+                'article_keyword' AS 'table_name', 
+                COUNT(*) AS 'total_rows'
+            FROM 
+        	    article_keyword
+            ''', merge=merge_rows_per_table)
+
+@app.get(
+    "/rows_per_table",
+    name = "Total number of rows per table",
+    tags = ['Database Statistics']        
+)
+async def fetch_data(request: Request):
+    results = await queries.fetch_all('rows_per_table')
+    return  rows_response(request, results)
+
+
+# --------------------------------------------
+# Call counts and timings of the SQL statements
+@app.get(
+    "/query_stats",
+    name = "Call counts and timings of every SQL statement of the API",
+    tags = ['Database Statistics']
+)
+async def fetch_query_stats():
+    return  queries.statistics()
+
+
+# --------------------------------------------
+# Latency histograms per route, split in DB and serialization time, rows returned and the last slow queries.
+# format=prometheus: the Prometheus text exposition format, without the slow queries
+@app.get(
+    "/metrics",
+    name = "Latency histograms per route (total, DB and serialization time), rows returned and slow queries",
+    tags = ['Database Statistics']
+)
+async def fetch_metrics(format: str = Query('json', regex='^(json|prometheus)$')):
+    if format == 'prometheus':
+        return  PlainTextResponse(metrics.prometheus_text(), media_type='text/plain; version=0.0.4')
+    return  {
+        'routes': metrics.statistics(),
+        'slow_queries': queries.slow_log.statistics()
+    }
+
+
+# --------------------------------------------
+# Hits and misses of the result cache
+@app.get(
+    "/cache_stats",
+    name = "Hits and misses of the result cache, and current database version",
+    tags = ['Database Statistics']
+)
+async def fetch_cache_stats():
+    return  queries.cache.statistics()
+
+
+# --------------------------------------------
+# Writes and batches of the group commit
+@app.get(
+    "/write_queue_stats",
+    name = "Writes queued, and writes and batches committed by the group commit of the inserts",
+    tags = ['Database Statistics']
+)
+async def fetch_write_queue_stats():
+    return  write_queue.statistics()
 
 
 # ============================================
@@ -104,40 +426,71 @@ async def fetch_data():
 # ============================================
 
 # --------------------------------------------
-# Retrieve the name of the authors containing the string entered
-@app.get(
-    "/author",
-    name = "Retrieve the names of authors that contain the [search string]",
-    tags = ['Query Authors']        
-)
-async def fetch_data(author: str):
-    query = '''
+# Autocomplete of the author names, see author_index.py.
+# Loaded at startup, updated by the inserts, reloaded when the database is replaced or
+# written by another process. Switched off with the environment variable NYT_AUTHOR_INDEX=0
+NYT_AUTHOR_INDEX = os.environ.get('NYT_AUTHOR_INDEX', '1').lower() in ('1', 'true', 'yes')
+
+author_index = AuthorIndex()
+author_index_loaded = False
+
+queries.register('author_index_rows', '''
+            SELECT 
+                au.author_id, 
+                au.author_name, 
+                COUNT(arau.article_id) AS total_articles
+            FROM 
+                author au
+                LEFT JOIN 
+                    article_author arau ON au.author_id = arau.author_id
+            GROUP BY 
+                au.author_id
+            ''', cacheable=False, timeout_s=0, merge=Merge(keys=['author_id'], sums=['total_articles']))
+
+async def load_author_index(swapped=False):
+    global author_index_loaded
+    if not NYT_AUTHOR_INDEX:
+        return
+    author_index.load(await queries.fetch_all('author_index_rows'))
+    author_index_loaded = True
+    print(f"Author index loaded: {len(author_index)} authors")
+
+queries.change_listeners.append(load_author_index)
+
+# Retrieve the name of the authors containing the string entered.
+# With the autocomplete index: the authors with a word of the name starting with every word entered,
+# most articles first. Without it: the names containing the string
+queries.register('author', '''
             SELECT 
                 * 
             FROM 
                 author
             WHERE 
-                author_name LIKE '%{author}%'
-            LIMIT 5          
-            '''
-    query = query.format(author=author)
-    results = await database.fetch_all(query=query)
-    return  results
+                author_name LIKE :author ESCAPE '\\'
+            LIMIT :limit          
+            ''', directory_only=True)
 
-# --------------------------------------------
-# Visualize the count of articles authored by [author name]
-# that include the [exact word] in the 'headline_main' field
 @app.get(
-    "/articles_count_with_word_in_headline_by_author",
-    name = "Visualize the count of articles authored by [author name] that include the [exact word] in the 'headline_main' field",
+    "/author",
+    name = "Retrieve the names of authors that contain the [search string]",
     tags = ['Query Authors']        
 )
-async def fetch_data(author: str, word: str):
-    query = '''
+async def fetch_data(request: Request, author: str, limit: int = Query(5, ge=1, le=50)):
+    if author_index_loaded:
+        return  rows_response(request, author_index.search(author, limit))
+
+    values = {"author": like_contains(author), "limit": limit}
+    results = await queries.fetch_all('author', values)
+    return  rows_response(request, results)
+
+# --------------------------------------------
+# Visualize the count of articles authored by [author name]
+# that include the [exact word] in the 'headline_main' field
+queries.register('articles_count_with_word_in_headline_by_author', '''
             SELECT 
                 au.author_name, 
                 COUNT(ar.article_id) AS total_articles, 
-                '{word}' AS word_in_headline
+                :word_value AS word_in_headline
             FROM 
                 article ar
                 JOIN 
@@ -145,29 +498,30 @@ async def fetch_data(author: str, word: str):
                 JOIN 
                     author au           ON arau.author_id = au.author_id
             WHERE 
-                ar.headline_main LIKE '%{word}%'
+                ar.headline_main LIKE :word ESCAPE '\\'
                 AND 
-                au.author_name LIKE '%{author}%'
+                au.author_name LIKE :author ESCAPE '\\'
             GROUP BY 
                 au.author_name
             ORDER BY 
                 total_articles DESC, 
                 au.author_name ASC
             LIMIT 20;         
-            '''
-    query = query.format(word=word, author=author)
-    results = await database.fetch_all(query=query)
-    return  results
+            ''', merge=Merge(keys=['author_name'], sums=['total_articles'], order_by=[('total_articles', 'DESC'), ('author_name', 'ASC')], limit=20), **HEAVY_QUERY)
 
-# --------------------------------------------
-# Visualize the count of articles authored by [author name] in each section
 @app.get(
-"/articles_count_by_section_by_author",
-    name = "Visualize the count of articles authored by [author name] in each section",
+    "/articles_count_with_word_in_headline_by_author",
+    name = "Visualize the count of articles authored by [author name] that include the [exact word] in the 'headline_main' field",
     tags = ['Query Authors']        
 )
-async def fetch_data(author: str):
-    query = '''
+async def fetch_data(request: Request, author: str, word: str):
+    values = {"author": like_contains(author), "word": like_contains(word), "word_value": word}
+    results = await queries.fetch_all('articles_count_with_word_in_headline_by_author', values)
+    return  rows_response(request, results)
+
+# --------------------------------------------
+# Visualize the count of articles authored by [author name] in each section
+queries.register('articles_count_by_section_by_author', '''
             SELECT 
                 ar.section_name, 
                 COUNT(*) AS total_articles_in_section
@@ -178,26 +532,31 @@ async def fetch_data(author: str):
                 JOIN 
                     author au           ON arau.author_id = au.author_id
             WHERE 
-                au.author_name LIKE '%{author}%'
+                au.author_name LIKE :author ESCAPE '\\'
             GROUP BY 
                 ar.section_name
             ORDER BY 
-                total_articles_in_section DESC;         
-            '''
-    query = query.format(author=author)
-    results = await database.fetch_all(query=query)
-    return  results
+                total_articles_in_section DESC, 
+                ar.section_name ASC;         
+            ''', merge=Merge(keys=['section_name'], sums=['total_articles_in_section'], order_by=[('total_articles_in_section', 'DESC'), ('section_name', 'ASC')]), **HEAVY_QUERY)
 
-# --------------------------------------------
-# Visualize the count of articles written by authors
-# whose name contains the [search string]
 @app.get(
-    "/articles_count_by_author",
-    name = "Visualize the count of articles written by authors whose name contains the [search string]",
+"/articles_count_by_section_by_author",
+    name = "Visualize the count of articles authored by [author name] in each section",
     tags = ['Query Authors']        
 )
-async def fetch_data(author: str):
-    query = '''
+async def fetch_data(request: Request, author: str):
+    if columnar is not None:
+        return  rows_response(request, columnar.articles_count_by_section_by_author(author))
+
+    values = {"author": like_contains(author)}
+    results = await queries.fetch_all('articles_count_by_section_by_author', values)
+    return  rows_response(request, results)
+
+# --------------------------------------------
+# Visualize the count of articles written by authors
+# whose name contains the [search string]
+queries.register('articles_count_by_author', '''
             SELECT 
                 au.author_name, 
                 COUNT(ar.article_id) AS total_articles
@@ -208,27 +567,37 @@ async def fetch_data(author: str):
                 JOIN 
                     author au           ON arau.author_id = au.author_id
             WHERE 
-                au.author_name LIKE '%{author}%'
+                au.author_name LIKE :author ESCAPE '\\'
             GROUP BY 
                 au.author_name
             ORDER BY 
                 total_articles DESC, au.author_name ASC
             LIMIT 20;         
-            '''
-    query = query.format(author=author)
-    results = await database.fetch_all(query=query)
-    return  results
+            ''', merge=Merge(keys=['author_name'], sums=['total_articles'], order_by=[('total_articles', 'DESC'), ('author_name', 'ASC')], limit=20), **HEAVY_QUERY)
 
-# --------------------------------------------
-# Visualize the count of articles authored by each author,
-# grouped by year and month.
 @app.get(
-    "/articles_count_by_author_per_year_month",
-    name = "Visualize the count of articles authored by [author name] string, grouped by year and month",
+    "/articles_count_by_author",
+    name = "Visualize the count of articles written by authors whose name contains the [search string]",
     tags = ['Query Authors']        
 )
-async def fetch_data(author: str):
-    query = '''
+async def fetch_data(request: Request, author: str):
+    if columnar is not None:
+        return  rows_response(request, columnar.articles_count_by_author(author))
+
+    values = {"author": like_contains(author)}
+    results = await queries.fetch_all('articles_count_by_author', values)
+    return  rows_response(request, results)
+
+# --------------------------------------------
+# Visualize the count of articles authored by each author,
+# grouped by year and month. Optionally only the articles of one [year]:
+# on a sharded database, only the shards of this year are read
+def year_date_range(values):
+    if values.get('first_date') is None:
+        return None
+    return (values['first_date'], values['last_date'])
+
+queries.register('articles_count_by_author_per_year_month', '''
             SELECT 
             	au.author_name,
                 STRFTIME('%Y', a.a_date) AS year,
@@ -241,7 +610,9 @@ async def fetch_data(author: str):
                 JOIN 
                     author au ON aa.author_id = au.author_id
             WHERE
-            	au.author_name LIKE "%{author}%"
+            	au.author_name LIKE :author ESCAPE '\\'
+                AND
+                (:first_date IS NULL OR a.a_date BETWEEN :first_date AND :last_date)
             GROUP BY 
                 au.author_name, 
                 year
@@ -249,10 +620,241 @@ async def fetch_data(author: str):
             	au.author_name,
             	year,
             	month;
-            '''
-    query = query.format(author=author)
-    results = await database.fetch_all(query=query)
-    return  results
+            ''', merge=Merge(keys=['author_name', 'year'], sums=['articles_written'], order_by=[('author_name', 'ASC'), ('year', 'ASC'), ('month', 'ASC')]),
+            date_range=year_date_range, **HEAVY_QUERY)
+
+@app.get(
+    "/articles_count_by_author_per_year_month",
+    name = "Visualize the count of articles authored by [author name] string, grouped by year and month",
+    tags = ['Query Authors']        
+)
+async def fetch_data(request: Request, author: str, year: Optional[int] = Query(None, ge=1, le=9999)):
+    values = {"author": like_contains(author), "first_date": None, "last_date": None}
+    if year is not None:
+        values.update({"first_date": f"{year:04d}-01-01", "last_date": f"{year:04d}-12-31"})
+    results = await queries.fetch_all('articles_count_by_author_per_year_month', values)
+    return  rows_response(request, results)
+
+
+# --------------------------------------------
+# Batched lookups: the queries above for a list of authors in one request and one query.
+# The authors are given by the strings contained in their names, like the endpoints above, and/or by their ids.
+# The list is bound as one JSON parameter, read by json_each(): the SQL text stays the same for any
+# number of authors, and article_author is scanned once for all of them.
+# The rows come back grouped by requested author, in the order of the request: one group per string
+# of 'authors', then one per id of 'author_ids'. At most NYT_BATCH_MAX_AUTHORS authors per request
+BATCH_MAX_AUTHORS = int(os.environ.get('NYT_BATCH_MAX_AUTHORS', '1000'))
+
+class AuthorBatch(BaseModel):
+    authors: List[str] = []
+    author_ids: List[int] = []
+
+# The requested authors: position in the request, id and name of every author they match
+BATCH_AUTHORS_CTE = '''
+            requested_author AS (
+                SELECT 
+                    r.key AS position, 
+                    au.author_id, 
+                    au.author_name
+                FROM 
+                    json_each(:authors) r
+                    JOIN 
+                        author au ON au.author_name LIKE r.value ESCAPE '\\'
+
+                UNION ALL
+
+                SELECT 
+                    json_array_length(:authors) + r.key AS position, 
+                    au.author_id, 
+                    au.author_name
+                FROM 
+                    json_each(:author_ids) r
+                    JOIN 
+                        author au ON au.author_id = r.value
+            )'''
+
+def batch_values(batch):
+    if not batch.authors and not batch.author_ids:
+        raise HTTPException(status_code=422, detail="No authors nor author_ids in the batch")
+    if len(batch.authors) + len(batch.author_ids) > BATCH_MAX_AUTHORS:
+        raise HTTPException(status_code=413, detail=f"More than {BATCH_MAX_AUTHORS} authors in one batch")
+    return {
+        "authors": json.dumps([like_contains(author) for author in batch.authors]),
+        "author_ids": json.dumps(batch.author_ids)
+    }
+
+def author_groups(batch, rows):
+    # Rows of a batched query grouped by requested author. The rows can be shared with the result cache: copied
+    groups = [{'author': author, 'rows': []} for author in batch.authors]
+    groups += [{'author_id': author_id, 'rows': []} for author_id in batch.author_ids]
+    for row in rows:
+        groups[row['position']]['rows'].append({column: value for column, value in row.items() if column != 'position'})
+    return groups
+
+def columnar_groups(batch, results):
+    groups = [{'author': author} for author in batch.authors] + [{'author_id': author_id} for author_id in batch.author_ids]
+    for group, rows in zip(groups, results):
+        group['rows'] = rows
+    return groups
+
+# --------------------------------------------
+# Count of articles of the authors whose name contains every [search string], for a list of strings or ids
+queries.register('articles_count_by_author_batch', f'''
+            WITH {BATCH_AUTHORS_CTE}
+
+            SELECT 
+                position, 
+                author_name, 
+                total_articles
+            FROM (
+                SELECT 
+                    ra.position, 
+                    ra.author_name, 
+                    COUNT(*) AS total_articles,
+                    ROW_NUMBER() OVER (PARTITION BY ra.position ORDER BY COUNT(*) DESC, ra.author_name ASC) AS author_rank
+                FROM 
+                    requested_author ra
+                    JOIN 
+                        article_author arau ON arau.author_id = ra.author_id
+                    JOIN 
+                        article ar          ON ar.article_id  = arau.article_id
+                GROUP BY 
+                    ra.position, 
+                    ra.author_name
+            )
+            WHERE 
+                author_rank <= 20
+            ORDER BY 
+                position, 
+                total_articles DESC, 
+                author_name ASC;
+            ''',
+            # On shards: the counts of every shard, the first 20 authors of every position once they are added
+            shard_sql=f'''
+            WITH {BATCH_AUTHORS_CTE}
+
+            SELECT 
+                ra.position, 
+                ra.author_name, 
+                COUNT(*) AS total_articles
+            FROM 
+                requested_author ra
+                JOIN 
+                    article_author arau ON arau.author_id = ra.author_id
+                JOIN 
+                    article ar          ON ar.article_id  = arau.article_id
+            GROUP BY 
+                ra.position, 
+                ra.author_name
+            ''',
+            merge=Merge(
+                keys=['position', 'author_name'],
+                sums=['total_articles'],
+                having=top_of_group('position', [('total_articles', 'DESC'), ('author_name', 'ASC')], 20),
+                order_by=[('position', 'ASC'), ('total_articles', 'DESC'), ('author_name', 'ASC')]
+            ),
+            **HEAVY_QUERY)
+
+@app.post(
+    "/articles_count_by_author_batch",
+    name = "Batched /articles_count_by_author: the count of articles of the authors matching every string of [authors] or id of [author_ids]",
+    tags = ['Query Authors']
+)
+async def fetch_data(request: Request, batch: AuthorBatch):
+    values = batch_values(batch)
+    if columnar is not None:
+        return  rows_response(request, columnar_groups(batch, columnar.articles_count_by_author_batch(batch.authors, batch.author_ids)))
+
+    results = await queries.fetch_all('articles_count_by_author_batch', values)
+    return  rows_response(request, author_groups(batch, results))
+
+# --------------------------------------------
+# Count of articles per section of the authors matching every [search string], for a list of strings or ids
+queries.register('articles_count_by_section_by_author_batch', f'''
+            WITH {BATCH_AUTHORS_CTE}
+
+            SELECT 
+                ra.position, 
+                ar.section_name, 
+                COUNT(*) AS total_articles_in_section
+            FROM 
+                requested_author ra
+                JOIN 
+                    article_author arau ON arau.author_id = ra.author_id
+                JOIN 
+                    article ar          ON ar.article_id  = arau.article_id
+            GROUP BY 
+                ra.position, 
+                ar.section_name
+            ORDER BY 
+                ra.position, 
+                total_articles_in_section DESC, 
+                ar.section_name ASC;
+            ''', merge=Merge(
+                keys=['position', 'section_name'],
+                sums=['total_articles_in_section'],
+                order_by=[('position', 'ASC'), ('total_articles_in_section', 'DESC'), ('section_name', 'ASC')]
+            ), **HEAVY_QUERY)
+
+@app.post(
+    "/articles_count_by_section_by_author_batch",
+    name = "Batched /articles_count_by_section_by_author: the count of articles per section of the authors matching every string of [authors] or id of [author_ids]",
+    tags = ['Query Authors']
+)
+async def fetch_data(request: Request, batch: AuthorBatch):
+    values = batch_values(batch)
+    if columnar is not None:
+        return  rows_response(request, columnar_groups(batch, columnar.articles_count_by_section_by_author_batch(batch.authors, batch.author_ids)))
+
+    results = await queries.fetch_all('articles_count_by_section_by_author_batch', values)
+    return  rows_response(request, author_groups(batch, results))
+
+# --------------------------------------------
+# Count of articles per year and month of the authors matching every [search string], for a list of strings or ids.
+# Optionally only the articles of one [year]
+queries.register('articles_count_by_author_per_year_month_batch', f'''
+            WITH {BATCH_AUTHORS_CTE}
+
+            SELECT 
+                ra.position, 
+            	ra.author_name,
+                STRFTIME('%Y', a.a_date) AS year,
+            	STRFTIME('%m', a.a_date) AS month,
+                COUNT(*) as articles_written
+            FROM 
+                requested_author ra
+                JOIN 
+                    article_author aa ON aa.author_id = ra.author_id
+                JOIN 
+                    article a         ON a.article_id = aa.article_id
+            WHERE
+                :first_date IS NULL OR a.a_date BETWEEN :first_date AND :last_date
+            GROUP BY 
+                ra.position, 
+                ra.author_name, 
+                year
+            ORDER BY 
+                ra.position, 
+            	ra.author_name,
+            	year,
+            	month;
+            ''', merge=Merge(
+                keys=['position', 'author_name', 'year'],
+                sums=['articles_written'],
+                order_by=[('position', 'ASC'), ('author_name', 'ASC'), ('year', 'ASC'), ('month', 'ASC')]
+            ), date_range=year_date_range, **HEAVY_QUERY)
+
+@app.post(
+    "/articles_count_by_author_per_year_month_batch",
+    name = "Batched /articles_count_by_author_per_year_month: the count of articles per year and month of the authors matching every string of [authors] or id of [author_ids]",
+    tags = ['Query Authors']
+)
+async def fetch_data(request: Request, batch: AuthorBatch, year: Optional[int] = Query(None, ge=1, le=9999)):
+    values = {**batch_values(batch), "first_date": None, "last_date": None}
+    if year is not None:
+        values.update({"first_date": f"{year:04d}-01-01", "last_date": f"{year:04d}-12-31"})
+    results = await queries.fetch_all('articles_count_by_author_per_year_month_batch', values)
+    return  rows_response(request, author_groups(batch, results))
 
 
 # ============================================
@@ -262,13 +864,13 @@ async def fetch_data(author: str):
 # --------------------------------------------
 # Rank the authors in each section by the count of their articles
 # and visualize the top author in each section.
-@app.get(
-    "/top_authors_by_section",
-    name = "Rank the authors in each section by the count of their articles and visualize the top author in each section",
-    tags = ['Info Authors']        
-)
-async def fetch_data():
-    query = '''
+# Paginated by section, see pagination.py
+top_authors_by_section_keyset = Keyset('top_authors_by_section', [
+    ('section_name', 'ASC', "''"),
+    ('top_author_name', 'ASC', "''")
+])
+
+queries.register('top_authors_by_section', f'''
             WITH section_author_count AS (
                 SELECT 
                     a.section_name, 
@@ -283,39 +885,85 @@ async def fetch_data():
                 GROUP BY 
                     a.section_name, 
                     au.author_name
+            ),
+
+            top_authors AS (
+                SELECT 
+                    s1.section_name, 
+                    s1.author_name AS top_author_name, 
+                    s1.article_count
+                FROM 
+                    section_author_count s1
+                    JOIN 
+                        section_author_count s2 ON s1.section_name = s2.section_name AND s1.article_count <= s2.article_count
+                GROUP BY 
+                    s1.section_name, 
+                    s1.author_name
+                HAVING 
+                    COUNT(*) <= 1
             )
 
             SELECT 
-                s1.section_name, 
-                s1.author_name AS top_author_name, 
-                s1.article_count
+                * 
+            FROM 
+                top_authors
+            WHERE 
+                {top_authors_by_section_keyset.where}
+            ORDER BY 
+                {top_authors_by_section_keyset.order_by}
+            LIMIT :limit;
+            ''',
+            # On shards: the article counts of every shard, the top authors are found once they are added
+            shard_sql='''
+            SELECT 
+                a.section_name, 
+                au.author_name AS top_author_name, 
+                COUNT(*) as article_count
             FROM 
-                section_author_count s1
+                article a
+                JOIN 
+                    article_author aa ON a.article_id = aa.article_id
                 JOIN 
-                    section_author_count s2 ON s1.section_name = s2.section_name AND s1.article_count <= s2.article_count
+                    author au ON aa.author_id = au.author_id
             GROUP BY 
-                s1.section_name, 
-                s1.author_name
-            HAVING 
-                COUNT(*) <= 1
-            ORDER BY 
-                s1.section_name, 
-                s1.article_count DESC;         
-            '''
-    query = query.format()
-    results = await database.fetch_all(query=query)
-    return  results
+                a.section_name, 
+                au.author_name
+            ''',
+            merge=Merge(
+                keys=['section_name', 'top_author_name'],
+                sums=['article_count'],
+                having=best_of_group('section_name', 'article_count'),
+                keyset=top_authors_by_section_keyset
+            ),
+            **HEAVY_QUERY)
 
-# --------------------------------------------
-# Rank authors in each section by word count
-# and visualize the author with the highest word count in each section.
 @app.get(
-    "/most_prolific_authors_by_section",
-    name = "Rank authors in each section by word count and visualize the author with the highest word count in each section",
+    "/top_authors_by_section",
+    name = "Rank the authors in each section by the count of their articles and visualize the top author in each section",
     tags = ['Info Authors']        
 )
-async def fetch_data():
-    query = '''
+async def fetch_data(
+                request: Request,
+                limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                cursor: Optional[str] = None,
+                format: str = Query('json', regex='^(json|ndjson)$')
+):
+    if columnar is not None:
+        return  paged_rows_response(request, top_authors_by_section_keyset, columnar.top_authors_by_section(), limit, cursor, format)
+
+    return  await paged_response(request, queries, top_authors_by_section_keyset, {}, limit, cursor, format)
+
+# --------------------------------------------
+# Rank authors in each section by word count
+# and visualize the author with the highest word count in each section.
+# Paginated by word count, see pagination.py
+most_prolific_authors_by_section_keyset = Keyset('most_prolific_authors_by_section', [
+    ('total_word_count', 'DESC', '0'),
+    ('section_name', 'ASC', "''"),
+    ('author_name', 'ASC', "''")
+])
+
+queries.register('most_prolific_authors_by_section', f'''
             WITH section_author_wordcount AS (
                 SELECT 
                     a.section_name, 
@@ -330,38 +978,117 @@ async def fetch_data():
                 GROUP BY 
                     a.section_name, 
                     au.author_name
+            ),
+
+            most_prolific AS (
+                SELECT 
+                    s1.section_name, 
+                    s1.author_name, 
+                    s1.total_word_count
+                FROM 
+                    section_author_wordcount s1
+                    JOIN 
+                      section_author_wordcount s2 ON s1.section_name = s2.section_name AND s1.total_word_count <= s2.total_word_count
+                GROUP BY 
+                    s1.section_name, 
+                    s1.author_name
+                HAVING 
+                    COUNT(*) <= 1
             )
 
             SELECT 
-                s1.section_name, 
-                s1.author_name, 
-                s1.total_word_count
+                * 
+            FROM 
+                most_prolific
+            WHERE 
+                {most_prolific_authors_by_section_keyset.where}
+            ORDER BY 
+                {most_prolific_authors_by_section_keyset.order_by}
+            LIMIT :limit;
+            ''',
+            # On shards: the word counts of every shard, the most prolific authors are found once they are added
+            shard_sql='''
+            SELECT 
+                a.section_name, 
+                au.author_name, 
+                SUM(a.word_count) as total_word_count
             FROM 
-                section_author_wordcount s1
+                article a
                 JOIN 
-                  section_author_wordcount s2 ON s1.section_name = s2.section_name AND s1.total_word_count <= s2.total_word_count
+                    article_author aa ON a.article_id = aa.article_id
+                JOIN 
+                    author au ON aa.author_id = au.author_id
             GROUP BY 
-                s1.section_name, 
-                s1.author_name
-            HAVING 
-                COUNT(*) <= 1
-            ORDER BY 
-                s1.total_word_count DESC;         
-            '''
-    query = query.format()
-    results = await database.fetch_all(query=query)
-    return  results
+                a.section_name, 
+                au.author_name
+            ''',
+            merge=Merge(
+                keys=['section_name', 'author_name'],
+                sums=['total_word_count'],
+                having=best_of_group('section_name', 'total_word_count'),
+                keyset=most_prolific_authors_by_section_keyset
+            ),
+            **HEAVY_QUERY)
+
+@app.get(
+    "/most_prolific_authors_by_section",
+    name = "Rank authors in each section by word count and visualize the author with the highest word count in each section",
+    tags = ['Info Authors']        
+)
+async def fetch_data(
+                request: Request,
+                limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                cursor: Optional[str] = None,
+                format: str = Query('json', regex='^(json|ndjson)$')
+):
+    if columnar is not None:
+        return  paged_rows_response(request, most_prolific_authors_by_section_keyset, columnar.most_prolific_authors_by_section(), limit, cursor, format)
+
+    return  await paged_response(request, queries, most_prolific_authors_by_section_keyset, {}, limit, cursor, format)
 
 # --------------------------------------------
 # Identify pairs of authors 
 # and visualize the count of articles they co-authored.
-@app.get(
-    "/count_pairs_authors_collaboration",
-    name = "Identify pairs of authors and visualize the count of articles they co-authored",
-    tags = ['Info Authors']
-)
-async def fetch_data():
-    query = '''
+# Paginated by count of articles, see pagination.py
+count_pairs_authors_collaboration_keyset = Keyset('count_pairs_authors_collaboration', [
+    ('coauthored_articles_count', 'DESC', None),
+    ('author1_id', 'ASC', None),
+    ('author2_id', 'ASC', None)
+])
+
+queries.register('count_pairs_authors_collaboration', f'''
+            WITH pairs AS (
+                SELECT 
+                    aa1.author_id AS author1_id,
+                    au1.author_name AS author1_name,
+                    aa2.author_id AS author2_id,
+                    au2.author_name AS author2_name,
+                    COUNT(*) AS coauthored_articles_count
+                FROM 
+                    article_author aa1
+                    JOIN 
+                        article_author aa2 ON aa1.article_id = aa2.article_id AND aa1.author_id < aa2.author_id
+                    JOIN 
+                        author au1 ON aa1.author_id = au1.author_id
+                    JOIN 
+                        author au2 ON aa2.author_id = au2.author_id
+                GROUP BY 
+                    author1_id, 
+                    author2_id
+            )
+
+            SELECT 
+                * 
+            FROM 
+                pairs
+            WHERE 
+                {count_pairs_authors_collaboration_keyset.where}
+            ORDER BY 
+                {count_pairs_authors_collaboration_keyset.order_by}
+            LIMIT :limit;
+            ''',
+            # On shards: the pairs of every shard, a pair can co-author articles of several shards
+            shard_sql='''
             SELECT 
                 aa1.author_id AS author1_id,
                 au1.author_name AS author1_name,
@@ -379,12 +1106,172 @@ async def fetch_data():
             GROUP BY 
                 author1_id, 
                 author2_id
+            ''',
+            merge=Merge(
+                keys=['author1_id', 'author2_id'],
+                sums=['coauthored_articles_count'],
+                keyset=count_pairs_authors_collaboration_keyset
+            ),
+            **HEAVY_QUERY)
+
+@app.get(
+    "/count_pairs_authors_collaboration",
+    name = "Identify pairs of authors and visualize the count of articles they co-authored",
+    tags = ['Info Authors']
+)
+async def fetch_data(
+                request: Request,
+                limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                cursor: Optional[str] = None,
+                format: str = Query('json', regex='^(json|ndjson)$')
+):
+    if columnar is not None:
+        return  paged_rows_response(request, count_pairs_authors_collaboration_keyset, columnar.count_pairs_authors_collaboration(), limit, cursor, format)
+
+    return  await paged_response(request, queries, count_pairs_authors_collaboration_keyset, {}, limit, cursor, format)
+
+
+# ============================================
+#  Query Keywords
+# ============================================
+
+# --------------------------------------------
+# Retrieve the articles tagged with the [keyword value],
+# optionally only the keywords of one [keyword name] (subject, persons, glocations, ...)
+# Paginated by rank of the keyword and date, 100 articles per page by default, see pagination.py
+articles_by_keyword_keyset = Keyset('articles_by_keyword', [
+    ('keyword_rank', 'ASC', '0'),
+    ('a_date', 'DESC', "''"),
+    ('article_id', 'ASC', None),
+    ('keyword_name', 'ASC', "''")
+])
+
+queries.register('articles_by_keyword', f'''
+            WITH tagged_articles AS (
+                SELECT 
+                    ar.article_id, 
+                    ar.headline_main, 
+                    ar.section_name, 
+                    ar.a_date, 
+                    kw.name AS keyword_name, 
+                    kw.value AS keyword_value, 
+                    arkw.rank AS keyword_rank
+                FROM 
+                    keyword kw
+                    JOIN 
+                        article_keyword arkw ON kw.keyword_id = arkw.keyword_id
+                    JOIN 
+                        article ar           ON arkw.article_id = ar.article_id
+                WHERE 
+                    kw.value = :keyword
+                    AND 
+                    (:name IS NULL OR kw.name = :name)
+            )
+
+            SELECT 
+                * 
+            FROM 
+                tagged_articles
+            WHERE 
+                {articles_by_keyword_keyset.where}
+            ORDER BY 
+                {articles_by_keyword_keyset.order_by}
+            LIMIT :limit;
+            ''', merge=Merge(keyset=articles_by_keyword_keyset))
+
+@app.get(
+    "/articles_by_keyword",
+    name = "Retrieve the articles tagged with the [keyword value]. Optionally filtered by [keyword name]",
+    tags = ['Query Keywords']
+)
+async def fetch_data(
+                request: Request,
+                keyword: str,
+                name: Optional[str] = None,
+                limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                cursor: Optional[str] = None,
+                format: str = Query('json', regex='^(json|ndjson)$')
+):
+    values = {"keyword": keyword, "name": name}
+    return  await paged_response(request, queries, articles_by_keyword_keyset, values, limit, cursor, format, default_limit=100)
+
+# --------------------------------------------
+# On shards: the keyword ids are the ids of every shard, the keywords are merged by name and value
+KEYWORDS_TOP_20 = Merge(
+    keys=['keyword_name', 'keyword_value'],
+    sums=['total_articles'],
+    order_by=[('total_articles', 'DESC'), ('keyword_value', 'ASC')],
+    limit=20
+)
+
+# Visualize the keywords most used in the articles
+# authored by [author name]
+queries.register('keywords_count_by_author', '''
+            SELECT 
+                kw.name AS keyword_name, 
+                kw.value AS keyword_value, 
+                COUNT(DISTINCT arau.article_id) AS total_articles
+            FROM 
+                author au
+                JOIN 
+                    article_author arau  ON au.author_id = arau.author_id
+                JOIN 
+                    article_keyword arkw ON arau.article_id = arkw.article_id
+                JOIN 
+                    keyword kw           ON arkw.keyword_id = kw.keyword_id
+            WHERE 
+                au.author_name LIKE :author ESCAPE '\\'
+            GROUP BY 
+                kw.keyword_id
+            ORDER BY 
+                total_articles DESC, 
+                kw.value ASC
+            LIMIT 20;
+            ''', merge=KEYWORDS_TOP_20, **HEAVY_QUERY)
+
+@app.get(
+    "/keywords_count_by_author",
+    name = "Visualize the count of articles per keyword, for the articles authored by [author name]",
+    tags = ['Query Keywords']
+)
+async def fetch_data(request: Request, author: str):
+    values = {"author": like_contains(author)}
+    results = await queries.fetch_all('keywords_count_by_author', values)
+    return  rows_response(request, results)
+
+# --------------------------------------------
+# Visualize the keywords most used in the articles
+# of the [section name]
+queries.register('keywords_count_by_section', '''
+            SELECT 
+                kw.name AS keyword_name, 
+                kw.value AS keyword_value, 
+                COUNT(*) AS total_articles
+            FROM 
+                article ar
+                JOIN 
+                    article_keyword arkw ON ar.article_id = arkw.article_id
+                JOIN 
+                    keyword kw           ON arkw.keyword_id = kw.keyword_id
+            WHERE 
+                ar.section_name = :section
+            GROUP BY 
+                kw.keyword_id
             ORDER BY 
-                coauthored_articles_count DESC;         
-            '''
-    query = query.format()
-    results = await database.fetch_all(query=query)
-    return  results
+                total_articles DESC, 
+                kw.value ASC
+            LIMIT 20;
+            ''', merge=KEYWORDS_TOP_20)
+
+@app.get(
+    "/keywords_count_by_section",
+    name = "Visualize the count of articles per keyword, for the articles of the [section name]",
+    tags = ['Query Keywords']
+)
+async def fetch_data(request: Request, section: str):
+    values = {"section": section}
+    results = await queries.fetch_all('keywords_count_by_section', values)
+    return  rows_response(request, results)
 
 
 # ============================================
@@ -394,13 +1281,7 @@ async def fetch_data():
 # --------------------------------------------
 # Show the articles written by an author ordered latest first.
 # Can check the inserted one
-@app.get(
-    "/test_inserted_author",
-    name = "Show the articles written by an author ordered latest first. You can check the inserted one",
-    tags = ['Test Insert Author']        
-)
-async def test_inserted(author: str):
-    query = '''
+queries.register('test_inserted_author', '''
             SELECT 
                 ar.article_id, 
                 ar.abstract, 
@@ -415,20 +1296,93 @@ async def test_inserted(author: str):
                 JOIN
                     author au           ON arau.author_id = au.author_id
             WHERE  
-                au.author_name LIKE '%{author}%'
+                au.author_name LIKE :author ESCAPE '\\'
             ORDER BY 
                 ar.article_id DESC
             LIMIT  20;         
-          '''
-    query = query.format(author=author)
-    results = await database.fetch_all(query=query)
-    return  results
+          ''', merge=Merge(order_by=[('article_id', 'DESC')], limit=20))
+
+@app.get(
+    "/test_inserted_author",
+    name = "Show the articles written by an author ordered latest first. You can check the inserted one",
+    tags = ['Test Insert Author']        
+)
+async def test_inserted(request: Request, author: str):
+    values = {"author": like_contains(author)}
+    results = await queries.fetch_all('test_inserted_author', values)
+    return  rows_response(request, results)
 
 # --------------------------------------------
 #  INSERT
 # --------------------------------------------
+# The inserts are queued and committed in batches with the inserts of the concurrent requests,
+# in one transaction of the writer connection (see write_queue.py): the ids of the new rows are
+# the rowids returned by the inserts, never a MAX() lookup that could return the row of
+# a concurrent request. Every insert invalidates the cached results
+async def queued_write(func, *args):
+    try:
+        return await write_queue.submit(func, *args)
+    except WriteQueueFull as e:
+        raise HTTPException(status_code=503, detail=f"Too many pending inserts: {e}", headers={"Retry-After": "1"})
+
+queries.register('insert_article', '''
+            INSERT INTO article (abstract, section_name, headline_main, a_date, a_time, authors) 
+            VALUES (:abstract, :section_name, :headline_main, :a_date, :a_time, :authors)
+            ''')
+
+# An author is the same author whatever the case of its name: the inserts match the names with
+# the NOCASE collation (ASCII case-insensitive), the single insert and the bulk insert alike.
+# When several spellings are stored already (create_db.py keeps them apart), the first one stored is used
+queries.register('author_id_by_name', ''' 
+            SELECT 
+                author_id
+            FROM 
+                author 
+            WHERE 
+                author_name = :authors COLLATE NOCASE
+            ORDER BY
+                author_id
+            LIMIT 1;
+            ''', cacheable=False)
+
+# Key of an author name under the NOCASE collation, which folds the ASCII letters only
+NOCASE_FOLD = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+def author_name_key(name):
+    return name.translate(NOCASE_FOLD)
+
+queries.register('insert_author', '''
+            INSERT OR IGNORE INTO author (author_name) 
+            VALUES (:authors)
+            ''')
+
+queries.register('insert_article_author', '''
+            INSERT OR IGNORE INTO article_author (article_id, author_id) 
+            VALUES (:article_id, :author_id)
+            ''')
+
 # Insert a new article with its one author.
 # Check if the author exists or not, taking care of the DB integrity
+def insert_article_with_author(transaction, values):
+    # ====== INSERT into TABLE 'articles'
+    article_id = transaction.execute('insert_article', values)
+
+    # ======= INSERT into TABLE 'author'
+    # Search author to be inserted if exist or not in the table 'author', whatever the case of its name
+    result = transaction.fetch_all('author_id_by_name', {"authors": values['authors']})
+
+    # If the author exists, retrieve his author_id, if NOT insert it
+    if result:
+        author_id = result[0]['author_id']
+    else:
+        author_id = transaction.execute('insert_author', {"authors": values['authors']})
+
+    # ======= INSERT into TABLE 'article_author'
+    # Insert ids on composite table 'article_author'
+    transaction.execute('insert_article_author', {"article_id": article_id, "author_id": author_id})
+
+    return {"article_id": article_id, "author_id": author_id}
+
 @app.post(
     "/insert_new_article_with_new_author",
     name = "Insert a new article with a new author. Check if the author exists or not, taking care of the DB integrity",
@@ -441,98 +1395,174 @@ async def insert_article(
                 authors: str
 ):
     
-    # ====== INSERT into TABLE 'articles'
     now = datetime.now()
 
     a_date = now.strftime("%Y-%m-%d")
     a_time = now.strftime("%H:%M:%S")
     
-    query = '''
-            INSERT OR IGNORE INTO article (abstract, section_name, headline_main, a_date, a_time, authors) 
-            VALUES (:abstract, :section_name, :headline_main, :a_date, :a_time, :authors)
-            '''
     values = {"abstract": abstract,
               "section_name": section_name,
               "headline_main": headline_main,
               "a_date": a_date,
               "a_time": a_time, 
               "authors": authors }
-        
-    await database.execute(query=query, values=values)
 
-    query = '''
+    result = await queued_write(insert_article_with_author, values)
+    author_index.add_articles(result['author_id'], authors)
+    columnar_insert(
+        [(result['article_id'], section_name, 0)],
+        [(result['author_id'], authors)],
+        [(result['article_id'], result['author_id'])]
+    )
+
+    # End result
+    return  {"Status": "Inserted OK", **result}
+
+
+# --------------------------------------------
+#  BULK INSERT
+# --------------------------------------------
+# Insert a batch of articles, each one with all the authors of its byline.
+# The bylines are split in authors like create_db.py does (etl/authors.py),
+# the authors of the whole batch are resolved and inserted with set-based statements,
+# and the articles and their links are inserted in one transaction, shared with the other queued inserts
+INGEST_MAX_ARTICLES = int(os.environ.get('NYT_INGEST_MAX_ARTICLES', '10000'))
+
+queries.register('ingest_article', '''
+            INSERT INTO article (original_id, abstract, web_url, snippet, lead_paragraph, pub_date, 
+                                 document_type, news_desk, section_name, type_of_material, word_count, 
+                                 headline_main, byline_original, a_date, a_time, authors) 
+            VALUES (:original_id, :abstract, :web_url, :snippet, :lead_paragraph, :pub_date, 
+                    :document_type, :news_desk, :section_name, :type_of_material, :word_count, 
+                    :headline_main, :byline_original, :a_date, :a_time, :authors)
+            ''')
+
+# The authors are matched with the NOCASE collation, like the single insert (see author_id_by_name)
+queries.register('ingest_authors', '''
+            INSERT OR IGNORE INTO author (author_name) 
             SELECT 
-                MAX(article_id) AS max_article_id 
+                name.value 
             FROM 
-                article
-            '''
-    result = await database.fetch_all(query=query)
-    
-    last_article_id = result[0].max_article_id
-    
-    
-    # ======= INSERT into TABLE 'author'
+                json_each(:author_names) AS name
+            WHERE 
+                NOT EXISTS (SELECT 1 FROM author WHERE author.author_name = name.value COLLATE NOCASE)
+            ''')
+
+queries.register('ingest_author_ids', '''
+            SELECT 
+                name.value AS requested_name,
+                MIN(author.author_id) AS author_id, 
+                author.author_name
+            FROM 
+                json_each(:author_names) AS name
+                JOIN author ON author.author_name = name.value COLLATE NOCASE
+            GROUP BY 
+                name.value
+            ''', cacheable=False)
+
+class NewArticle(BaseModel):
+    abstract: str
+    section_name: str
+    headline_main: str
+    byline: str
+    pub_date: Optional[datetime] = None
+    original_id: Optional[str] = None
+    web_url: Optional[str] = None
+    snippet: Optional[str] = None
+    lead_paragraph: Optional[str] = None
+    document_type: Optional[str] = None
+    news_desk: Optional[str] = None
+    type_of_material: Optional[str] = None
+    word_count: int = 0
+
+def ingest_articles(transaction, articles, authors_per_article):
+    # ======= INSERT into TABLE 'author' the authors not stored yet, and retrieve the ids of all of them.
+    # The names of the batch differing only in case are one author, inserted with its first spelling
+    spellings = {}
+    for names in authors_per_article:
+        for name in names:
+            spellings.setdefault(author_name_key(name), name)
+    author_names = json.dumps(sorted(spellings.values()))
+    new_authors = transaction.execute_many('ingest_authors', [{"author_names": author_names}])
+    stored_authors = {
+        author_name_key(row['requested_name']): (row['author_id'], row['author_name'])
+        for row in transaction.fetch_all('ingest_author_ids', {"author_names": author_names})
+    }
+
+    # Ids of the authors of every article, each author once
+    article_author_ids = [
+        list(dict.fromkeys(stored_authors[author_name_key(name)][0] for name in names))
+        for names in authors_per_article
+    ]
+
+    # ====== INSERT into TABLE 'articles', the rowid of every insert is the article_id
+    article_ids = [transaction.execute('ingest_article', values) for values in articles]
 
-    # Search author to be inserted if exist or not in the table 'author'
-    query = ''' 
-                SELECT 
-                    COUNT(author_id) AS count_author_id
-                FROM 
-                    author 
-                WHERE 
-                    author_name LIKE '{authors}';
-            '''
-    query = query.format(authors=authors)
-    result = await database.fetch_all(query=query)
-    author_exits = result[0].count_author_id
-    
-    # If the author does NOT exists, insert it and then retrieve his author_id
-    author_id = ''
-    if author_exits == 0:
-        query = '''
-                    INSERT OR IGNORE INTO author (author_name) 
-                    VALUES (:authors)
-                '''
-        values = {"authors": authors}
-        
-        await database.execute(query=query, values=values)
-
-        query = '''
-                    SELECT 
-                        MAX(author_id) AS max_author_id 
-                    FROM 
-                        author
-                '''
-        result = await database.fetch_all(query=query)
-    
-        author_id = result[0].max_author_id
-    # If the author exists, retrieve his author_id
-    else:
-        query = ''' 
-                    SELECT 
-                        author_id
-                    FROM 
-                        author 
-                    WHERE 
-                        author_name LIKE '{authors}';
-                '''
-        query = query.format(authors=authors)
-        result = await database.fetch_all(query=query)
-        author_id = result[0].author_id        
-    
-    
     # ======= INSERT into TABLE 'article_author'
-    # Insert ids on composite table 'article_author'   
-    query = '''
-                INSERT OR IGNORE INTO article_author (article_id, author_id) 
-                VALUES (:article_id, :author_id)
-            '''
-    values = {
-                "article_id": last_article_id,
-                "author_id" : author_id
-             }
-        
-    await database.execute(query=query, values=values)
+    links = [
+        {"article_id": article_id, "author_id": author_id}
+        for article_id, author_ids in zip(article_ids, article_author_ids)
+        for author_id in author_ids
+    ]
+    transaction.execute_many('insert_article_author', links)
+
+    # Articles per author of the batch, for the autocomplete index
+    author_articles = {}
+    for author_ids in article_author_ids:
+        for author_id in author_ids:
+            author_articles[author_id] = author_articles.get(author_id, 0) + 1
+    author_names = {author_id: name for author_id, name in stored_authors.values()}
+
+    return {"article_ids": article_ids, "new_authors": new_authors, "article_authors": len(links),
+            "author_articles": [(author_id, author_names[author_id], count) for author_id, count in author_articles.items()],
+            "article_author_ids": article_author_ids}
+
+@app.post(
+    "/insert_articles",
+    name = "Insert a batch of articles with all the authors of their bylines, in one transaction",
+    tags = ['Test Insert Author']
+)
+async def insert_articles(articles: List[NewArticle]):
+    if len(articles) > INGEST_MAX_ARTICLES:
+        raise HTTPException(status_code=413, detail=f"More than {INGEST_MAX_ARTICLES} articles in one batch")
+
+    now = datetime.now()
+    rows = []
+    authors_per_article = []
+    for article in articles:
+        names = split_authors(article.byline)
+        pub_date = article.pub_date or now
+        rows.append({
+            "original_id": article.original_id,
+            "abstract": article.abstract,
+            "web_url": article.web_url,
+            "snippet": article.snippet,
+            "lead_paragraph": article.lead_paragraph,
+            "pub_date": pub_date.isoformat(),
+            "document_type": article.document_type,
+            "news_desk": article.news_desk,
+            "section_name": article.section_name,
+            "type_of_material": article.type_of_material,
+            "word_count": article.word_count,
+            "headline_main": article.headline_main,
+            "byline_original": article.byline,
+            "a_date": pub_date.strftime("%Y-%m-%d"),
+            "a_time": pub_date.strftime("%H:%M:%S"),
+            "authors": ', '.join(names)
+        })
+        authors_per_article.append(names)
+
+    result = await queued_write(ingest_articles, rows, authors_per_article)
+    author_articles = result.pop("author_articles")
+    article_author_ids = result.pop("article_author_ids")
+    for author_id, name, count in author_articles:
+        author_index.add_articles(author_id, name, count)
+
+    columnar_insert(
+        [(article_id, row['section_name'], row['word_count']) for article_id, row in zip(result['article_ids'], rows)],
+        [(author_id, name) for author_id, name, _ in author_articles],
+        [(article_id, author_id) for article_id, author_ids in zip(result['article_ids'], article_author_ids) for author_id in author_ids]
+    )
 
     # End result
-    return  {"Status": "Inserted OK"}
\ No newline at end of file
+    return  {"Status": "Inserted OK", "articles": len(rows), **result}
@@ -0,0 +1,269 @@
+import ast
+import json
+import base64
+import binascii
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+# api_common is importable from the parent directory, see main.py
+from api_common.responses import dumps_json, rows_response, NDJSON_MEDIA_TYPE
+from api_common.request_metrics import add_rows, serialization_timer
+
+# Keyset pagination and NDJSON streaming of the list endpoints.
+# A page is read with 'WHERE <sort key> after <last row of the previous page> ORDER BY <sort key> LIMIT n':
+# the page costs the same at any depth and the API never holds more than one page in memory.
+# The position is returned to the client as an opaque continuation token in the header X-Next-Cursor,
+# and sent back with the query parameter 'cursor'.
+# With format=ndjson the rows are streamed one JSON object per line, from the cursor to the end
+# (or 'limit' rows), while they are read from the database.
+# The rows computed in memory (see columnar.py) are paged the same way by paged_rows_response().
+
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+STREAM_BATCH_SIZE = 500
+
+
+class Keyset:
+    """
+    Sort key of a paginated query, used to build its SQL and its continuation tokens
+    """
+
+    def __init__(self, name, columns):
+        """
+        :param name: name of the query, stored in the tokens to reject the tokens of another query
+        :param columns: list of (output column, 'ASC' or 'DESC', SQL value sorting its NULLs or None), unique together
+        """
+
+        self.name = name
+        self.columns = columns
+
+    def _expression(self, column, null_value, param):
+        if null_value is None:
+            return column, param
+        return f'IFNULL({column}, {null_value})', f'IFNULL({param}, {null_value})'
+
+    @property
+    def where(self):
+        """
+        SQL condition selecting the rows after the cursor, bound parameters :has_cursor, :after_0, :after_1, ...
+        """
+
+        conditions = []
+        for position, (column, direction, null_value) in enumerate(self.columns):
+            terms = []
+            for previous, (previous_column, _, previous_null) in enumerate(self.columns[:position]):
+                expression, param = self._expression(previous_column, previous_null, f':after_{previous}')
+                terms.append(f'{expression} = {param}')
+            expression, param = self._expression(column, null_value, f':after_{position}')
+            terms.append(f"{expression} {'<' if direction == 'DESC' else '>'} {param}")
+            conditions.append('(' + ' AND '.join(terms) + ')')
+        return '(:has_cursor = 0 OR ' + ' OR '.join(conditions) + ')'
+
+    @property
+    def order_by(self):
+        """
+        SQL ORDER BY clause of the sort key
+        """
+
+        return ', '.join(
+            f'{self._expression(column, null_value, "")[0]} {direction}'
+            for column, direction, null_value in self.columns
+        )
+
+    def encode(self, row):
+        """
+        Continuation token of the page following the row
+        :param row: last row of the page, as a dict
+        """
+
+        payload = {'q': self.name, 'k': [row[column] for column, _, _ in self.columns]}
+        return base64.urlsafe_b64encode(json.dumps(payload, separators=(',', ':')).encode()).decode().rstrip('=')
+
+    def decode(self, cursor):
+        """
+        Sort key values of a continuation token
+        :param cursor: continuation token from X-Next-Cursor
+        """
+
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+            keys = payload['k']
+            if payload['q'] != self.name or len(keys) != len(self.columns):
+                raise ValueError
+        except (ValueError, KeyError, TypeError, binascii.Error):
+            raise HTTPException(status_code=400, detail='Invalid cursor')
+        return keys
+
+    def bind(self, cursor=None):
+        """
+        Bound parameters of the cursor
+        :param cursor: continuation token from X-Next-Cursor, None for the first page
+        """
+
+        values = {f'after_{position}': None for position in range(len(self.columns))}
+        if not cursor:
+            return {'has_cursor': 0, **values}
+
+        values.update({f'after_{position}': key for position, key in enumerate(self.decode(cursor))})
+        return {'has_cursor': 1, **values}
+
+    def sort(self, rows):
+        """
+        Sort rows in the order of the keyset, like its ORDER BY
+        :param rows: list of dicts, sorted in place
+        """
+
+        for column, direction, null_value in reversed(self.columns):
+            if null_value is None:
+                key = lambda row: (row[column] is not None, row[column])
+            else:
+                null = ast.literal_eval(null_value)
+                key = lambda row: null if row[column] is None else row[column]
+            rows.sort(key=key, reverse=direction == 'DESC')
+
+    def follows(self, row, keys):
+        """
+        True when the row comes after the sort key values in the order of the keyset, like the SQL condition
+        :param row: row as a dict
+        :param keys: sort key values of a cursor
+        """
+
+        for (column, direction, null_value), key in zip(self.columns, keys):
+            value = row[column]
+            if null_value is not None:
+                # The SQL values sorting the NULLs are literals: '' or 0
+                null = ast.literal_eval(null_value)
+                value = null if value is None else value
+                key = null if key is None else key
+            if value != key:
+                return value < key if direction == 'DESC' else value > key
+        return False
+
+    def position(self, rows, cursor=None):
+        """
+        Index of the first row after the cursor, by binary search
+        :param rows: list of dicts sorted in the order of the keyset
+        :param cursor: continuation token from X-Next-Cursor, None for the first page
+        """
+
+        if not cursor:
+            return 0
+        keys = self.decode(cursor)
+        low, high = 0, len(rows)
+        while low < high:
+            middle = (low + high) // 2
+            if self.follows(rows[middle], keys):
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+
+async def ndjson_lines(batches):
+    """
+    NDJSON lines of the batches of rows
+    :param batches: async iterator of lists of rows
+    """
+
+    async for rows in batches:
+        add_rows(len(rows))
+        with serialization_timer():
+            lines = b''.join(dumps_json(row) + b'\n' for row in rows)
+        yield lines
+
+
+async def prefetch(batches):
+    """
+    Read the first batch at once: the errors of the query execution (e.g. QueryTimeout) are raised
+    before the response starts, and answered with their status code
+    :param batches: async iterator of lists of rows
+    """
+
+    first = await anext(batches, None)
+
+    async def chained():
+        if first is not None:
+            yield first
+        async for rows in batches:
+            yield rows
+
+    return chained()
+
+
+async def row_batches(rows):
+    """
+    Rows in lists of STREAM_BATCH_SIZE, as an async iterator
+    :param rows: list of rows
+    """
+
+    for start in range(0, len(rows), STREAM_BATCH_SIZE):
+        yield rows[start:start + STREAM_BATCH_SIZE]
+
+
+def page_response(request, keyset, rows, limit):
+    """
+    Response of one page, with X-Next-Cursor when more rows follow
+    :param request: request of the endpoint
+    :param keyset: Keyset of the query
+    :param rows: rows of the page and at most one more
+    :param limit: rows of the page
+    """
+
+    headers = {}
+    if len(rows) > limit:
+        rows = rows[:limit]
+        headers['X-Next-Cursor'] = keyset.encode(rows[-1])
+    return rows_response(request, rows, headers)
+
+
+async def paged_response(request, queries, keyset, values, limit=None, cursor=None, format='json',
+                         default_limit=DEFAULT_PAGE_SIZE):
+    """
+    Response of a paginated endpoint: one page in the format requested by the 'Accept' header
+    (see api_common/responses.py), or the rows streamed as NDJSON
+    :param request: request of the endpoint
+    :param queries: QueryRegistry
+    :param keyset: Keyset of the query, its name is the name of the registered query
+    :param values: dict of bound parameters of the query, without the pagination parameters
+    :param limit: rows of the page, default_limit by default. With NDJSON: no limit by default
+    :param cursor: continuation token of the page
+    :param format: 'json' or 'ndjson'
+    :param default_limit: rows of the page when limit is not given
+    """
+
+    values = {**values, **keyset.bind(cursor)}
+
+    if format == 'ndjson':
+        # LIMIT -1: no limit in SQLite
+        values['limit'] = limit or -1
+        batches = await prefetch(queries.stream(keyset.name, values, STREAM_BATCH_SIZE))
+        return StreamingResponse(ndjson_lines(batches), media_type=NDJSON_MEDIA_TYPE)
+
+    limit = limit or default_limit
+    # One more row tells if there is a next page
+    values['limit'] = limit + 1
+    rows = await queries.fetch_all(keyset.name, values)
+    return page_response(request, keyset, rows, limit)
+
+
+def paged_rows_response(request, keyset, rows, limit=None, cursor=None, format='json', default_limit=DEFAULT_PAGE_SIZE):
+    """
+    Response of a paginated endpoint whose rows are already in memory, like paged_response()
+    :param request: request of the endpoint
+    :param keyset: Keyset of the query
+    :param rows: all the rows of the query, sorted in the order of the keyset
+    :param limit: rows of the page, default_limit by default. With NDJSON: no limit by default
+    :param cursor: continuation token of the page
+    :param format: 'json' or 'ndjson'
+    :param default_limit: rows of the page when limit is not given
+    """
+
+    start = keyset.position(rows, cursor)
+
+    if format == 'ndjson':
+        end = start + limit if limit else len(rows)
+        return StreamingResponse(ndjson_lines(row_batches(rows[start:end])), media_type=NDJSON_MEDIA_TYPE)
+
+    limit = limit or default_limit
+    return page_response(request, keyset, rows[start:start + limit + 1], limit)
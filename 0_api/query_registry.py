@@ -0,0 +1,655 @@
+import os
+import time
+import hashlib
+import asyncio
+from contextlib import contextmanager
+
+from sqlite_pool import SQLitePool, QueryTimeout
+from sharded_pool import ShardedPool, Merge, without_limit
+
+# etl and api_common are importable from the parent directory, see main.py
+from etl.shards import is_sharded, MANIFEST_NAME
+from api_common.request_metrics import add_db_time, current_path
+
+# Central registry of the SQL statements of the API.
+# Every statement is registered once with a name and fixed SQL text, user input is only passed
+# as bound parameters (:name), never spliced into the SQL. As the SQL text of one statement never
+# changes, the statement cache of the connections (sqlite3 'cached_statements') keeps it prepared:
+# a repeated query is neither parsed nor planned again.
+# SELECTs run on the read connections of a SQLitePool, writes on its writer connection.
+# With a ResultCache, the results of the cached SELECTs are served from memory until the next
+# write: through execute(), by another process (e.g. another uvicorn worker) or by replacing
+# the database file (e.g. create_db ran again).
+# Every SELECT has a time budget, enforced inside SQLite (QueryTimeout), and the expensive ones a maximum
+# number of concurrent executions: beyond it they are rejected at once (QueryRejected) instead of
+# taking the read connections of the short lookups.
+# The database can be a single file or a directory of time shards (see sharded_pool.py): on the shards,
+# a SELECT runs its shard SQL on every shard and the partial results are merged by its Merge.
+# create_db publishes a new database as a new snapshot file (see etl/snapshots.py): the registry opens
+# and warms a pool on it beside the old one, sends the new statements to it, drains the old pool and closes it.
+# The requests never wait for the switch.
+# The time of every statement is added to the DB time of its request (see api_common/request_metrics.py),
+# and with a SlowQueryLog a statement slower than its threshold is logged with its bound parameters
+# and its EXPLAIN QUERY PLAN, read after the statement on the same database.
+# content_version() identifies the content of the open database for the ETags of the API: its snapshot
+# and the user_version incremented by every write (see sqlite_pool.py). It changes with the version
+# of the result cache, so a response is never served with the ETag of newer data.
+
+
+def escape_like(text):
+    """
+    Escape the LIKE wildcards of a user string, to be used with ESCAPE '\\'
+    :param text: user string
+    """
+
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def like_contains(text):
+    """
+    LIKE pattern matching the values that contain the user string
+    :param text: user string
+    """
+
+    return f'%{escape_like(text)}%'
+
+
+def query_plan(rows):
+    """
+    Lines of an EXPLAIN QUERY PLAN, indented like the tree of the sqlite3 shell
+    :param rows: rows of the EXPLAIN QUERY PLAN, dicts or tuples (id, parent, notused, detail)
+    """
+
+    depth = {0: -1}
+    lines = []
+    for row in rows:
+        node_id, parent, _, detail = row.values() if isinstance(row, dict) else row
+        depth[node_id] = depth.get(parent, -1) + 1
+        lines.append('  ' * depth[node_id] + detail)
+    return lines
+
+
+def file_signature(path):
+    """
+    Identity of a file that changes when it is replaced: device and inode.
+    While the database is open its inode cannot be reused by a new file
+    :param path: path of the file
+    """
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_dev, stat.st_ino)
+
+
+class QueryRejected(Exception):
+    """
+    A SELECT already runs its maximum number of concurrent executions
+    """
+
+
+class QueryRegistry:
+    """
+    Named parameterized SQL statements, executed on a pool of long-lived SQLite connections
+    with per-query call counts and timings, and optionally a cache of their results
+    """
+
+    def __init__(self, cache=None, reload_check_s=2.0, default_timeout_s=None, drain_timeout_s=None, prefetch_tables=(),
+                 slow_log=None):
+        """
+        :param cache: ResultCache of the SELECT results, None for no cache
+        :param reload_check_s: seconds between two checks of the database for changes made by other processes
+        :param default_timeout_s: time budget of the SELECTs registered without one, None for no budget
+        :param drain_timeout_s: maximum wait of the calls in progress on the old snapshot after a switch,
+                                None for no limit
+        :param prefetch_tables: tables read into memory with their indexes by prefetch(), and before a switch
+                                to a new snapshot
+        :param slow_log: SlowQueryLog of the statements over its threshold, see api_common/request_metrics.py
+        """
+
+        self.queries = {}
+        self.cacheable = {}
+        self.default_timeout_s = default_timeout_s
+        self.timeouts = {}
+        self.max_concurrent = {}
+        self.running = {}
+        self.shard_queries = {}
+        self.merges = {}
+        self.date_ranges = {}
+        self.directory_only = {}
+        self.sharded = False
+        self.stats = {}
+        self.pool = None
+        self.pool_options = {}
+        self.cache = cache
+        self.reload_check_s = reload_check_s
+        self.db_path = None
+        self.db_signature = None
+        self.snapshot_path = None
+        self.data_version = None
+        self.drain_timeout_s = drain_timeout_s
+        self.swap_task = None
+        self.swaps = 0
+        self.prefetch_tables = list(prefetch_tables)
+        self.last_reload_check = 0.0
+        self.reload_lock = asyncio.Lock()
+        self.change_listeners = []
+        self.slow_log = slow_log
+        self.user_version = None
+        self.foreign_writes = 0
+        self.slow_log_tasks = set()
+
+    def register(self, name, sql, cacheable=True, timeout_s=None, max_concurrent=None,
+                 shard_sql=None, merge=None, date_range=None, directory_only=False):
+        """
+        Register one statement. Returns its name
+        :param name: unique name of the statement
+        :param sql: SQL text with named parameters, e.g. 'SELECT * FROM author WHERE author_id = :author_id'
+        :param cacheable: the result of the SELECT can be served from the result cache
+        :param timeout_s: time budget of the SELECT in seconds, None for default_timeout_s, 0 for no budget
+        :param max_concurrent: maximum number of concurrent executions of the SELECT, None for no limit
+        :param shard_sql: SQL run on every shard when it differs from sql, e.g. partial aggregates.
+                          By default sql, without its final LIMIT when the merge groups the rows
+        :param merge: Merge of the rows of the shards, by default their concatenation
+        :param date_range: function of the bound parameters returning the (first date, last date) of the
+                           articles read, or None for all. Only these shards are read
+        :param directory_only: the SELECT reads only the author directory, on one shard
+        """
+
+        if name in self.queries:
+            raise ValueError(f"Query '{name}' is already registered")
+        self.queries[name] = sql
+        self.cacheable[name] = cacheable
+        self.timeouts[name] = self.default_timeout_s if timeout_s is None else timeout_s
+        self.max_concurrent[name] = max_concurrent
+        self.running[name] = 0
+        self.merges[name] = merge or Merge()
+        if shard_sql is None:
+            shard_sql = without_limit(sql) if getattr(self.merges[name], 'grouped', False) else sql
+        self.shard_queries[name] = shard_sql
+        self.date_ranges[name] = date_range
+        self.directory_only[name] = directory_only
+        self.stats[name] = self._new_stats()
+        return name
+
+    @staticmethod
+    def _new_stats():
+        return {'calls': 0, 'errors': 0, 'cache_hits': 0, 'timeouts': 0, 'rejected': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+
+    async def connect(self, db_path, **pool_options):
+        """
+        Open the connection pool, with statement caches big enough to keep every registered statement prepared
+        :param db_path: SQLite database file, or directory of shards
+        :param pool_options: options of SQLitePool, e.g. readers=8
+        """
+
+        self.db_path = db_path
+        self.pool_options = pool_options
+        self._use(*await self._open_pool())
+
+    async def _open_pool(self, prefetch=False):
+        # Open and warm a pool on the database published at db_path, returns it with its state
+        sharded = is_sharded(self.db_path)
+        # The manifest of the shards is replaced when a shard is rebuilt
+        signature_path = os.path.join(self.db_path, MANIFEST_NAME) if sharded else self.db_path
+        signature = file_signature(signature_path)
+        # The snapshot the published path points to, see etl/snapshots.py
+        snapshot_path = os.path.realpath(self.db_path)
+        pool_class = ShardedPool if sharded else SQLitePool
+        pool = pool_class(snapshot_path, cached_statements=max(128, 2 * len(self.queries)), **self.pool_options)
+        await pool.open()
+        try:
+            await pool.warm()
+            if prefetch:
+                await pool.prefetch(self.prefetch_tables)
+            data_version = await pool.data_version()
+        except BaseException:
+            await pool.close()
+            raise
+        return pool, sharded, signature_path, signature, snapshot_path, data_version
+
+    def _use(self, pool, sharded, signature_path, signature, snapshot_path, data_version):
+        # Send the new statements to the pool
+        self.pool = pool
+        self.sharded = sharded
+        self.signature_path = signature_path
+        self.db_signature = signature
+        self.snapshot_path = snapshot_path
+        self.data_version = data_version
+        self.user_version = pool.user_version
+        self.last_reload_check = time.monotonic()
+
+    async def prefetch(self):
+        """
+        Read the prefetch tables and their indexes into memory, see SQLitePool.prefetch().
+        Returns the number of b-trees read
+        """
+
+        await self._wait_pool()
+        return await self.pool.prefetch(self.prefetch_tables)
+
+    async def disconnect(self):
+        """
+        Close the connection pool
+        """
+
+        if self.swap_task is not None:
+            await asyncio.gather(self.swap_task, return_exceptions=True)
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    def invalidate(self):
+        """
+        Bump the database version: the cached results are not served anymore
+        """
+
+        if self.cache is not None:
+            self.cache.bump_version()
+        if self.pool is not None:
+            self.user_version = self.pool.user_version
+
+    def content_version(self):
+        """
+        Version of the content of the open database, the same in every process: changes with a new snapshot
+        and with every write. None while no database is open
+        """
+
+        if self.pool is None:
+            return None
+        version = f'{self.pool.snapshot_id}:{self.user_version}:{self.foreign_writes}'
+        return hashlib.blake2b(version.encode(), digest_size=8).hexdigest()
+
+    async def swap(self):
+        """
+        Switch to the snapshot published in place of the open one, without stopping: the pool of the new
+        snapshot is opened and warmed, its prefetch tables read, while the old one serves, the new statements go to the new pool,
+        then the old pool is drained and closed. The cached results are invalidated
+        """
+
+        async with self.reload_lock:
+            old_pool = self.pool
+            try:
+                self._use(*await self._open_pool(prefetch=True))
+            except Exception as e:
+                # The old snapshot keeps serving, the switch is tried again at the next check
+                print(f">>> The new snapshot of {self.db_path} could not be opened : {e}")
+                return
+            self.invalidate()
+            self.swaps += 1
+        print(f"Database {self.db_path} switched to {self.snapshot_path}")
+        await self.notify_change(swapped=True)
+        if old_pool is not None:
+            await old_pool.drain(self.drain_timeout_s)
+            await old_pool.close()
+
+    def published_snapshot(self):
+        """
+        True when a new snapshot was published at db_path, a file other than the one open: its pool can be
+        opened beside the old one. The shards of a new manifest are new snapshot files
+        """
+
+        return self.sharded or os.path.realpath(self.db_path) != self.snapshot_path
+
+    async def reload(self):
+        """
+        Reopen the database file replaced in place and invalidate the cached results.
+        The old pool is drained, like in swap(), then closed first: the WAL of the old file is checkpointed
+        and removed, it is never replayed into the new file. The statements arriving meanwhile wait for the new pool
+        """
+
+        async with self.reload_lock:
+            old_pool, self.pool = self.pool, None
+            if old_pool is not None:
+                await old_pool.drain(self.drain_timeout_s)
+                await old_pool.close()
+            await self.connect(self.db_path, **self.pool_options)
+            self.invalidate()
+        print(f"Database {self.db_path} reloaded")
+        await self.notify_change()
+
+    async def check_reload(self):
+        """
+        Reload the database when its file was replaced, and invalidate the cached results when
+        another process wrote to it. Checked at most every reload_check_s seconds
+        """
+
+        now = time.monotonic()
+        if self.pool is None or now - self.last_reload_check < self.reload_check_s:
+            return
+        if self.swap_task is not None and not self.swap_task.done():
+            return
+        self.last_reload_check = now
+        signature = file_signature(self.signature_path)
+        if signature is not None and signature != self.db_signature:
+            if self.published_snapshot():
+                # In the background: this request and the next ones are served by the old snapshot meanwhile
+                self.swap_task = asyncio.create_task(self.swap())
+            else:
+                await self.reload()
+            return
+        data_version = await self.pool.data_version()
+        if data_version != self.data_version:
+            self.data_version = data_version
+            if self.pool.user_version == self.user_version:
+                # Written by a process that does not increment user_version, e.g. the sqlite3 shell:
+                # only this process knows it, its content version differs from the other processes
+                self.foreign_writes += 1
+            self.invalidate()
+            await self.notify_change()
+
+    async def notify_change(self, swapped=False):
+        """
+        Call the change listeners, async functions kept in memory from the database (e.g. an index),
+        after the database was reloaded or written by another process. They receive swapped
+        :param swapped: the database was switched to a new snapshot, see swap()
+        """
+
+        for listener in self.change_listeners:
+            await listener(swapped)
+
+    def record(self, name, start, failed=False):
+        """
+        Add one call to the statistics of a statement or transaction. Returns its duration in ms
+        :param name: name of the statement or transaction
+        :param start: time.perf_counter() at the start of the call
+        :param failed: the call raised an exception
+        """
+
+        stats = self.stats.setdefault(name, self._new_stats())
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        stats['calls'] += 1
+        stats['errors'] += int(failed)
+        stats['total_ms'] += elapsed_ms
+        stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+        return elapsed_ms
+
+    def is_slow(self, elapsed_ms):
+        """
+        True when a statement of this duration goes to the slow-query log
+        :param elapsed_ms: duration of the statement
+        """
+
+        return self.slow_log is not None and self.slow_log.is_slow(elapsed_ms)
+
+    def log_slow(self, name, values, elapsed_ms):
+        """
+        Log a slow statement with its EXPLAIN QUERY PLAN, read in the background: the request does not wait for it
+        :param name: name of the statement
+        :param values: dict of bound parameters
+        :param elapsed_ms: duration of the statement
+        """
+
+        task = asyncio.create_task(self._log_slow(name, values, elapsed_ms, current_path()))
+        self.slow_log_tasks.add(task)
+        task.add_done_callback(self.slow_log_tasks.discard)
+
+    async def _log_slow(self, name, values, elapsed_ms, path):
+        # On shards, the plan of the shard SQL on the write shard: the shards have the same schema
+        sql = self.queries[name]
+        if self.sharded and not self.directory_only[name]:
+            sql = self.shard_queries[name]
+        try:
+            plan = query_plan(await self.pool.read('EXPLAIN QUERY PLAN ' + sql, values))
+        except Exception as e:
+            plan = [f'{type(e).__name__}: {e}']
+        self.slow_log.log(name, sql, values, elapsed_ms, plan, path)
+
+    async def _wait_pool(self):
+        if self.pool is None:
+            async with self.reload_lock:
+                pass
+
+    @contextmanager
+    def _limits(self, name):
+        # Concurrency limit and timeout counter of a SELECT
+        max_concurrent = self.max_concurrent[name]
+        if max_concurrent is not None and self.running[name] >= max_concurrent:
+            self.stats[name]['rejected'] += 1
+            raise QueryRejected(f"Query '{name}' already runs {max_concurrent} times, retry later")
+        self.running[name] += 1
+        try:
+            yield
+        except QueryTimeout:
+            self.stats[name]['timeouts'] += 1
+            raise
+        finally:
+            self.running[name] -= 1
+
+    async def _read(self, name, values):
+        # Rows of a SELECT, from every shard it reads when the database is sharded
+        if not self.sharded or self.directory_only[name]:
+            return await self.pool.read(self.queries[name], values, self.timeouts[name])
+        date_range = self.date_ranges[name]
+        partials = await self.pool.read_shards(
+            self.shard_queries[name], values, self.timeouts[name], date_range(values or {}) if date_range else None
+        )
+        return self.merges[name](partials, values or {})
+
+    async def _run(self, name, values, fetch):
+        await self._wait_pool()
+        sql = self.queries[name]
+        start = time.perf_counter()
+        failed = True
+        try:
+            if fetch:
+                with self._limits(name):
+                    result = await self._read(name, values)
+            else:
+                result = await self.pool.write(sql, values)
+            failed = False
+            return result
+        finally:
+            elapsed_ms = self.record(name, start, failed)
+            add_db_time(elapsed_ms)
+            if self.is_slow(elapsed_ms):
+                self.log_slow(name, values, elapsed_ms)
+
+    async def fetch_all(self, name, values=None):
+        """
+        Run a registered SELECT and return its rows as dicts, from the result cache when possible.
+        Raises QueryTimeout when its time budget is spent, QueryRejected beyond its concurrency limit
+        :param name: name of the statement
+        :param values: dict of bound parameters
+        """
+
+        await self.check_reload()
+        if self.cache is None or not self.cache.enabled or not self.cacheable[name]:
+            return await self._run(name, values, fetch=True)
+
+        key = self.cache.key(name, values)
+        result = self.cache.get(key)
+        if result is not None:
+            self.stats[name]['cache_hits'] += 1
+            return result
+
+        version = self.cache.version
+        result = await self._run(name, values, fetch=True)
+        self.cache.set(key, result, version)
+        return result
+
+    async def stream(self, name, values=None, batch_size=500):
+        """
+        Run a registered SELECT and yield its rows in lists of batch_size dicts while they are read.
+        On shards, the rows are merged before the first batch. Never served from the result cache.
+        Raises QueryTimeout and QueryRejected like fetch_all()
+        :param name: name of the statement
+        :param values: dict of bound parameters
+        :param batch_size: rows of every batch
+        """
+
+        await self.check_reload()
+        await self._wait_pool()
+        start = time.perf_counter()
+        # Time reading the rows, without the time the client takes to receive the batches
+        db_ms = 0.0
+        failed = True
+        try:
+            with self._limits(name):
+                if self.sharded:
+                    rows = await self._read(name, values)
+                    db_ms = (time.perf_counter() - start) * 1000
+                    add_db_time(db_ms)
+                    for position in range(0, len(rows), batch_size):
+                        yield rows[position:position + batch_size]
+                else:
+                    batches = self.pool.stream(self.queries[name], values, batch_size, self.timeouts[name])
+                    try:
+                        while True:
+                            batch_start = time.perf_counter()
+                            rows = await anext(batches, None)
+                            batch_ms = (time.perf_counter() - batch_start) * 1000
+                            db_ms += batch_ms
+                            add_db_time(batch_ms)
+                            if rows is None:
+                                break
+                            yield rows
+                    finally:
+                        await batches.aclose()
+            failed = False
+        finally:
+            self.record(name, start, failed)
+            if self.is_slow(db_ms):
+                self.log_slow(name, values, db_ms)
+
+    async def execute(self, name, values=None):
+        """
+        Run a registered INSERT/UPDATE/DELETE and return the rowid of the last inserted row.
+        The cached results are invalidated
+        :param name: name of the statement
+        :param values: dict of bound parameters
+        """
+
+        try:
+            return await self._run(name, values, fetch=False)
+        finally:
+            self.invalidate()
+
+    async def transaction(self, name, func, *args):
+        """
+        Run func(transaction, *args) in one transaction of the writer connection, in the writer thread.
+        Committed when func returns, rolled back when it raises. Returns the result of func.
+        The cached results are invalidated
+        :param name: name of the transaction in the statistics
+        :param func: function running registered statements with the Transaction it receives
+        :param args: arguments of func
+        """
+
+        await self._wait_pool()
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = await self.pool.transaction(lambda connection: func(Transaction(self, connection), *args))
+            failed = False
+            return result
+        finally:
+            add_db_time(self.record(name, start, failed))
+            self.invalidate()
+
+    def statistics(self):
+        """
+        Call counts and timings of every registered statement, most time consuming first
+        """
+
+        rows = []
+        for name, stats in self.stats.items():
+            rows.append({
+                'query': name,
+                'calls': stats['calls'],
+                'errors': stats['errors'],
+                'cache_hits': stats['cache_hits'],
+                'timeouts': stats['timeouts'],
+                'rejected': stats['rejected'],
+                'total_ms': round(stats['total_ms'], 3),
+                'mean_ms': round(stats['total_ms'] / stats['calls'], 3) if stats['calls'] else None,
+                'max_ms': round(stats['max_ms'], 3)
+            })
+        return sorted(rows, key=lambda row: row['total_ms'], reverse=True)
+
+
+class Transaction:
+    """
+    Registered statements run on the writer connection inside QueryRegistry.transaction(),
+    called from the writer thread
+    """
+
+    def __init__(self, registry, connection):
+        self.registry = registry
+        self.connection = connection
+
+    def _record(self, name, start, failed, values):
+        # Statistics of a statement, and its EXPLAIN QUERY PLAN on the writer connection when it is slow
+        elapsed_ms = self.registry.record(name, start, failed)
+        if self.registry.is_slow(elapsed_ms):
+            sql = self.registry.queries[name]
+            try:
+                plan = query_plan(self.connection.execute('EXPLAIN QUERY PLAN ' + sql, values or {}).fetchall())
+            except Exception as e:
+                plan = [f'{type(e).__name__}: {e}']
+            self.registry.slow_log.log(name, sql, values, elapsed_ms, plan)
+
+    @contextmanager
+    def savepoint(self):
+        """
+        Run the statements of the 'with' block in a savepoint: rolled back alone when the block raises
+        """
+
+        self.connection.execute('SAVEPOINT write')
+        try:
+            yield
+        except BaseException:
+            self.connection.execute('ROLLBACK TO write')
+            self.connection.execute('RELEASE write')
+            raise
+        self.connection.execute('RELEASE write')
+
+    def fetch_all(self, name, values=None):
+        """
+        Run a registered SELECT and return its rows as dicts
+        :param name: name of the statement
+        :param values: dict of bound parameters
+        """
+
+        start = time.perf_counter()
+        failed = True
+        try:
+            cursor = self.connection.execute(self.registry.queries[name], values or {})
+            rows = [dict(row) for row in cursor.fetchall()]
+            failed = False
+            return rows
+        finally:
+            self._record(name, start, failed, values)
+
+    def execute(self, name, values=None):
+        """
+        Run a registered INSERT/UPDATE/DELETE and return the rowid of the last inserted row
+        :param name: name of the statement
+        :param values: dict of bound parameters
+        """
+
+        start = time.perf_counter()
+        failed = True
+        try:
+            lastrowid = self.connection.execute(self.registry.queries[name], values or {}).lastrowid
+            failed = False
+            return lastrowid
+        finally:
+            self._record(name, start, failed, values)
+
+    def execute_many(self, name, values_list):
+        """
+        Run a registered INSERT/UPDATE/DELETE once per set of parameters and return the number of rows changed
+        :param name: name of the statement
+        :param values_list: list of dicts of bound parameters
+        """
+
+        start = time.perf_counter()
+        failed = True
+        try:
+            rowcount = self.connection.executemany(self.registry.queries[name], values_list).rowcount
+            failed = False
+            return rowcount
+        finally:
+            # Logged with its first set of parameters
+            self._record(name, start, failed, values_list[0] if values_list else None)
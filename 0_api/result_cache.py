@@ -0,0 +1,107 @@
+import time
+from collections import OrderedDict
+
+# In-process cache of the query results of the API.
+# Entries are keyed by query name and bound parameters, bounded in number (LRU) and optionally
+# expire after a TTL. Every entry is stored with the database version it was read from: a write
+# through the API or a reload of the database file bumps the version, and the entries of older
+# versions are never served again.
+
+
+class ResultCache:
+    """
+    Size-bounded LRU cache of query results, with optional TTL and invalidation by database version
+    """
+
+    def __init__(self, max_entries=1024, ttl_s=0):
+        """
+        :param max_entries: maximum number of cached results, 0 disables the cache
+        :param ttl_s: seconds an entry is served, 0 for no expiry
+        """
+
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.version = 0
+        self.entries = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    @staticmethod
+    def key(name, values=None):
+        """
+        Cache key of one query: its name and its bound parameters sorted by name
+        :param name: name of the query
+        :param values: dict of bound parameters
+        """
+
+        return (name, tuple(sorted((values or {}).items())))
+
+    def get(self, key):
+        """
+        Cached result of the key, None on a miss
+        :param key: key built by ResultCache.key()
+        """
+
+        entry = self.entries.get(key)
+        if entry is None:
+            self.stats['misses'] += 1
+            return None
+
+        version, expires_at, result = entry
+        if version != self.version or (expires_at is not None and time.monotonic() >= expires_at):
+            if version == self.version:
+                self.stats['expirations'] += 1
+            del self.entries[key]
+            self.stats['misses'] += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.stats['hits'] += 1
+        return result
+
+    def set(self, key, result, version):
+        """
+        Store a result, evicting the least recently used entries above max_entries
+        :param key: key built by ResultCache.key()
+        :param result: result of the query
+        :param version: database version read before running the query
+        """
+
+        # The database changed while the query was running: the result may already be stale
+        if version != self.version:
+            return
+
+        expires_at = time.monotonic() + self.ttl_s if self.ttl_s else None
+        self.entries[key] = (version, expires_at, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def bump_version(self):
+        """
+        Invalidate every cached result, after a write or a reload of the database
+        """
+
+        self.version += 1
+        self.entries.clear()
+        self.stats['invalidations'] += 1
+
+    def statistics(self):
+        """
+        Hit and miss counters of the cache
+        """
+
+        lookups = self.stats['hits'] + self.stats['misses']
+        return {
+            'enabled': self.enabled,
+            'db_version': self.version,
+            'entries': len(self.entries),
+            'max_entries': self.max_entries,
+            'ttl_s': self.ttl_s,
+            **self.stats,
+            'hit_ratio': round(self.stats['hits'] / lookups, 4) if lookups else None
+        }
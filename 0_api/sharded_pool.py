@@ -0,0 +1,290 @@
+import os
+import re
+import asyncio
+
+from sqlite_pool import SQLitePool
+
+# etl is importable from the parent directory, see main.py
+from etl.shards import read_manifest, MANIFEST_NAME
+
+# Storage layer of the API over a time-sharded database, see etl/shards.py.
+# Every shard has its own SQLitePool, and the author directory is attached to all their connections
+# as the schema 'directory': the SQL written for the single database runs unchanged on every shard.
+# A SELECT is fanned out in parallel to the shards, only to the shards holding the dates it asks for
+# when it has a date range, and the partial results of the shards are merged (see Merge).
+# The writes go to the shard of the latest period, the write shard. As its articles can have any date,
+# the write shard is read by every SELECT.
+
+LIMIT_CLAUSE = re.compile(r'\s+LIMIT\s+\d+\s*;?\s*$', re.IGNORECASE)
+
+
+def without_limit(sql):
+    """
+    SQL of a SELECT without its final LIMIT, e.g. 'LIMIT 20;'
+    :param sql: SQL text
+    """
+
+    return LIMIT_CLAUSE.sub('', sql)
+
+
+def sort_rows(rows, order_by):
+    """
+    Sort rows like an SQL ORDER BY, the NULLs first in ascending order like SQLite
+    :param rows: list of dicts, sorted in place
+    :param order_by: list of (column, 'ASC' or 'DESC')
+    """
+
+    for column, direction in reversed(order_by):
+        rows.sort(key=lambda row: (row[column] is not None, row[column]), reverse=direction == 'DESC')
+
+
+def best_of_group(group_column, value_column):
+    """
+    Filter of the merged rows keeping the row whose value is greater than the values of all the other rows
+    of its group, like the SQL "self join ON value <= value HAVING COUNT(*) <= 1": no row for a tie,
+    the NULL groups and values do not take part
+    :param group_column: column of the group, e.g. 'section_name'
+    :param value_column: column of the value, e.g. 'article_count'
+    """
+
+    def having(rows):
+        best = {}
+        for row in rows:
+            group, value = row[group_column], row[value_column]
+            if group is None or value is None:
+                continue
+            if group not in best or value > best[group][0]:
+                best[group] = (value, row, 1)
+            elif value == best[group][0]:
+                best[group] = (value, row, best[group][2] + 1)
+        return [row for _, row, count in best.values() if count == 1]
+
+    return having
+
+
+def top_of_group(group_column, order_by, limit):
+    """
+    Filter of the merged rows keeping the first rows of every group in an order, like the SQL
+    "ROW_NUMBER() OVER (PARTITION BY group ORDER BY ...) <= limit"
+    :param group_column: column of the group, e.g. 'position'
+    :param order_by: list of (column, 'ASC' or 'DESC') of the rows in their group
+    :param limit: rows kept per group
+    """
+
+    def having(rows):
+        sort_rows(rows, order_by)
+        kept = {}
+        result = []
+        for row in rows:
+            count = kept.get(row[group_column], 0)
+            if count < limit:
+                kept[row[group_column]] = count + 1
+                result.append(row)
+        return result
+
+    return having
+
+
+class Merge:
+    """
+    Merge of the partial results of one SELECT run on several shards
+    """
+
+    def __init__(self, keys=None, sums=(), having=None, order_by=(), limit=None, keyset=None):
+        """
+        :param keys: columns grouping the rows of the shards, whose 'sums' columns are added. None to keep every row
+        :param sums: columns added by the grouping, NULL when all their values are NULL like SQL SUM()
+        :param having: function filtering the merged rows, e.g. best_of_group()
+        :param order_by: list of (column, 'ASC' or 'DESC')
+        :param limit: maximum number of rows
+        :param keyset: Keyset of a paginated SELECT, see pagination.py: the rows are sorted in its order,
+                       and its cursor and 'limit' parameters are applied to them
+        """
+
+        self.keys = keys
+        self.sums = sums
+        self.having = having
+        self.order_by = order_by
+        self.limit = limit
+        self.keyset = keyset
+
+    @property
+    def grouped(self):
+        # The rows of a group are spread over the shards: every shard returns all its groups
+        return self.keys is not None
+
+    def group(self, partials):
+        groups = {}
+        for rows in partials:
+            for row in rows:
+                key = tuple(row[column] for column in self.keys)
+                merged = groups.get(key)
+                if merged is None:
+                    groups[key] = dict(row)
+                    continue
+                for column in self.sums:
+                    if row[column] is not None:
+                        merged[column] = row[column] if merged[column] is None else merged[column] + row[column]
+        return list(groups.values())
+
+    def __call__(self, partials, values):
+        """
+        Rows of the SELECT from the rows of every shard
+        :param partials: list of lists of rows, one per shard
+        :param values: dict of bound parameters of the SELECT
+        """
+
+        if self.keys is None:
+            rows = [row for rows in partials for row in rows]
+        else:
+            rows = self.group(partials)
+        if self.having is not None:
+            rows = self.having(rows)
+
+        if self.keyset is not None:
+            self.keyset.sort(rows)
+            if values.get('has_cursor'):
+                keys = [values[f'after_{position}'] for position in range(len(self.keyset.columns))]
+                rows = [row for row in rows if self.keyset.follows(row, keys)]
+            limit = values.get('limit', -1)
+        else:
+            sort_rows(rows, self.order_by)
+            limit = self.limit
+
+        if limit is not None and limit >= 0:
+            rows = rows[:limit]
+        return rows
+
+
+class ShardedPool:
+    """
+    One SQLitePool per shard of a time-sharded database, with the author directory attached
+    """
+
+    sharded = True
+
+    def __init__(self, directory, **pool_options):
+        """
+        :param directory: directory of the shards, with its manifest
+        :param pool_options: options of the SQLitePool of every shard
+        """
+
+        self.directory = directory
+        self.pool_options = pool_options
+        self.shards = []
+        self.write_shard = None
+
+    async def open(self):
+        """
+        Open the pools of the shards listed by the manifest
+        """
+
+        manifest = read_manifest(self.directory)
+        if not manifest or not manifest['shards']:
+            raise ValueError(f'No shards in {os.path.join(self.directory, MANIFEST_NAME)}')
+
+        attach = {'directory': os.path.join(self.directory, manifest['directory'])}
+        self.shards = [
+            (entry, SQLitePool(os.path.join(self.directory, entry['file']), attach=attach, **self.pool_options))
+            for _, entry in sorted(manifest['shards'].items())
+        ]
+        # The write shard first: it sets the author directory to WAL
+        self.write_shard = self.shards[-1][1]
+        await self.write_shard.open()
+        await asyncio.gather(*(pool.open() for _, pool in self.shards[:-1]))
+
+    async def close(self):
+        """
+        Close the pools of every shard
+        """
+
+        await asyncio.gather(*(pool.close() for _, pool in self.shards))
+        self.shards = []
+        self.write_shard = None
+
+    async def warm(self, statements=None):
+        """
+        Run statements on every read connection of every shard, see SQLitePool.warm()
+        """
+
+        await asyncio.gather(*(pool.warm(statements) for _, pool in self.shards))
+
+    async def prefetch(self, tables):
+        """
+        Read every page of tables and of their indexes once, on every shard, see SQLitePool.prefetch()
+        """
+
+        return sum(await asyncio.gather(*(pool.prefetch(tables) for _, pool in self.shards)))
+
+    async def drain(self, timeout_s=None):
+        """
+        Wait until the calls in progress on every shard have returned, see SQLitePool.drain()
+        """
+
+        await asyncio.gather(*(pool.drain(timeout_s) for _, pool in self.shards))
+
+    @property
+    def snapshot_id(self):
+        # The shard files of the manifest, versioned snapshots (see etl/snapshots.py)
+        return ','.join(pool.snapshot_id for _, pool in self.shards)
+
+    @property
+    def user_version(self):
+        # The API writes only to the write shard, see SQLitePool
+        return self.write_shard.user_version
+
+    def select(self, date_range=None):
+        """
+        Pools of the shards with articles in the date range, and the write shard
+        :param date_range: (first date, last date) as 'YYYY-MM-DD', None for every shard
+        """
+
+        if date_range is None:
+            return [pool for _, pool in self.shards]
+        first_date, last_date = date_range
+        return [
+            pool for entry, pool in self.shards
+            if pool is self.write_shard or (entry['first_date'] <= last_date and entry['last_date'] >= first_date)
+        ]
+
+    async def read_shards(self, sql, values=None, timeout_s=None, date_range=None):
+        """
+        Run a SELECT on the shards in parallel. Returns the list of the rows of every shard
+        :param sql: SQL text
+        :param values: dict of bound parameters
+        :param timeout_s: time budget of the SELECT on every shard
+        :param date_range: (first date, last date) of the articles read, None for every shard
+        """
+
+        return await asyncio.gather(*(pool.read(sql, values, timeout_s) for pool in self.select(date_range)))
+
+    async def read(self, sql, values=None, timeout_s=None):
+        """
+        Run a SELECT reading only the author directory, on the write shard
+        :param sql: SQL text
+        :param values: dict of bound parameters
+        :param timeout_s: time budget of the SELECT
+        """
+
+        return await self.write_shard.read(sql, values, timeout_s)
+
+    async def write(self, sql, values=None):
+        """
+        Run an INSERT/UPDATE/DELETE on the writer connection of the write shard
+        """
+
+        return await self.write_shard.write(sql, values)
+
+    async def transaction(self, func):
+        """
+        Run func(writer connection) in one transaction of the write shard, see SQLitePool.transaction()
+        """
+
+        return await self.write_shard.transaction(func)
+
+    async def data_version(self):
+        """
+        SQLite data_version of every shard and of the author directory
+        """
+
+        return tuple(await asyncio.gather(*(pool.data_version() for _, pool in self.shards)))
@@ -0,0 +1,380 @@
+import os
+import time
+import queue
+import asyncio
+import sqlite3
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# Storage layer of the API over one SQLite database file:
+# - a pool of read-only connections (query_only) used in parallel by a thread pool. sqlite3 releases
+#   the GIL while SQLite runs a statement, so slow aggregates run beside the short lookups instead
+#   of queueing them behind
+# - one writer connection with its own thread, the only one of this process that writes
+# The database is switched to WAL, so the readers never wait for the writer and see the last commit.
+# Every uvicorn worker has its own pool and writer: the writers of several workers are serialized
+# by the SQLite file lock, waiting up to busy_timeout for it.
+# A SELECT can be given a time budget: a progress handler of its connection interrupts it inside SQLite
+# once the budget is spent, and QueryTimeout is raised.
+# A read waits for a free read connection in the event loop, not in a thread of the pool: a stream keeps
+# its connection between its batches, and the threads stay free to read its next batches.
+# Every write through the pool increments the user_version of the database in its transaction: a content
+# version stored in the file, the same for every process reading it (see the ETags of query_registry.py).
+# The calls in progress are counted: a pool replaced by the pool of a new snapshot is drained,
+# its last calls end on the old snapshot, before it is closed.
+
+# SQLite virtual machine instructions between two checks of the time budget
+PROGRESS_STEPS = 10000
+
+# Statements run by every read connection of a new pool before its first request: the schema is parsed
+WARM_STATEMENTS = ['SELECT COUNT(*) FROM sqlite_master']
+
+# A table and its indexes can be prefetched: every page of their b-trees is read once, into the page cache
+# of the operating system and the memory mapping shared by all the connections
+
+
+class QueryTimeout(Exception):
+    """
+    A SELECT ran longer than its time budget and was interrupted
+    """
+
+
+@contextmanager
+def time_budget(connection, timeout_s):
+    """
+    Interrupt the statements of the connection run in the 'with' block after timeout_s seconds
+    :param connection: sqlite3 connection
+    :param timeout_s: seconds, None or 0 for no budget
+    """
+
+    if not timeout_s:
+        yield
+        return
+
+    deadline = time.monotonic() + timeout_s
+    # A true value returned by the handler interrupts the statement
+    connection.set_progress_handler(lambda: time.monotonic() > deadline, PROGRESS_STEPS)
+    try:
+        yield
+    except sqlite3.OperationalError as e:
+        if time.monotonic() > deadline:
+            raise QueryTimeout(f'Query interrupted after its time budget of {timeout_s} s') from e
+        raise
+    finally:
+        connection.set_progress_handler(None, 0)
+
+
+class SQLitePool:
+    """
+    Read-only connections on a thread pool and one writer connection on the same SQLite file
+    """
+
+    def __init__(self, db_path, readers=None, cached_statements=128,
+                 cache_size_kb=65536, mmap_size=268435456, busy_timeout_ms=5000, attach=None):
+        """
+        :param db_path: SQLite database file
+        :param readers: number of read connections and threads, by default the number of CPUs
+        :param cached_statements: prepared statements kept by every connection
+        :param cache_size_kb: page cache of every connection, in KB
+        :param mmap_size: bytes of the database file read through memory mapping, 0 disables it
+        :param busy_timeout_ms: milliseconds a connection waits for a lock held by another process
+        :param attach: dict of schema name: database file attached to every connection, its tables are
+                       used without schema name when the main database has no table of the same name
+        """
+
+        self.db_path = db_path
+        self.readers = readers or os.cpu_count() or 4
+        self.cached_statements = cached_statements
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.busy_timeout_ms = busy_timeout_ms
+        self.attach = attach or {}
+        self.read_connections = None
+        self.read_executor = None
+        self.read_slots = None
+        self.snapshot_id = None
+        self.user_version = None
+        self.writer = None
+        self.write_executor = None
+        self.active = 0
+        self.drained = None
+
+    def _connect(self, read_only):
+        uri = f'file:{self.db_path}?mode=ro' if read_only else f'file:{self.db_path}?mode=rw'
+        connection = sqlite3.connect(
+            uri,
+            uri=True,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=self.cached_statements
+        )
+        connection.row_factory = sqlite3.Row
+        connection.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout_ms)}')
+        for schema, path in self.attach.items():
+            connection.execute(f'ATTACH DATABASE ? AS {schema}', (f"file:{path}?mode={'ro' if read_only else 'rw'}",))
+        for schema in ['main', *self.attach]:
+            connection.execute(f'PRAGMA {schema}.cache_size = {-int(self.cache_size_kb)}')
+            connection.execute(f'PRAGMA {schema}.mmap_size = {int(self.mmap_size)}')
+        if read_only:
+            connection.execute('PRAGMA query_only = 1')
+        return connection
+
+    def _open(self):
+        # The writer switches the file to WAL before the readers attach to it
+        self.writer = self._connect(read_only=False)
+        for schema in ['main', *self.attach]:
+            self.writer.execute(f'PRAGMA {schema}.journal_mode = WAL')
+            self.writer.execute(f'PRAGMA {schema}.synchronous = NORMAL')
+
+        self.read_connections = queue.Queue()
+        for _ in range(self.readers):
+            self.read_connections.put(self._connect(read_only=True))
+
+        # The snapshot files have unique names (see etl/snapshots.py), the inode tells apart a file replaced in place
+        self.snapshot_id = f'{os.path.basename(self.db_path)}:{os.stat(self.db_path).st_ino}'
+        self.user_version = self.writer.execute('PRAGMA user_version').fetchone()[0]
+
+    async def open(self):
+        """
+        Open the writer and the read connections
+        """
+
+        self.write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-writer')
+        self.read_executor = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix='sqlite-reader')
+        # Free read connections
+        self.read_slots = asyncio.Semaphore(self.readers)
+        await asyncio.get_running_loop().run_in_executor(self.write_executor, self._open)
+
+    def _warm(self, statements):
+        # Every read connection at once, so that each one runs the statements
+        connections = [self.read_connections.get() for _ in range(self.readers)]
+        try:
+            for connection in connections:
+                for sql in statements:
+                    connection.execute(sql).fetchall()
+        finally:
+            for connection in connections:
+                self.read_connections.put(connection)
+
+    async def warm(self, statements=None):
+        """
+        Run statements on every read connection, before the pool serves its first request
+        :param statements: list of SQL texts, by default WARM_STATEMENTS
+        """
+
+        await asyncio.get_running_loop().run_in_executor(self.read_executor, self._warm, statements or WARM_STATEMENTS)
+
+    def _prefetch(self, table):
+        connection = self.read_connections.get()
+        try:
+            # COUNT(*) reads every page of the b-tree it counts: the table itself, then every index
+            # from its first column on
+            statements = [f'SELECT COUNT(*) FROM "{table}" NOT INDEXED']
+            for index in connection.execute(f'PRAGMA index_list("{table}")').fetchall():
+                columns = connection.execute(f'PRAGMA index_info("{index["name"]}")').fetchall()
+                if columns and columns[0]['name'] is not None:
+                    statements.append(
+                        f'SELECT COUNT(*) FROM "{table}" INDEXED BY "{index["name"]}" WHERE "{columns[0]["name"]}" IS NOT NULL'
+                    )
+            for sql in statements:
+                connection.execute(sql).fetchall()
+            return len(statements)
+        except sqlite3.OperationalError:
+            # Not a table of this database, e.g. the author directory of the shards
+            return 0
+        finally:
+            self.read_connections.put(connection)
+
+    async def prefetch(self, tables):
+        """
+        Read every page of tables and of their indexes once, in parallel. Returns the number of b-trees read
+        :param tables: list of table names
+        """
+
+        async def prefetch_table(table):
+            async with self.read_slots:
+                return await asyncio.get_running_loop().run_in_executor(self.read_executor, self._prefetch, table)
+
+        with self._in_use():
+            counts = await asyncio.gather(*(prefetch_table(table) for table in tables))
+        return sum(counts)
+
+    @contextmanager
+    def _in_use(self):
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            if not self.active and self.drained is not None:
+                self.drained.set()
+
+    async def drain(self, timeout_s=None):
+        """
+        Wait until the calls in progress have returned, the streams included
+        :param timeout_s: maximum wait in seconds, None for no limit
+        """
+
+        if not self.active:
+            return
+        self.drained = asyncio.Event()
+        try:
+            await asyncio.wait_for(self.drained.wait(), timeout_s)
+        except asyncio.TimeoutError:
+            print(f'{self.active} calls still running on {self.db_path} after {timeout_s} s')
+        finally:
+            self.drained = None
+
+    async def close(self):
+        """
+        Wait for the statements running, then close every connection
+        """
+
+        read_executor, write_executor = self.read_executor, self.write_executor
+        read_connections, writer = self.read_connections, self.writer
+        self.read_executor = self.write_executor = self.read_connections = self.writer = None
+
+        if read_executor is not None:
+            await asyncio.get_running_loop().run_in_executor(None, read_executor.shutdown)
+        if write_executor is not None:
+            await asyncio.get_running_loop().run_in_executor(None, write_executor.shutdown)
+        while read_connections is not None and not read_connections.empty():
+            read_connections.get_nowait().close()
+        if writer is not None:
+            writer.close()
+
+    def _read(self, sql, values, timeout_s):
+        connection = self.read_connections.get()
+        try:
+            with time_budget(connection, timeout_s):
+                cursor = connection.execute(sql, values)
+                rows = [dict(row) for row in cursor.fetchall()]
+                cursor.close()
+            return rows
+        finally:
+            self.read_connections.put(connection)
+
+    def _execute_cursor(self, connection, sql, values, timeout_s):
+        with time_budget(connection, timeout_s):
+            return connection.execute(sql, values)
+
+    def _fetch_batch(self, connection, cursor, batch_size, timeout_s):
+        with time_budget(connection, timeout_s):
+            return [dict(row) for row in cursor.fetchmany(batch_size)]
+
+    def _write(self, sql, values):
+        def write(writer):
+            cursor = writer.execute(sql, values)
+            lastrowid = cursor.lastrowid
+            cursor.close()
+            return lastrowid
+
+        return self._transaction(write)
+
+    def _transaction(self, func):
+        self.writer.execute('BEGIN IMMEDIATE')
+        try:
+            result = func(self.writer)
+            # Read in the transaction: the write lock serializes the increments of all the processes
+            user_version = self.writer.execute('PRAGMA user_version').fetchone()[0] + 1
+            self.writer.execute(f'PRAGMA user_version = {user_version}')
+        except BaseException:
+            self.writer.execute('ROLLBACK')
+            raise
+        self.writer.execute('COMMIT')
+        self.user_version = user_version
+        return result
+
+    def _data_version(self):
+        # The user_version written by the other processes is read with the data_version that tells their writes
+        self.user_version = self.writer.execute('PRAGMA user_version').fetchone()[0]
+        if not self.attach:
+            return self.writer.execute('PRAGMA data_version').fetchone()[0]
+        return tuple(self.writer.execute(f'PRAGMA {schema}.data_version').fetchone()[0] for schema in ['main', *self.attach])
+
+    async def read(self, sql, values=None, timeout_s=None):
+        """
+        Run a SELECT on a read connection and return its rows as dicts
+        :param sql: SQL text
+        :param values: dict of bound parameters
+        :param timeout_s: time budget of the SELECT in seconds, None for no budget
+        """
+
+        with self._in_use():
+            async with self.read_slots:
+                return await asyncio.get_running_loop().run_in_executor(self.read_executor, self._read, sql, values or {}, timeout_s)
+
+    async def stream(self, sql, values=None, batch_size=500, timeout_s=None):
+        """
+        Run a SELECT on a read connection and yield its rows in lists of batch_size dicts,
+        while they are produced. The connection is kept until the end of the iteration
+        :param sql: SQL text
+        :param values: dict of bound parameters
+        :param batch_size: rows of every batch
+        :param timeout_s: time budget of the SELECT in seconds, spent only while SQLite runs
+                          (not while the batches are sent), None for no budget
+        """
+
+        loop = asyncio.get_running_loop()
+        executor, connections = self.read_executor, self.read_connections
+        with self._in_use():
+            await self.read_slots.acquire()
+            connection = connections.get_nowait()
+            cursor = None
+            # Seconds spent in SQLite: the time of the client reading the batches between two fetches is not counted
+            spent_s = 0.0
+            try:
+                start = time.monotonic()
+                cursor = await loop.run_in_executor(executor, self._execute_cursor, connection, sql, values or {}, timeout_s)
+                spent_s += time.monotonic() - start
+                while True:
+                    remaining_s = timeout_s and timeout_s - spent_s
+                    if timeout_s and remaining_s <= 0:
+                        raise QueryTimeout(f'Query interrupted after its time budget of {timeout_s} s')
+                    start = time.monotonic()
+                    try:
+                        rows = await loop.run_in_executor(executor, self._fetch_batch, connection, cursor, batch_size, remaining_s)
+                    except QueryTimeout as e:
+                        # The fetch had the remainder of the budget, the error gives the budget of the query
+                        raise QueryTimeout(f'Query interrupted after its time budget of {timeout_s} s') from e
+                    spent_s += time.monotonic() - start
+                    if not rows:
+                        break
+                    yield rows
+            finally:
+                if cursor is not None:
+                    cursor.close()
+                if self.read_connections is connections:
+                    connections.put(connection)
+                else:
+                    # The pool was closed while the stream outlived its drain: nobody else closes the connection
+                    connection.close()
+                self.read_slots.release()
+
+    async def write(self, sql, values=None):
+        """
+        Run an INSERT/UPDATE/DELETE on the writer connection and return the rowid of the last inserted row
+        :param sql: SQL text
+        :param values: dict of bound parameters
+        """
+
+        with self._in_use():
+            return await asyncio.get_running_loop().run_in_executor(self.write_executor, self._write, sql, values or {})
+
+    async def transaction(self, func):
+        """
+        Run func(writer connection) in the writer thread inside one transaction,
+        committed when func returns and rolled back when it raises. Returns the result of func
+        :param func: function receiving the writer connection
+        """
+
+        with self._in_use():
+            return await asyncio.get_running_loop().run_in_executor(self.write_executor, self._transaction, func)
+
+    async def data_version(self):
+        """
+        SQLite data_version of the writer connection: it changes when another connection,
+        e.g. the writer of another uvicorn worker, commits to the database
+        """
+
+        return await asyncio.get_running_loop().run_in_executor(self.write_executor, self._data_version)
@@ -0,0 +1,105 @@
+import time
+import asyncio
+from urllib.parse import urlsplit
+
+# Warm-up of the API after it starts, before it reports ready.
+# The API accepts requests at once, but /ready answers 503 until the warm-up steps are done:
+# the hot tables read into memory, the in-memory indexes loaded and the warm-up requests answered
+# (their results stay in the result cache). A load balancer or docker-compose sends the traffic
+# once /ready answers 200, and the first requests are served at steady-state latency.
+# A failing step is recorded and does not stop the warm-up: the API serves without it.
+
+
+class WarmUp:
+    """
+    Steps of the warm-up and their timings
+    """
+
+    def __init__(self):
+        self.ready = False
+        self.started = time.time()
+        self.finished = None
+        self.steps = []
+
+    async def run(self, name, func, *args):
+        """
+        Run one step of the warm-up. Returns the result of func, None when it raised
+        :param name: name of the step
+        :param func: async function
+        :param args: arguments of func
+        """
+
+        step = {'step': name, 'ms': None, 'error': None}
+        self.steps.append(step)
+        start = time.perf_counter()
+        try:
+            return await func(*args)
+        except Exception as e:
+            step['error'] = f'{type(e).__name__}: {e}'
+            print(f">>> Warm-up step '{name}' failed : {e}")
+            return None
+        finally:
+            step['ms'] = round((time.perf_counter() - start) * 1000, 3)
+
+    def done(self):
+        """
+        End of the warm-up: the API reports ready
+        """
+
+        self.ready = True
+        self.finished = time.time()
+        print(f"Warm-up done in {self.finished - self.started:.3f} s")
+
+    def state(self):
+        """
+        Readiness and steps of the warm-up
+        """
+
+        return {
+            'ready': self.ready,
+            'seconds': round((self.finished or time.time()) - self.started, 3),
+            'steps': self.steps
+        }
+
+
+async def asgi_get(app, url):
+    """
+    Answer a GET request with the ASGI app in this process, without a network connection.
+    Returns the status code of the response, its body is dropped
+    :param app: ASGI application
+    :param url: path with its query string, e.g. '/articles_count_by_author?author=smith'
+    """
+
+    parts = urlsplit(url)
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': parts.path,
+        'raw_path': parts.path.encode(),
+        'query_string': parts.query.encode(),
+        'root_path': '',
+        'headers': [(b'host', b'warmup')],
+        'client': ('127.0.0.1', 0),
+        'server': ('warmup', 80)
+    }
+    status = {}
+    disconnected = asyncio.Event()
+
+    async def receive():
+        if not status.get('requested'):
+            status['requested'] = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        await disconnected.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status['code'] = message['status']
+        elif message['type'] == 'http.response.body' and not message.get('more_body', False):
+            disconnected.set()
+
+    await app(scope, receive, send)
+    return status.get('code')
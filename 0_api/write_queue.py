@@ -0,0 +1,166 @@
+import time
+import asyncio
+
+# api_common is importable from the parent directory, see main.py
+from api_common.request_metrics import add_db_time
+
+# Write coalescing of the API inserts (group commit).
+# The endpoints do not write themselves: they queue their write, a function running registered
+# statements with a Transaction (see query_registry.py), and wait for its result.
+# One background task drains the queue: it takes the first pending write, waits at most max_delay_ms
+# for more, up to max_batch writes, and runs them all in one transaction, so many inserts share
+# one commit. Every write runs in its own savepoint: a failing write is rolled back alone and its
+# caller gets the exception, the other writes of the batch are committed.
+# When max_pending writes are already queued, submit() waits at most enqueue_timeout_s for
+# a free place and then raises WriteQueueFull (backpressure).
+
+
+class WriteQueueFull(Exception):
+    """
+    The write queue stayed full during enqueue_timeout_s
+    """
+
+
+def run_batch(transaction, writes):
+    """
+    Run the writes of one batch, each one in its own savepoint. Returns (ok, result or exception) per write
+    :param transaction: Transaction of the batch
+    :param writes: list of (func, args)
+    """
+
+    results = []
+    for func, args in writes:
+        try:
+            with transaction.savepoint():
+                results.append((True, func(transaction, *args)))
+        except Exception as e:
+            results.append((False, e))
+    return results
+
+
+class WriteQueue:
+    """
+    Queue of writes committed in batches by one background task
+    """
+
+    def __init__(self, queries, max_batch=256, max_delay_ms=2.0, max_pending=10000, enqueue_timeout_s=1.0):
+        """
+        :param queries: QueryRegistry running the transactions
+        :param max_batch: maximum number of writes committed in one transaction
+        :param max_delay_ms: maximum milliseconds the first write of a batch waits for more writes
+        :param max_pending: maximum number of writes waiting in the queue
+        :param enqueue_timeout_s: seconds a write waits for a place in a full queue
+        """
+
+        self.queries = queries
+        self.max_batch = max_batch
+        self.max_delay_s = max_delay_ms / 1000
+        self.max_pending = max_pending
+        self.enqueue_timeout_s = enqueue_timeout_s
+        self.queue = None
+        self.task = None
+        self.stats = {'writes': 0, 'failed_writes': 0, 'rejected_writes': 0, 'batches': 0, 'max_batch_size': 0}
+
+    async def start(self):
+        """
+        Start the background task committing the writes
+        """
+
+        self.queue = asyncio.Queue(self.max_pending)
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Commit the writes still queued, then stop the background task
+        """
+
+        if self.task is None:
+            return
+        await self.queue.join()
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def submit(self, func, *args):
+        """
+        Queue one write and wait until its batch is committed. Returns the result of func
+        :param func: function running registered statements with the Transaction it receives
+        :param args: arguments of func
+        """
+
+        future = asyncio.get_running_loop().create_future()
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.queue.put((func, args, future)), self.enqueue_timeout_s)
+        except asyncio.TimeoutError:
+            self.stats['rejected_writes'] += 1
+            raise WriteQueueFull(f'{self.max_pending} writes already queued')
+        try:
+            return await future
+        finally:
+            # The batch is committed by the writer task: its time is the DB time of the request
+            add_db_time((time.perf_counter() - start) * 1000)
+
+    async def _next_batch(self):
+        batch = [await self.queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_delay_s
+        while len(batch) < self.max_batch:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _commit(self, batch):
+        writes = [(func, args) for func, args, _ in batch]
+        try:
+            results = await self.queries.transaction('group_commit', run_batch, writes)
+        except Exception as e:
+            results = [(False, e)] * len(batch)
+
+        for (_, _, future), (ok, value) in zip(batch, results):
+            self.stats['writes'] += 1
+            if not ok:
+                self.stats['failed_writes'] += 1
+            # The caller may be gone (client disconnected): its write is committed anyway
+            if future.done():
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+        self.stats['batches'] += 1
+        self.stats['max_batch_size'] = max(self.stats['max_batch_size'], len(batch))
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self._commit(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def statistics(self):
+        """
+        Counters of the writes and batches
+        """
+
+        return {
+            'pending_writes': self.queue.qsize() if self.queue is not None else 0,
+            'max_pending': self.max_pending,
+            'max_batch': self.max_batch,
+            'max_delay_ms': self.max_delay_s * 1000,
+            **self.stats,
+            'mean_batch_size': round(self.stats['writes'] / self.stats['batches'], 2) if self.stats['batches'] else None
+        }
@@ -0,0 +1,65 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import monitoring
+
+# api_common is importable from the parent directory, see main.py
+from api_common.request_metrics import add_db_time, current_path
+
+# MongoDB side of the request metrics (see api_common/request_metrics.py), as a command listener of the client.
+# pymongo calls the listener for every command it sends (find, getMore, aggregate...) in the thread of the
+# caller: the duration of the command is added to the DB time of the request in progress.
+# A command slower than the threshold of the SlowQueryLog is logged with its command document (the filter
+# or pipeline and their values) and the queryPlanner output of explain(). The explain runs in a thread of
+# its own after the command: a listener must not block, nor send commands from inside pymongo.
+
+# Commands explain() accepts, the others are logged without plan (e.g. getMore)
+EXPLAINED_COMMANDS = {'find', 'aggregate', 'count', 'distinct'}
+
+# Fields added to the commands by the driver, not sent again inside explain
+DRIVER_FIELDS = {'lsid', 'txnNumber', '$clusterTime', '$db', '$readPreference'}
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """
+    DB time of the requests and slow-query log of the MongoDB commands
+    """
+
+    def __init__(self, slow_log):
+        """
+        :param slow_log: SlowQueryLog of the commands over its threshold
+        """
+
+        self.slow_log = slow_log
+        self.client = None
+        self.commands = {}
+        self.explain_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='mongo-explain')
+
+    def started(self, event):
+        if self.slow_log.threshold_ms > 0 and event.command_name != 'explain':
+            self.commands[(event.connection_id, event.request_id)] = (event.command, current_path())
+
+    def succeeded(self, event):
+        self.finished(event)
+
+    def failed(self, event):
+        self.finished(event)
+
+    def finished(self, event):
+        elapsed_ms = event.duration_micros / 1000
+        add_db_time(elapsed_ms)
+        started = self.commands.pop((event.connection_id, event.request_id), None)
+        if started is not None and self.slow_log.is_slow(elapsed_ms):
+            command, path = started
+            self.explain_executor.submit(self.log_slow, event.database_name, event.command_name, command, elapsed_ms, path)
+
+    def log_slow(self, database_name, command_name, command, elapsed_ms, path):
+        # In the explain thread
+        parameters = {key: value for key, value in command.items() if key not in DRIVER_FIELDS}
+        plan = None
+        if command_name in EXPLAINED_COMMANDS and self.client is not None:
+            try:
+                explain = self.client[database_name].command({'explain': parameters, 'verbosity': 'queryPlanner'})
+                plan = {key: explain[key] for key in ('queryPlanner', 'stages') if key in explain}
+            except Exception as e:
+                plan = f'{type(e).__name__}: {e}'
+        self.slow_log.log(command_name, f'{command_name} {command.get(command_name)}', parameters, elapsed_ms, plan, path)
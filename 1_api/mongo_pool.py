@@ -0,0 +1,159 @@
+import asyncio
+import contextvars
+from functools import partial
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import pymongo
+from pymongo.errors import ExecutionTimeout, OperationFailure
+
+# Access of the API to one MongoDB collection without blocking the event loop.
+# pymongo is synchronous: every call, with the iteration of its cursor (which fetches the next batches
+# from the server), runs in a bounded thread pool, and the event loop serves the other requests meanwhile.
+# The threads share the connection pool of one MongoClient, sized for them: a thread does not wait for
+# a connection, and the calls beyond the threads wait in the queue of the thread pool.
+# The threads run in a copy of the context of the request, so the command listener (command_metrics.py)
+# adds the DB time of the commands to the request.
+# A command can be given a time budget (maxTimeMS): MongoDB interrupts it on the server and QueryTimeout is raised.
+
+
+class QueryTimeout(Exception):
+    """
+    A command ran longer than its time budget and was interrupted by MongoDB
+    """
+
+
+class MongoPool:
+    """
+    One MongoDB collection read by a thread pool
+    """
+
+    def __init__(self, url, db_name, collection_name, workers=16, max_pool_size=None, min_pool_size=0,
+                 server_selection_timeout_ms=5000, connect_timeout_ms=5000, socket_timeout_ms=None,
+                 wait_queue_timeout_ms=None, max_time_ms=None, batch_size=1000, event_listeners=()):
+        """
+        :param url: MongoDB connection string
+        :param db_name: database of the collection
+        :param collection_name: collection read by the API
+        :param workers: threads running the calls, the calls in parallel
+        :param max_pool_size: connections of the client, by default one per thread and one for the slow-command explains
+        :param min_pool_size: connections kept open while idle
+        :param server_selection_timeout_ms: milliseconds a call waits for a reachable server
+        :param connect_timeout_ms: milliseconds to open a connection
+        :param socket_timeout_ms: milliseconds a call waits for a reply of the server, None for no limit
+        :param wait_queue_timeout_ms: milliseconds a call waits for a free connection, None for no limit
+        :param max_time_ms: time budget of the commands on the server, None or 0 for no budget
+        :param batch_size: documents per batch of the cursors
+        :param event_listeners: pymongo event listeners of the client, e.g. CommandMetrics
+        """
+
+        self.workers = workers
+        self.max_pool_size = max_pool_size or workers + 1
+        self.min_pool_size = min_pool_size
+        self.max_time_ms = max_time_ms or None
+        self.batch_size = batch_size
+        self.client = pymongo.MongoClient(
+            url,
+            maxPoolSize=self.max_pool_size,
+            minPoolSize=self.min_pool_size,
+            serverSelectionTimeoutMS=server_selection_timeout_ms,
+            connectTimeoutMS=connect_timeout_ms,
+            socketTimeoutMS=socket_timeout_ms,
+            waitQueueTimeoutMS=wait_queue_timeout_ms,
+            event_listeners=list(event_listeners),
+            appname='nyt-api'
+        )
+        self.db = self.client[db_name]
+        self.collection = self.db[collection_name]
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='mongo')
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Run a blocking function in the thread pool, in the context of the request in progress
+        :param func: function calling pymongo
+        :param args: arguments of func
+        :param kwargs: keyword arguments of func
+        """
+
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(context.run, func, *args, **kwargs))
+
+    def _budget(self):
+        return {} if self.max_time_ms is None else {'maxTimeMS': self.max_time_ms}
+
+    @contextmanager
+    def _time_budget(self):
+        try:
+            yield
+        except ExecutionTimeout as e:
+            raise QueryTimeout(f'Query interrupted after its time budget of {self.max_time_ms} ms') from e
+
+    def _find(self, filter, projection):
+        # In a thread of the pool
+        with self._time_budget():
+            return list(self.collection.find(filter, projection, batch_size=self.batch_size, max_time_ms=self.max_time_ms))
+
+    def _aggregate(self, pipeline, hint):
+        # In a thread of the pool
+        options = self._budget() if hint is None else {**self._budget(), 'hint': hint}
+        with self._time_budget():
+            try:
+                return list(self.collection.aggregate(pipeline, batchSize=self.batch_size, **options))
+            except OperationFailure as e:
+                # The index of the hint is not built yet, see etl/mongo_indexes.py
+                if hint is None or 'hint' not in str(e).lower():
+                    raise
+                return list(self.collection.aggregate(pipeline, batchSize=self.batch_size, **self._budget()))
+
+    def _count_documents(self, filter):
+        # In a thread of the pool
+        with self._time_budget():
+            return self.collection.count_documents(filter, **self._budget())
+
+    async def find(self, filter, projection=None):
+        """
+        Documents of the collection matching a filter, as a list
+        :param filter: query filter
+        :param projection: fields returned, None for all
+        """
+
+        return await self.run(self._find, filter, projection)
+
+    async def aggregate(self, pipeline, hint=None):
+        """
+        Result of an aggregation pipeline on the collection, as a list
+        :param pipeline: list of stages
+        :param hint: name of the index read by the pipeline, ignored while the index does not exist
+        """
+
+        return await self.run(self._aggregate, pipeline, hint)
+
+    async def count_documents(self, filter):
+        """
+        Number of documents of the collection matching a filter
+        :param filter: query filter
+        """
+
+        return await self.run(self._count_documents, filter)
+
+    def statistics(self):
+        """
+        Settings of the pool and calls waiting for a thread
+        """
+
+        return {
+            'workers': self.workers,
+            'queued_calls': self.executor._work_queue.qsize(),
+            'max_pool_size': self.max_pool_size,
+            'min_pool_size': self.min_pool_size,
+            'max_time_ms': self.max_time_ms,
+            'batch_size': self.batch_size
+        }
+
+    async def close(self):
+        """
+        Wait for the calls in progress and close the client
+        """
+
+        await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+        self.client.close()
@@ -0,0 +1,90 @@
+import os
+import json
+import hashlib
+
+from fastapi import Request
+from fastapi.responses import Response
+
+from api_common.responses import requested_format
+
+# HTTP conditional GETs, shared by the FastAPI apps.
+# A successful GET response carries a weak ETag made of the content version of the database, given by
+# the app (changed by create_db, the inserts of the API and the MongoDB ingest), and of the normalized
+# request: path, query parameters in sorted order and response format (see responses.py).
+# A GET whose If-None-Match holds the current ETag is answered 304 before the routing: no query runs.
+# Cache-Control of the GETs: NYT_CACHE_CONTROL (default 'no-cache': the clients and the proxy keep the
+# responses and revalidate them, a 304 costs no query), per route with NYT_CACHE_CONTROL_ROUTES, a JSON
+# object of path: Cache-Control, e.g. '{"/top_authors_by_section": "public, max-age=3600"}'.
+# The status routes of the apps, not read from the database, get 'no-store' and no ETag.
+
+NYT_CACHE_CONTROL = os.environ.get('NYT_CACHE_CONTROL', 'no-cache')
+NYT_CACHE_CONTROL_ROUTES = json.loads(os.environ.get('NYT_CACHE_CONTROL_ROUTES', '') or '{}')
+
+
+def request_etag(version, request: Request):
+    """
+    Weak ETag of the response of a GET
+    :param version: content version of the database
+    :param request: request of the response
+    """
+
+    normalized = json.dumps([request.url.path, sorted(request.query_params.multi_items()), requested_format(request)])
+    return f'W/"{version}-{hashlib.blake2b(normalized.encode(), digest_size=8).hexdigest()}"'
+
+
+def etag_matches(if_none_match, etag):
+    """
+    True when the header If-None-Match holds the ETag, compared weakly.
+    '*' matches nothing: the check runs before the routing, when the existence of the resource is unknown
+    :param if_none_match: value of the header, None when missing
+    :param etag: current ETag
+    """
+
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return etag.removeprefix('W/') in (tag.removeprefix('W/') for tag in tags)
+
+
+class ConditionalGet:
+    """
+    Middleware: ETag and Cache-Control of the GETs, 304 for the unchanged responses
+    """
+
+    def __init__(self, content_version, no_store=()):
+        """
+        :param content_version: async function returning the content version of the database, None when unknown
+        :param no_store: paths answered with 'Cache-Control: no-store' and without ETag
+        """
+
+        self.content_version = content_version
+        self.no_store = set(no_store)
+        self.not_modified = 0
+
+    async def __call__(self, request: Request, call_next):
+        if request.method not in ('GET', 'HEAD'):
+            return await call_next(request)
+
+        path = request.url.path
+        if path in self.no_store:
+            response = await call_next(request)
+            response.headers['Cache-Control'] = 'no-store'
+            return response
+
+        version = await self.content_version()
+        if version is None:
+            return await call_next(request)
+        headers = {
+            'ETag': request_etag(version, request),
+            'Cache-Control': NYT_CACHE_CONTROL_ROUTES.get(path, NYT_CACHE_CONTROL),
+            'Vary': 'Accept'
+        }
+        if etag_matches(request.headers.get('if-none-match'), headers['ETag']):
+            self.not_modified += 1
+            return Response(status_code=304, headers=headers)
+
+        response = await call_next(request)
+        if response.status_code == 200:
+            for name, value in headers.items():
+                response.headers[name] = value
+        return response
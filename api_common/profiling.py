@@ -0,0 +1,86 @@
+import os
+import io
+import time
+import pstats
+import cProfile
+from datetime import datetime
+
+from fastapi import Request
+from fastapi.responses import Response, PlainTextResponse
+
+# Per-request profiling middleware, shared by the FastAPI apps.
+# Switched on with the environment variable NYT_API_PROFILING=1, then one request is profiled
+# when it carries the header 'X-Profile' or the query parameter 'profile':
+#   1 / true  the response is replaced by the text report of the profile
+#   save      the normal response is returned, the profile is only saved
+# The .prof file is saved in NYT_API_PROFILE_DIR and its name returned in the header 'X-Profile-File'.
+
+PROFILING_ENABLED = os.environ.get('NYT_API_PROFILING', '').lower() in ('1', 'true', 'yes')
+PROFILE_DIR = os.environ.get('NYT_API_PROFILE_DIR', '../output_data')
+PROFILE_TOP = 40
+
+# cProfile profiles the whole thread: only one request is profiled at a time
+_profile_active = False
+
+
+def requested_profile(request: Request):
+    """
+    Profile mode requested by the client: None, 'return' or 'save'
+    """
+
+    value = request.headers.get('x-profile') or request.query_params.get('profile')
+    if not value:
+        return None
+    value = value.lower()
+    if value == 'save':
+        return 'save'
+    if value in ('1', 'true', 'yes', 'return'):
+        return 'return'
+    return None
+
+
+async def profile_request(request: Request, call_next):
+    """
+    Middleware: profile one request with cProfile when requested, see the header of this module
+    """
+
+    global _profile_active
+
+    mode = requested_profile(request) if PROFILING_ENABLED else None
+    if mode is None:
+        return await call_next(request)
+    if _profile_active:
+        response = await call_next(request)
+        response.headers['X-Profile'] = 'busy'
+        return response
+
+    _profile_active = True
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        response = await call_next(request)
+        # Read the body inside the profile, serialization included
+        body = b''.join([chunk async for chunk in response.body_iterator])
+    finally:
+        profiler.disable()
+        _profile_active = False
+    elapsed_ms = (time.perf_counter() - start) * 1000
+
+    route = request.url.path.strip('/').replace('/', '_') or 'index'
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+    profile_file = os.path.join(PROFILE_DIR, f'profile_api_{route}_{timestamp}.prof')
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profiler.dump_stats(profile_file)
+
+    if mode == 'return':
+        stream = io.StringIO()
+        stream.write(f'{request.method} {request.url.path}?{request.url.query}  '
+                     f'{elapsed_ms:.1f} ms  status {response.status_code}\n'
+                     f'Other requests served at the same time by this worker are included in the profile\n\n')
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(PROFILE_TOP)
+        return PlainTextResponse(stream.getvalue(), headers={'X-Profile-File': profile_file})
+
+    headers = {key: value for key, value in response.headers.items() if key.lower() != 'content-length'}
+    headers['X-Profile-File'] = profile_file
+    return Response(content=body, status_code=response.status_code, headers=headers, media_type=response.media_type)
@@ -0,0 +1,332 @@
+import os
+import json
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+
+from fastapi import Request
+
+# Per-route request metrics and slow-query log, shared by the FastAPI apps.
+# The middleware record_request() times every request, per route (the path template, e.g.
+# '/articles_count_by_author'), and splits its latency in:
+#   db             time waiting for the database, added by the query layer of the app with add_db_time()
+#   serialization  time encoding the response, added by api_common/responses.py with serialization_timer()
+#   total          from the start of the request to the last byte of its body, streamed bodies included
+# and counts the rows returned (add_rows()). The latencies are kept in histograms with fixed buckets,
+# growing by BUCKET_RATIO: their quantiles p50/p95/p99 are exact within one bucket.
+# The metrics are published by the endpoint /metrics of the apps, as JSON or in the Prometheus text format.
+# Every process (e.g. every uvicorn worker) has its own metrics.
+# Slow-query log: a statement slower than NYT_SLOW_QUERY_MS (0 disables the log) is logged with its bound
+# parameters and its query plan, as one JSON line of NYT_SLOW_QUERY_DIR/slow_queries_<api>.jsonl.
+# The last ones are also kept in memory and published by /metrics.
+
+NYT_SLOW_QUERY_MS = float(os.environ.get('NYT_SLOW_QUERY_MS', '500'))
+NYT_SLOW_QUERY_DIR = os.environ.get('NYT_SLOW_QUERY_DIR', '../output_data')
+SLOW_QUERIES_KEPT = 50
+
+# Upper bounds of the histogram buckets in ms: 0.05 ms to about 3 minutes, and one more bucket beyond
+BUCKET_RATIO = 2 ** 0.25
+BUCKET_BOUNDS_MS = [0.05 * BUCKET_RATIO ** index for index in range(88)]
+QUANTILES = (0.5, 0.95, 0.99)
+PARTS = ('total', 'db', 'serialization')
+
+# Timings of the request in progress, shared by its tasks
+_current = ContextVar('request_timing', default=None)
+
+
+class Histogram:
+    """
+    Latencies in fixed buckets
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+        self.count = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, ms):
+        """
+        Add one latency
+        :param ms: latency in milliseconds
+        """
+
+        self.counts[bisect_left(BUCKET_BOUNDS_MS, ms)] += 1
+        self.count += 1
+        self.sum_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket of the quantile q, None without latencies
+        :param q: quantile between 0 and 1, e.g. 0.95
+        """
+
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if index == len(BUCKET_BOUNDS_MS):
+                    return self.max_ms
+                return min(BUCKET_BOUNDS_MS[index], self.max_ms)
+        return self.max_ms
+
+    def summary(self):
+        """
+        Count, mean, quantiles and maximum of the latencies, in ms
+        """
+
+        summary = {
+            'count': self.count,
+            'mean_ms': round(self.sum_ms / self.count, 3) if self.count else None
+        }
+        for q in QUANTILES:
+            value = self.quantile(q)
+            summary[f'p{round(q * 100)}_ms'] = None if value is None else round(value, 3)
+        summary['max_ms'] = round(self.max_ms, 3)
+        return summary
+
+
+class RequestMetrics:
+    """
+    Requests, errors, rows and latency histograms of every route
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.routes = {}
+
+    def record(self, method, route, status_code, timing, total_ms):
+        """
+        Add one request to the metrics of its route
+        :param method: HTTP method
+        :param route: path template of the route
+        :param status_code: status code of the response, 500 when the app raised
+        :param timing: dict of the db_ms, serialization_ms and rows of the request
+        :param total_ms: latency of the request
+        """
+
+        stats = self.routes.get((method, route))
+        if stats is None:
+            stats = self.routes[(method, route)] = {
+                'requests': 0, 'errors': 0, 'rows': 0, **{part: Histogram() for part in PARTS}
+            }
+        stats['requests'] += 1
+        stats['errors'] += int(status_code >= 500)
+        stats['rows'] += timing['rows']
+        stats['total'].add(total_ms)
+        stats['db'].add(timing['db_ms'])
+        stats['serialization'].add(timing['serialization_ms'])
+
+    def statistics(self):
+        """
+        Metrics of every route, most time consuming first
+        """
+
+        rows = []
+        for (method, route), stats in self.routes.items():
+            rows.append({
+                'route': route,
+                'method': method,
+                'requests': stats['requests'],
+                'errors': stats['errors'],
+                'rows': stats['rows'],
+                **{f'{part}_ms': stats[part].summary() for part in PARTS}
+            })
+        return sorted(rows, key=lambda row: self.routes[(row['method'], row['route'])]['total'].sum_ms, reverse=True)
+
+    def prometheus_text(self):
+        """
+        Metrics of every route in the Prometheus text exposition format, the latencies as summaries
+        """
+
+        lines = [
+            '# HELP nyt_api_requests_total Requests answered per route',
+            '# TYPE nyt_api_requests_total counter'
+        ]
+        routes = sorted(self.routes.items())
+        for (method, route), stats in routes:
+            lines.append(f'nyt_api_requests_total{{method="{method}",route="{route}"}} {stats["requests"]}')
+        lines += ['# HELP nyt_api_errors_total Requests answered with a 5xx status per route',
+                  '# TYPE nyt_api_errors_total counter']
+        for (method, route), stats in routes:
+            lines.append(f'nyt_api_errors_total{{method="{method}",route="{route}"}} {stats["errors"]}')
+        lines += ['# HELP nyt_api_rows_total Rows returned per route',
+                  '# TYPE nyt_api_rows_total counter']
+        for (method, route), stats in routes:
+            lines.append(f'nyt_api_rows_total{{method="{method}",route="{route}"}} {stats["rows"]}')
+        for part in PARTS:
+            metric = f'nyt_api_{part}_milliseconds'
+            lines += [f'# HELP {metric} Latency of the requests per route, {part} part',
+                      f'# TYPE {metric} summary']
+            for (method, route), stats in routes:
+                labels = f'method="{method}",route="{route}"'
+                histogram = stats[part]
+                for q in QUANTILES:
+                    value = histogram.quantile(q)
+                    lines.append(f'{metric}{{{labels},quantile="{q}"}} {"NaN" if value is None else round(value, 3)}')
+                lines.append(f'{metric}_sum{{{labels}}} {round(histogram.sum_ms, 3)}')
+                lines.append(f'{metric}_count{{{labels}}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+class SlowQueryLog:
+    """
+    Statements slower than a threshold, with their bound parameters and query plan
+    """
+
+    def __init__(self, api_name, threshold_ms=NYT_SLOW_QUERY_MS, directory=NYT_SLOW_QUERY_DIR, kept=SLOW_QUERIES_KEPT):
+        """
+        :param api_name: name of the API in the file name of the log, e.g. 'sqlite'
+        :param threshold_ms: minimum duration of a logged statement, 0 disables the log
+        :param directory: directory of the log file
+        :param kept: number of the last slow statements kept in memory
+        """
+
+        self.threshold_ms = threshold_ms
+        self.path = os.path.join(directory, f'slow_queries_{api_name}.jsonl')
+        self.recent = deque(maxlen=kept)
+        self.logged = 0
+
+    def is_slow(self, elapsed_ms):
+        """
+        True when a statement of this duration is logged
+        :param elapsed_ms: duration of the statement
+        """
+
+        return 0 < self.threshold_ms <= elapsed_ms
+
+    def log(self, query, statement, parameters, elapsed_ms, plan, path=None):
+        """
+        Log one slow statement. Called from the event loop or from a worker thread
+        :param query: name of the statement, e.g. a registered query or a MongoDB command
+        :param statement: SQL text or MongoDB command
+        :param parameters: bound parameters
+        :param elapsed_ms: duration of the statement
+        :param plan: query plan, EXPLAIN QUERY PLAN or explain() output
+        :param path: path of the request that ran it, None when unknown
+        """
+
+        entry = {
+            'time': datetime.now().isoformat(timespec='milliseconds'),
+            'path': path,
+            'query': query,
+            'ms': round(elapsed_ms, 3),
+            'statement': statement,
+            'parameters': parameters,
+            'plan': plan
+        }
+        self.recent.append(entry)
+        self.logged += 1
+        print(f"Slow query '{query}' {elapsed_ms:.1f} ms" + (f' in {path}' if path else ''))
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'a', encoding='utf8') as file:
+                file.write(json.dumps(entry, default=str, ensure_ascii=False) + '\n')
+        except OSError as e:
+            print(">>> A 'slow query log' exception : ", e, "\n")
+
+    def statistics(self):
+        """
+        Threshold, file and last entries of the log
+        """
+
+        return {
+            'threshold_ms': self.threshold_ms,
+            'file': self.path,
+            'logged': self.logged,
+            'recent': list(self.recent)
+        }
+
+
+metrics = RequestMetrics()
+
+
+def current_path():
+    """
+    Path of the request in progress, None outside of a request
+    """
+
+    timing = _current.get()
+    return None if timing is None else timing['path']
+
+
+def add_db_time(ms):
+    """
+    Add time spent waiting for the database to the request in progress
+    :param ms: milliseconds
+    """
+
+    timing = _current.get()
+    if timing is not None:
+        timing['db_ms'] += ms
+
+
+def add_rows(count):
+    """
+    Add rows returned to the request in progress
+    :param count: number of rows
+    """
+
+    timing = _current.get()
+    if timing is not None:
+        timing['rows'] += count
+
+
+@contextmanager
+def serialization_timer():
+    """
+    Add the time of the 'with' block to the serialization time of the request in progress
+    """
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing = _current.get()
+        if timing is not None:
+            timing['serialization_ms'] += (time.perf_counter() - start) * 1000
+
+
+async def record_request(request: Request, call_next):
+    """
+    Middleware: add every request to the metrics of its route, see the header of this module
+    """
+
+    timing = {'path': request.url.path, 'db_ms': 0.0, 'serialization_ms': 0.0, 'rows': 0}
+    token = _current.set(timing)
+    start = time.perf_counter()
+
+    def route_of(status_code):
+        # Set by the router once the route is matched. The unmatched paths are counted together,
+        # but for the 304 answered before the routing (see http_cache.py)
+        route = request.scope.get('route')
+        if route is not None:
+            return route.path
+        return request.url.path if status_code == 304 else '(unmatched)'
+
+    try:
+        response = await call_next(request)
+    except Exception:
+        metrics.record(request.method, route_of(500), 500, timing, (time.perf_counter() - start) * 1000)
+        raise
+    finally:
+        _current.reset(token)
+
+    body = response.body_iterator
+
+    async def recorded_body():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            metrics.record(request.method, route_of(response.status_code), response.status_code, timing, (time.perf_counter() - start) * 1000)
+
+    response.body_iterator = recorded_body()
+    return response
@@ -0,0 +1,169 @@
+import io
+import csv
+import json
+from datetime import date, datetime
+
+from fastapi import Request
+from fastapi.responses import JSONResponse, Response
+
+from api_common.request_metrics import add_rows, serialization_timer
+
+# Fast encoding of the query results, shared by the FastAPI apps.
+# - JSON is encoded with orjson when it is installed, otherwise with the json module,
+#   without going through FastAPI's jsonable_encoder
+# - the format of a list of rows is chosen by the 'Accept' header of the request:
+#   application/json (default), text/csv, application/x-ndjson, application/vnd.apache.arrow.stream
+#   (Arrow IPC stream, needs pyarrow)
+# - a Response returned by an endpoint is not validated against its response_model: rows_response()
+#   is only used by the trusted endpoints whose rows already have the documented shape
+# The responses are compressed by the GZipMiddleware of the apps when the client accepts gzip.
+# The encoding time and the rows returned are added to the metrics of the request (see request_metrics.py).
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+# Responses smaller than this are not compressed
+GZIP_MINIMUM_SIZE = 1024
+
+CSV_MEDIA_TYPE = 'text/csv'
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+ARROW_MEDIA_TYPE = 'application/vnd.apache.arrow.stream'
+
+
+def encode_default(value):
+    """
+    Encoding of the values unknown to JSON: dates in ISO format, anything else (e.g. ObjectId) as string
+    :param value: value to encode
+    """
+
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def dumps_json(content):
+    """
+    JSON encoding of the content, as bytes
+    :param content: content to encode
+    """
+
+    if orjson is not None:
+        return orjson.dumps(content, default=encode_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=encode_default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSONResponse encoded by dumps_json()
+    """
+
+    def render(self, content):
+        with serialization_timer():
+            return dumps_json(content)
+
+
+def rows_columns(rows):
+    """
+    Columns of the rows, in order of first appearance
+    :param rows: list of dicts
+    """
+
+    columns = {}
+    for row in rows:
+        for column in row:
+            columns.setdefault(column, None)
+    return list(columns)
+
+
+def rows_to_csv(rows):
+    """
+    CSV encoding of the rows, nested values (dicts, lists) encoded as JSON
+    :param rows: list of dicts
+    """
+
+    stream = io.StringIO()
+    writer = csv.writer(stream)
+    columns = rows_columns(rows)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([
+            dumps_json(value).decode('utf-8') if isinstance(value, (dict, list)) else value
+            for value in (row.get(column) for column in columns)
+        ])
+    return stream.getvalue().encode('utf-8')
+
+
+def rows_to_ndjson(rows):
+    """
+    NDJSON encoding of the rows: one JSON object per line
+    :param rows: list of dicts
+    """
+
+    return b''.join(dumps_json(row) + b'\n' for row in rows)
+
+
+def rows_to_arrow(rows):
+    """
+    Arrow IPC stream of the rows, as one record batch
+    :param rows: list of dicts
+    """
+
+    table = pyarrow.Table.from_pylist(rows)
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def requested_format(request: Request):
+    """
+    Media type of the response requested by the 'Accept' header, application/json by default
+    :param request: request of the endpoint
+    """
+
+    accept = request.headers.get('accept', '')
+    for media_type in (ARROW_MEDIA_TYPE, CSV_MEDIA_TYPE, NDJSON_MEDIA_TYPE):
+        if media_type in accept:
+            return media_type
+    return 'application/json'
+
+
+def rows_response(request: Request, rows, headers=None):
+    """
+    Response of a list of rows, in the format requested by the 'Accept' header
+    :param request: request of the endpoint
+    :param rows: list of dicts
+    :param headers: extra headers of the response
+    """
+
+    headers = dict(headers or {})
+    headers['Vary'] = 'Accept'
+    media_type = requested_format(request)
+    add_rows(len(rows))
+
+    if media_type == CSV_MEDIA_TYPE:
+        with serialization_timer():
+            content = rows_to_csv(rows)
+        return Response(content, media_type=CSV_MEDIA_TYPE, headers=headers)
+    if media_type == NDJSON_MEDIA_TYPE:
+        with serialization_timer():
+            content = rows_to_ndjson(rows)
+        return Response(content, media_type=NDJSON_MEDIA_TYPE, headers=headers)
+    if media_type == ARROW_MEDIA_TYPE:
+        if pyarrow is None:
+            return JSONResponse({'detail': 'Arrow responses need pyarrow'}, status_code=406)
+        try:
+            with serialization_timer():
+                content = rows_to_arrow(rows)
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError) as e:
+            return JSONResponse({'detail': f'Rows not convertible to Arrow: {e}'}, status_code=406)
+        return Response(content, media_type=ARROW_MEDIA_TYPE, headers=headers)
+    return FastJSONResponse(rows, headers=headers)
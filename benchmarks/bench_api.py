@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import importlib.util
+from collections import defaultdict
+
+import httpx
+
+from common import load_etl_modules, environment_info, ROOT_DIR, OUTPUT_DATA_DIR
+from generate_data import generate_archive
+
+# Load test of the FastAPI apps over a synthetic database:
+# 0_api (SQLite) or 1_api (MongoDB), in-process or under uvicorn,
+# with a mixed workload over every route published in /openapi.json.
+# The query parameters and the JSON bodies of the POST routes are filled from the OpenAPI schema,
+# with values read from the database; the routes with another kind of body (e.g. a form) are skipped.
+# Throughput and p50/p95/p99 latency per endpoint are written to a JSON file.
+
+load_etl_modules()
+import convert_data
+import mongo_indexes
+from bench_etl import bench_etl
+
+APPS = {
+    'sqlite': os.path.join(ROOT_DIR, '0_api'),
+    'mongo': os.path.join(ROOT_DIR, '1_api')
+}
+
+# Database and collection read by 1_api
+MONGO_API_DB_NAME = 'nyt_db_mongo'
+MONGO_API_COL_NAME = 'nyt_articles_coll'
+
+# Items of the arrays of the request bodies
+BODY_ITEMS = 5
+
+# Optional fields of the request bodies filled anyway, the other optional fields keep their defaults
+SAMPLED_FIELDS = ('author', 'authors', 'author_name', 'word', 'keyword', 'section', 'section_name', 'byline')
+
+
+def build_database(work_dir, months, articles_per_month, total_authors, seed, mongo_url=None):
+    """
+    Generate a synthetic archive and build the SQLite database with the ETL stages.
+    When mongo_url is set, the collection read by 1_api is filled too
+    Returns the path of the SQLite database
+    :param work_dir: directory for the generated files
+    :param months: number of monthly files
+    :param articles_per_month: articles per month
+    :param total_authors: size of the pool of authors
+    :param seed: seed of the random generator
+    :param mongo_url: MongoDB connection string or None
+    """
+
+    input_directory = os.path.join(work_dir, 'input_data')
+    generate_archive(input_directory, months=months, articles_per_month=articles_per_month,
+                     total_authors=total_authors, seed=seed)
+    bench_etl(work_dir)
+
+    if mongo_url:
+        fill_mongo(mongo_url, input_directory)
+
+    return os.path.join(work_dir, 'nyt_db.db')
+
+
+def fill_mongo(mongo_url, input_directory):
+    """
+    Insert the generated articles in the collection read by 1_api, replacing its content
+    :param mongo_url: MongoDB connection string
+    :param input_directory: directory with the generated JSON files
+    """
+
+    import pymongo
+
+    nyt_db = pymongo.MongoClient(mongo_url)[MONGO_API_DB_NAME]
+    nyt_articles_coll = nyt_db[MONGO_API_COL_NAME]
+    nyt_articles_coll.drop()
+
+    seen_ids = set()
+    for filename in sorted(os.listdir(input_directory)):
+        with open(os.path.join(input_directory, filename), encoding='utf8') as file:
+            docs = json.load(file)['response']['docs']
+        docs = [mongo_indexes.add_name_fields(convert_data.slim_document(doc, ['multimedia']))
+                for doc in docs if doc['_id'] not in seen_ids]
+        seen_ids.update(doc['_id'] for doc in docs)
+        if docs:
+            nyt_articles_coll.insert_many(docs)
+    convert_data.bump_content_version(nyt_db, MONGO_API_COL_NAME)
+    mongo_indexes.ensure_indexes(nyt_articles_coll)
+
+
+def load_samples(db_file, rng):
+    """
+    Values used to fill the query parameters, read from the SQLite database
+    :param db_file: SQLite database
+    :param rng: random.Random instance
+    """
+
+    conn = sqlite3.connect(db_file)
+    samples = {
+        'authors': [row[0] for row in conn.execute('SELECT author_name FROM author')],
+        'sections': [row[0] for row in conn.execute('SELECT DISTINCT section_name FROM article WHERE section_name IS NOT NULL')],
+        'keywords': [row[0] for row in conn.execute('SELECT value FROM keyword')],
+        'words': sorted({word for row in conn.execute('SELECT headline_main FROM article LIMIT 1000')
+                         for word in str(row[0]).lower().split() if len(word) > 3})
+    }
+    conn.close()
+
+    for key in samples:
+        rng.shuffle(samples[key])
+        samples[key] = samples[key][:500] or ['a']
+    return samples
+
+
+def param_value(name, app, samples, rng):
+    """
+    Value of one query parameter, chosen by its name
+    :param name: name of the query parameter
+    :param app: 'sqlite' or 'mongo'
+    :param samples: values read from the database
+    :param rng: random.Random instance
+    """
+
+    if name == 'author':
+        tokens = rng.choice(samples['authors']).split()
+        # 1_api searches the first name, 0_api any part of the name
+        return tokens[0] if app == 'mongo' else tokens[-1]
+    if name in ('authors', 'author_name'):
+        return rng.choice(samples['authors'])
+    if name == 'word':
+        return rng.choice(samples['words'])
+    if name == 'keyword':
+        return rng.choice(samples['keywords'])
+    if name in ('section', 'section_name'):
+        return rng.choice(samples['sections'])
+    if name == 'byline':
+        return 'By ' + rng.choice(samples['authors'])
+    return ' '.join(rng.choice(samples['words']) for _ in range(6))
+
+
+def body_value(schema, schemas, name, app, samples, rng):
+    """
+    Value of a request body, or of one of its fields, built from its JSON schema
+    :param schema: JSON schema of the value
+    :param schemas: schemas of the components of /openapi.json, to resolve the references
+    :param name: name of the field, '' for the body itself
+    :param app: 'sqlite' or 'mongo'
+    :param samples: values read from the database
+    :param rng: random.Random instance
+    """
+
+    if '$ref' in schema:
+        schema = schemas[schema['$ref'].rsplit('/', 1)[-1]]
+    kind = schema.get('type')
+    if kind == 'object':
+        required = schema.get('required', [])
+        return {
+            field: body_value(field_schema, schemas, field, app, samples, rng)
+            for field, field_schema in schema.get('properties', {}).items()
+            if field in required or field in SAMPLED_FIELDS
+        }
+    if kind == 'array':
+        return [body_value(schema.get('items', {}), schemas, name, app, samples, rng) for _ in range(BODY_ITEMS)]
+    if kind == 'integer':
+        return rng.randint(schema.get('minimum', 1), schema.get('maximum', 1000))
+    if kind == 'number':
+        return rng.uniform(schema.get('minimum', 0), schema.get('maximum', 1000))
+    if kind == 'boolean':
+        return rng.random() < 0.5
+    return param_value(name, app, samples, rng)
+
+
+def discover_routes(openapi, read_only=False):
+    """
+    Routes published by the app, with their query parameters and the schema of their JSON body.
+    The routes whose body is not JSON are skipped
+    :param openapi: content of /openapi.json
+    :param read_only: skip the POST routes
+    """
+
+    routes = []
+    for path, methods in openapi['paths'].items():
+        for method, operation in methods.items():
+            if method not in ('get', 'post') or (read_only and method == 'post'):
+                continue
+            content = operation.get('requestBody', {}).get('content')
+            if content and 'application/json' not in content:
+                print(f'Skipped {method.upper()} {path}: body {", ".join(content)} not generated')
+                continue
+            params = [
+                (param['name'], param.get('required', False))
+                for param in operation.get('parameters', [])
+                if param.get('in') == 'query'
+            ]
+            body = content['application/json']['schema'] if content else None
+            routes.append({'method': method.upper(), 'path': path, 'params': params, 'body': body, 'weight': 1.0})
+    return routes
+
+
+def apply_mix(routes, mix):
+    """
+    Change the weight of the routes from a string like '/author=5,/count_pairs_authors_collaboration=0.5'
+    :param routes: routes discovered in the app
+    :param mix: endpoint mix, weight 1 for the routes not listed
+    """
+
+    if not mix:
+        return routes
+    weights = {}
+    for item in mix.split(','):
+        path, _, weight = item.partition('=')
+        weights[path.strip()] = float(weight)
+    for route in routes:
+        route['weight'] = weights.get(route['path'], route['weight'])
+    return [route for route in routes if route['weight'] > 0]
+
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile of a sorted list
+    """
+
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+async def run_workload(client, routes, schemas, app, samples, rng, concurrency, total_requests, duration):
+    """
+    Send requests from `concurrency` workers until total_requests are sent or duration seconds pass
+    Returns the latencies in ms and the errors per route, and the elapsed time
+    """
+
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    weights = [route['weight'] for route in routes]
+    state = {'sent': 0}
+    deadline = time.perf_counter() + duration if duration else None
+
+    async def worker():
+        while True:
+            if total_requests and state['sent'] >= total_requests:
+                return
+            if deadline and time.perf_counter() >= deadline:
+                return
+            state['sent'] += 1
+
+            route = rng.choices(routes, weights=weights)[0]
+            params = {
+                name: param_value(name, app, samples, rng)
+                for name, required in route['params']
+                if required or name in ('author', 'word', 'keyword', 'section')
+            }
+            body = None if route['body'] is None else body_value(route['body'], schemas, '', app, samples, rng)
+            key = f"{route['method']} {route['path']}"
+
+            start = time.perf_counter()
+            try:
+                response = await client.request(route['method'], route['path'], params=params, json=body)
+                failed = response.status_code >= 400
+            except httpx.HTTPError:
+                failed = True
+            latencies[key].append((time.perf_counter() - start) * 1000)
+            if failed:
+                errors[key] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return latencies, errors, time.perf_counter() - start
+
+
+def summarize(latencies, errors, elapsed):
+    """
+    Throughput and latency percentiles per endpoint and in total
+    """
+
+    def stats(values, total_errors):
+        values = sorted(values)
+        return {
+            'requests': len(values),
+            'errors': total_errors,
+            'throughput_rps': round(len(values) / elapsed, 1) if elapsed else None,
+            'p50_ms': round(percentile(values, 0.50), 2) if values else None,
+            'p95_ms': round(percentile(values, 0.95), 2) if values else None,
+            'p99_ms': round(percentile(values, 0.99), 2) if values else None,
+            'max_ms': round(values[-1], 2) if values else None
+        }
+
+    endpoints = {key: stats(values, errors.get(key, 0)) for key, values in sorted(latencies.items())}
+    all_values = [value for values in latencies.values() for value in values]
+    return endpoints, stats(all_values, sum(errors.values()))
+
+
+def load_app(app):
+    """
+    Import main.py of one app with its own module name, so both apps can be loaded
+    :param app: 'sqlite' or 'mongo'
+    """
+
+    app_dir = APPS[app]
+    if app_dir not in sys.path:
+        sys.path.insert(0, app_dir)
+    spec = importlib.util.spec_from_file_location(f'{app}_api_main', os.path.join(app_dir, 'main.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.app
+
+
+async def bench_inprocess(app, args, samples, rng):
+    """
+    Run the workload against the app in the same process, through its ASGI interface
+    """
+
+    asgi_app = load_app(app)
+    async with asgi_app.router.lifespan_context(asgi_app):
+        transport = httpx.ASGITransport(app=asgi_app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=args.timeout) as client:
+            openapi = (await client.get('/openapi.json')).json()
+            routes = apply_mix(discover_routes(openapi, args.read_only), args.mix)
+            schemas = openapi.get('components', {}).get('schemas', {})
+            if args.warmup:
+                await run_workload(client, routes, schemas, app, samples, rng, args.concurrency, args.warmup, None)
+            return await run_workload(client, routes, schemas, app, samples, rng,
+                                      args.concurrency, args.requests, args.duration)
+
+
+async def bench_uvicorn(app, args, samples, rng, env):
+    """
+    Run the workload against the app served by uvicorn in a child process
+    """
+
+    command = [sys.executable, '-m', 'uvicorn', 'main:app', '--host', '127.0.0.1',
+               '--port', str(args.port), '--workers', str(args.workers), '--log-level', 'warning']
+    server = subprocess.Popen(command, cwd=APPS[app], env=env)
+    base_url = f'http://127.0.0.1:{args.port}'
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+            for _ in range(100):
+                try:
+                    openapi = (await client.get('/openapi.json')).json()
+                    break
+                except httpx.HTTPError:
+                    await asyncio.sleep(0.2)
+            else:
+                raise SystemExit(f'>>> uvicorn did not start on {base_url}')
+
+            routes = apply_mix(discover_routes(openapi, args.read_only), args.mix)
+            schemas = openapi.get('components', {}).get('schemas', {})
+            if args.warmup:
+                await run_workload(client, routes, schemas, app, samples, rng, args.concurrency, args.warmup, None)
+            return await run_workload(client, routes, schemas, app, samples, rng,
+                                      args.concurrency, args.requests, args.duration)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    """
+    Build a synthetic database and load test one of the APIs
+    """
+
+    parser = argparse.ArgumentParser(description='Load test the FastAPI apps over a synthetic database')
+    parser.add_argument('--app', choices=sorted(APPS), default='sqlite', help='sqlite: 0_api, mongo: 1_api')
+    parser.add_argument('--mode', choices=['inprocess', 'uvicorn'], default='inprocess')
+    parser.add_argument('--workers', type=int, default=1, help='uvicorn workers')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent clients')
+    parser.add_argument('--requests', type=int, default=2000, help='total requests, 0 to run for --duration')
+    parser.add_argument('--duration', type=float, default=None, help='seconds to run')
+    parser.add_argument('--warmup', type=int, default=100, help='requests sent before measuring')
+    parser.add_argument('--timeout', type=float, default=120.0, help='request timeout in seconds')
+    parser.add_argument('--mix', default=None,
+                        help="weights per endpoint, e.g. '/author=5,/count_pairs_authors_collaboration=0.5'")
+    parser.add_argument('--read-only', action='store_true', help='skip the POST endpoints')
+    parser.add_argument('--db', default=None, help='existing SQLite database instead of building a synthetic one')
+    parser.add_argument('--scale', type=int, default=1, help='multiplier of the articles per month')
+    parser.add_argument('--months', type=int, default=3)
+    parser.add_argument('--articles-per-month', type=int, default=1000, help='articles per month at scale 1')
+    parser.add_argument('--authors', type=int, default=1000, help='size of the pool of authors')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--mongo-url', default=None, help='local mongod filled for 1_api')
+    parser.add_argument('--output', default=None, help='JSON file with the results')
+    args = parser.parse_args()
+    if not args.requests and not args.duration:
+        # The workers would never stop
+        parser.error('--requests 0 needs --duration')
+
+    rng = random.Random(args.seed)
+    work_dir = tempfile.mkdtemp(prefix='nyt_bench_api_')
+    output_file = args.output or os.path.join(OUTPUT_DATA_DIR, f'benchmark_api_{args.app}_{args.scale}x.json')
+
+    try:
+        db_file = args.db or build_database(work_dir, args.months, args.articles_per_month * args.scale,
+                                            args.authors, args.seed, args.mongo_url)
+        db_file = os.path.abspath(db_file)
+        samples = load_samples(db_file, rng)
+
+        env = dict(os.environ, NYT_DB_PATH=db_file)
+        os.environ['NYT_DB_PATH'] = db_file
+        if args.mongo_url:
+            env['NYT_MONGODB_URL'] = os.environ['NYT_MONGODB_URL'] = args.mongo_url
+
+        if args.mode == 'inprocess':
+            latencies, errors, elapsed = asyncio.run(bench_inprocess(args.app, args, samples, rng))
+        else:
+            latencies, errors, elapsed = asyncio.run(bench_uvicorn(args.app, args, samples, rng, env))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    endpoints, total = summarize(latencies, errors, elapsed)
+
+    print(f"{'endpoint':<70} {'req':>6} {'err':>5} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for key, row in list(endpoints.items()) + [('TOTAL', total)]:
+        print(f"{key:<70} {row['requests']:>6} {row['errors']:>5} {row['throughput_rps']:>8} "
+              f"{row['p50_ms']:>8} {row['p95_ms']:>8} {row['p99_ms']:>8}")
+
+    report = {
+        'benchmark': 'api',
+        'app': args.app,
+        'mode': args.mode,
+        'scale': args.scale,
+        'params': {
+            'workers': args.workers,
+            'concurrency': args.concurrency,
+            'requests': args.requests,
+            'duration': args.duration,
+            'mix': args.mix,
+            'read_only': args.read_only,
+            'months': args.months,
+            'articles_per_month': args.articles_per_month * args.scale,
+            'authors': args.authors
+        },
+        'environment': environment_info(),
+        'elapsed_s': round(elapsed, 3),
+        'total': total,
+        'endpoints': endpoints
+    }
+
+    with open(output_file, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Results saved to {output_file}")
+
+
+if __name__ == '__main__':
+    main()
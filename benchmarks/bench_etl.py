@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import pandas as pd
+
+from common import load_etl_modules, run_stage, environment_info, OUTPUT_DATA_DIR
+from generate_data import generate_archive
+
+# Benchmark of the ETL stages over a synthetic archive:
+# json_to_csv (MongoDB), the create_df_* transforms and the create_table_* loads (SQLite).
+# Wall time, CPU time, rows and peak RSS of every stage are written to a JSON file,
+# run it at --scale 1, 10 and 100 to compare changes.
+
+load_etl_modules()
+import convert_data
+import create_db
+
+
+def mongo_client(mongo_url):
+    """
+    Client of a local mongod when mongo_url is set, otherwise of the in-process stand-in mongomock
+    :param mongo_url: MongoDB connection string or None
+    """
+
+    if mongo_url:
+        import pymongo
+        return pymongo.MongoClient(mongo_url)
+
+    try:
+        import mongomock
+    except ImportError:
+        raise SystemExit(">>> Set --mongo-url or install mongomock to run the 'json_to_csv' stage")
+    return mongomock.MongoClient()
+
+
+def bench_etl(work_dir, mongo_url=None):
+    """
+    Run every stage of convert_data and create_db over the JSON files in work_dir/input_data
+    Returns the list of measures
+    :param work_dir: directory with the input_data directory, results of the stages are written there
+    :param mongo_url: MongoDB connection string, None for the in-process stand-in
+    """
+
+    results = []
+    input_directory = os.path.join(work_dir, 'input_data')
+    csv_file = os.path.join(work_dir, 'extracted_data.csv')
+    db_file = os.path.join(work_dir, 'nyt_db.db')
+
+    # Convert: start from an empty collection
+    client = mongo_client(mongo_url)
+    client.drop_database(convert_data.MONGODB_NYT_DB_NAME)
+    run_stage(results, 'json_to_csv', convert_data.json_to_csv, input_directory, csv_file, client)
+    client.drop_database(convert_data.MONGODB_NYT_DB_NAME)
+
+    # Create DB: transforms
+    df_Ar = run_stage(results, 'read_csv', pd.read_csv, csv_file, low_memory=False)
+    rows = len(df_Ar)
+    df_Ar = run_stage(results, 'create_df_article', create_db.create_df_article, df_Ar, rows_in=rows)
+    df_Ar_Au = run_stage(results, 'create_df_article_author', create_db.create_df_article_author,
+                         pd.DataFrame(), df_Ar, rows_in=len(df_Ar))
+    df_Au = run_stage(results, 'create_df_author', create_db.create_df_author,
+                      pd.DataFrame(), df_Ar_Au, rows_in=len(df_Ar_Au))
+    df_Ar_Au = run_stage(results, 'modify_df_article_author', create_db.modify_df_article_author,
+                         df_Ar_Au, df_Au, rows_in=len(df_Ar_Au))
+    df_Ar_Kw = run_stage(results, 'create_df_article_keyword', create_db.create_df_article_keyword,
+                         pd.DataFrame(), df_Ar, rows_in=len(df_Ar))
+    df_Kw = run_stage(results, 'create_df_keyword', create_db.create_df_keyword,
+                      pd.DataFrame(), df_Ar_Kw, rows_in=len(df_Ar_Kw))
+    df_Ar_Kw = run_stage(results, 'modify_df_article_keyword', create_db.modify_df_article_keyword,
+                         df_Ar_Kw, df_Kw, rows_in=len(df_Ar_Kw))
+    df_Ar = df_Ar.drop('keywords', axis=1, errors='ignore')
+
+    # Create DB: loads
+    if os.path.exists(db_file):
+        os.remove(db_file)
+    conn = sqlite3.connect(db_file)
+    for name, func, df in [
+        ('create_table_article', create_db.create_table_article, df_Ar),
+        ('create_table_author', create_db.create_table_author, df_Au),
+        ('create_table_article_author', create_db.create_table_article_author, df_Ar_Au),
+        ('create_table_keyword', create_db.create_table_keyword, df_Kw),
+        ('create_table_article_keyword', create_db.create_table_article_keyword, df_Ar_Kw)
+    ]:
+        run_stage(results, name, func, conn, df, rows_in=len(df), rows_out=len(df))
+    conn.close()
+
+    return results
+
+
+def main():
+    """
+    Generate a synthetic archive at the requested scale and benchmark the ETL stages
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark the ETL stages over a synthetic NYT archive')
+    parser.add_argument('--scale', type=int, default=1, help='multiplier of the articles per month (1, 10, 100)')
+    parser.add_argument('--months', type=int, default=3)
+    parser.add_argument('--articles-per-month', type=int, default=1000, help='articles per month at scale 1')
+    parser.add_argument('--authors', type=int, default=1000, help='size of the pool of authors')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--mongo-url', default=None, help='local mongod, by default the in-process stand-in mongomock')
+    parser.add_argument('--work-dir', default=None, help='directory for the generated files, by default a temporary one')
+    parser.add_argument('--output', default=None, help='JSON file with the results')
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='nyt_bench_')
+    output_file = args.output or os.path.join(OUTPUT_DATA_DIR, f'benchmark_etl_{args.scale}x.json')
+    articles_per_month = args.articles_per_month * args.scale
+
+    results = []
+    try:
+        run_stage(results, 'generate_data', generate_archive, os.path.join(work_dir, 'input_data'),
+                  months=args.months, articles_per_month=articles_per_month,
+                  total_authors=args.authors, seed=args.seed, rows_out=args.months * articles_per_month)
+        results += bench_etl(work_dir, args.mongo_url)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'benchmark': 'etl',
+        'scale': args.scale,
+        'params': {
+            'months': args.months,
+            'articles_per_month': articles_per_month,
+            'authors': args.authors,
+            'seed': args.seed,
+            'mongo': 'mongod' if args.mongo_url else 'mongomock'
+        },
+        'environment': environment_info(),
+        'stages': results
+    }
+
+    with open(output_file, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Results saved to {output_file}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import platform
+import importlib.util
+import importlib.machinery
+from datetime import datetime, timezone
+
+# Shared helpers of the benchmark scripts:
+# importing the ETL modules and measuring wall time, CPU time and peak RSS of one stage
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+ETL_DIR = os.path.join(ROOT_DIR, 'etl')
+OUTPUT_DATA_DIR = os.path.join(ROOT_DIR, 'output_data')
+
+sys.path.append(ETL_DIR)
+from metrics import reset_peak_rss, peak_rss_bytes
+
+
+def load_etl_modules():
+    """
+    Make the ETL scripts importable.
+    When etl/config_vars.py was not created yet, the sample configuration is used
+    """
+
+    if 'config_vars' not in sys.modules and not os.path.exists(os.path.join(ETL_DIR, 'config_vars.py')):
+        sample_path = os.path.join(ETL_DIR, 'config_vars.py_sample')
+        loader = importlib.machinery.SourceFileLoader('config_vars', sample_path)
+        spec = importlib.util.spec_from_loader('config_vars', loader)
+        config_vars = importlib.util.module_from_spec(spec)
+        loader.exec_module(config_vars)
+        sys.modules['config_vars'] = config_vars
+
+
+def run_stage(results, name, func, *args, rows_in=None, rows_out=None, **kwargs):
+    """
+    Run one stage, append its measures to results and return the result of the stage
+    :param results: list of the measures of the stages
+    :param name: name of the stage
+    :param func: function of the stage
+    :param rows_in: number of rows the stage reads
+    :param rows_out: number of rows the stage writes, by default len() of the result
+    """
+
+    reset_peak_rss()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    result = func(*args, **kwargs)
+
+    wall_s = time.perf_counter() - wall_start
+    cpu_s = time.process_time() - cpu_start
+
+    if rows_out is None and hasattr(result, '__len__'):
+        rows_out = len(result)
+
+    results.append({
+        'stage': name,
+        'wall_s': round(wall_s, 4),
+        'cpu_s': round(cpu_s, 4),
+        'rows_in': rows_in,
+        'rows_out': rows_out,
+        'rows_per_s': round((rows_out or rows_in or 0) / wall_s, 1) if wall_s > 0 else None,
+        'peak_rss_mb': round(peak_rss_bytes() / 2**20, 1)
+    })
+    print(f"{name:<32} {wall_s:>9.3f} s  {results[-1]['peak_rss_mb']:>8} MB")
+
+    return result
+
+
+def environment_info():
+    """
+    Description of the machine running the benchmark, stored with the results
+    """
+
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count()
+    }
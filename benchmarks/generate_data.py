@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import uuid
+import random
+import argparse
+import calendar
+from datetime import datetime
+
+# Generates synthetic NYT Archive API responses, one file per month,
+# with the same structure and file name (NYT_<year>_<month>.json) that extract_data.sh writes.
+# No API key and no rate limits, so the pipeline can be tested at any scale.
+
+FIRST_NAMES = [
+    'Paul', 'Jane', 'John', 'Maria', 'David', 'Sarah', 'Michael', 'Emily', 'James', 'Anna',
+    'Robert', 'Laura', 'Daniel', 'Rachel', 'Thomas', 'Julia', 'Peter', 'Claire', 'Kevin', 'Sofia',
+    'Ahmed', 'Mei', 'Carlos', 'Ingrid', 'Kwame', 'Yuki', 'Pablo', 'Nadia', 'Lars', 'Priya'
+]
+
+LAST_NAMES = [
+    'Krugman', 'Smith', 'Johnson', 'Garcia', 'Chen', 'Williams', 'Brown', 'Miller', 'Davis', 'Lopez',
+    'Wilson', 'Anderson', 'Taylor', 'Thomas', 'Moore', 'Martin', 'Lee', 'Thompson', 'White', 'Harris',
+    'Clark', 'Lewis', 'Robinson', 'Walker', 'Young', 'Hall', 'Allen', 'King', 'Wright', 'Scott',
+    'Nguyen', 'Hill', 'Green', 'Adams', 'Baker', 'Nelson', 'Carter', 'Mitchell', 'Perez', 'Roberts'
+]
+
+MIDDLE_INITIALS = ['A.', 'B.', 'C.', 'D.', 'E.', 'J.', 'M.', 'R.', 'S.', 'W.']
+
+# (section_name, news_desk, weight)
+SECTIONS = [
+    ('U.S.', 'National', 14), ('World', 'Foreign', 14), ('Opinion', 'OpEd', 10),
+    ('Business Day', 'Business', 9), ('New York', 'Metro', 8), ('Arts', 'Culture', 8),
+    ('Sports', 'Sports', 7), ('Technology', 'Business', 4), ('Science', 'Science', 3),
+    ('Health', 'Science', 3), ('Style', 'Styles', 3), ('Food', 'Dining', 3),
+    ('Books', 'BookReview', 3), ('Travel', 'Travel', 2), ('Movies', 'Culture', 2),
+    ('Magazine', 'Magazine', 2), ('Real Estate', 'RealEstate', 2), ('Briefing', 'NYTNow', 3)
+]
+
+# (type_of_material, document_type, weight, median word count)
+MATERIALS = [
+    ('News', 'article', 60, 1100), ('Op-Ed', 'article', 8, 900), ('Review', 'article', 6, 1000),
+    ('Letter', 'article', 4, 250), ('Obituary (Obit)', 'article', 3, 1000), ('Briefing', 'article', 5, 1800),
+    ('Interactive Feature', 'multimedia', 7, 0), ('Video', 'multimedia', 4, 0), ('News Analysis', 'article', 3, 1400)
+]
+
+KEYWORD_NAMES = ['subject', 'persons', 'glocations', 'organizations', 'creative_works']
+
+KEYWORD_VALUES = {
+    'subject': ['United States Economy', 'Labor and Jobs', 'Coronavirus (2019-nCoV)', 'Elections',
+                'Vaccination and Immunization', 'Climate Change', 'Computers and the Internet',
+                'Real Estate and Housing (Residential)', 'Books and Literature', 'Immigration and Emigration',
+                'Stocks and Bonds', 'Baseball', 'Basketball', 'Movies', 'Restaurants'],
+    'persons': ['Biden, Joseph R Jr', 'Trump, Donald J', 'Harris, Kamala D', 'Putin, Vladimir V',
+                'Musk, Elon', 'Powell, Jerome H', 'Adams, Eric L', 'Zelensky, Volodymyr'],
+    'glocations': ['New York City', 'Washington (DC)', 'China', 'Ukraine', 'California', 'Europe', 'Texas'],
+    'organizations': ['Federal Reserve System', 'Congress', 'Supreme Court (US)', 'Apple Inc',
+                      'United Nations', 'Democratic Party', 'Republican Party'],
+    'creative_works': ['The Crown (TV Program)', 'Barbie (Movie)', 'Succession (TV Program)']
+}
+
+WORDS = [
+    'city', 'plan', 'market', 'vote', 'court', 'season', 'storm', 'deal', 'war', 'school', 'virus',
+    'election', 'economy', 'album', 'film', 'strike', 'budget', 'team', 'health', 'climate', 'home',
+    'policy', 'leader', 'crisis', 'report', 'future', 'night', 'family', 'world', 'street', 'price'
+]
+
+
+def create_author_pool(rng, total_authors):
+    """
+    Create the pool of authors as (firstname, middlename, lastname) tuples.
+    Every name is unique
+    :param rng: random.Random instance
+    :param total_authors: number of authors in the pool
+    """
+
+    authors = []
+    seen = set()
+    while len(authors) < total_authors:
+        firstname = rng.choice(FIRST_NAMES)
+        middlename = rng.choice(MIDDLE_INITIALS) if rng.random() < 0.2 else None
+        lastname = rng.choice(LAST_NAMES)
+        # Double-barrelled surname when the combination is taken
+        if (firstname, middlename, lastname) in seen:
+            lastname = f'{lastname}-{rng.choice(LAST_NAMES)}'
+        if (firstname, middlename, lastname) not in seen:
+            seen.add((firstname, middlename, lastname))
+            authors.append((firstname, middlename, lastname))
+    return authors
+
+
+def author_name(author):
+    """
+    Full name of an author, as written in the byline
+    :param author: (firstname, middlename, lastname) tuple
+    """
+
+    return ' '.join(part for part in author if part)
+
+
+def create_byline(rng, authors, author_weights):
+    """
+    Create the 'byline' field with the patterns found in the archive:
+    'By X', 'By X and Y', 'By X, Y and Z', 'By X for The New York Times', 'Photographs by X', ...
+    :param rng: random.Random instance
+    :param authors: pool of authors
+    :param author_weights: cumulative weights of the authors, a few authors write most of the articles
+    """
+
+    pattern = rng.random()
+    if pattern < 0.05:
+        return {'original': None, 'person': [], 'organization': None}
+    if pattern < 0.07:
+        return {'original': 'By The Associated Press', 'person': [], 'organization': 'The Associated Press'}
+
+    if pattern < 0.62:
+        total_persons = 1
+    elif pattern < 0.82:
+        total_persons = 2
+    elif pattern < 0.90:
+        total_persons = 3
+    else:
+        total_persons = 1
+
+    persons = []
+    while len(persons) < total_persons:
+        person = rng.choices(authors, cum_weights=author_weights)[0]
+        if person not in persons:
+            persons.append(person)
+    names = [author_name(person) for person in persons]
+
+    if total_persons == 1:
+        names_text = names[0]
+    else:
+        names_text = ', '.join(names[:-1]) + ' and ' + names[-1]
+
+    if pattern < 0.90:
+        original = f'By {names_text}'
+        if rng.random() < 0.12:
+            original += rng.choice([' for The New York Times', ' For The New York Times'])
+    elif pattern < 0.94:
+        original = f'Photographs by {names_text}'
+    elif pattern < 0.97:
+        original = f'Compiled by {names_text}'
+    else:
+        original = f'Text by {names_text}'
+
+    return {
+        'original': original,
+        'person': [
+            {
+                'firstname': firstname,
+                'middlename': middlename,
+                'lastname': lastname,
+                'qualifier': None,
+                'title': None,
+                'role': 'reported',
+                'organization': '',
+                'rank': rank
+            }
+            for rank, (firstname, middlename, lastname) in enumerate(persons, start=1)
+        ],
+        'organization': None
+    }
+
+
+def create_article(rng, year, month, authors, author_weights):
+    """
+    Create one article with the structure of the NYT Archive API
+    :param rng: random.Random instance
+    :param year: publication year
+    :param month: publication month
+    :param authors: pool of authors
+    :param author_weights: cumulative weights of the authors
+    """
+
+    section_name, news_desk, _ = rng.choices(SECTIONS, weights=[s[2] for s in SECTIONS])[0]
+    type_of_material, document_type, _, median_words = rng.choices(MATERIALS, weights=[m[2] for m in MATERIALS])[0]
+
+    day = rng.randint(1, calendar.monthrange(year, month)[1])
+    pub_date = datetime(year, month, day, rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59))
+    article_uuid = uuid.UUID(int=rng.getrandbits(128), version=4)
+    slug = '-'.join(rng.sample(WORDS, 4))
+
+    headline = ' '.join(rng.sample(WORDS, rng.randint(4, 8))).capitalize()
+    abstract = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(12, 30))).capitalize() + '.'
+    lead_paragraph = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(30, 70))).capitalize() + '.'
+
+    word_count = int(rng.lognormvariate(0, 0.5) * median_words) if median_words else 0
+
+    keyword_names = rng.sample(KEYWORD_NAMES, rng.randint(1, 4))
+    keywords = []
+    for name in keyword_names:
+        for value in rng.sample(KEYWORD_VALUES[name], min(len(KEYWORD_VALUES[name]), rng.randint(1, 3))):
+            keywords.append({'name': name, 'value': value, 'rank': len(keywords) + 1, 'major': 'N'})
+
+    image_path = f'images/{year}/{month:02d}/{day:02d}/{news_desk.lower()}/{slug}'
+    multimedia = [
+        {
+            'rank': 0, 'subtype': crop, 'caption': None, 'credit': None, 'type': 'image',
+            'url': f'{image_path}/{slug}-{crop}.jpg', 'height': height, 'width': width,
+            'legacy': {}, 'subType': crop, 'crop_name': crop
+        }
+        for crop, height, width in [('xlarge', 400, 600), ('jumbo', 683, 1024), ('superJumbo', 1366, 2048),
+                                    ('thumbnail', 75, 75), ('thumbLarge', 150, 150)][:rng.randint(0, 5)]
+    ]
+
+    in_print = document_type == 'article' and rng.random() < 0.6
+
+    return {
+        'abstract': abstract,
+        'web_url': f'https://www.nytimes.com/{year}/{month:02d}/{day:02d}/{section_name.lower().replace(" ", "-")}/{slug}.html',
+        'snippet': abstract if rng.random() < 0.7 else headline + '.',
+        'lead_paragraph': lead_paragraph,
+        'print_section': rng.choice(['A', 'B', 'C', 'D', 'MB']) if in_print else None,
+        'print_page': str(rng.randint(1, 30)) if in_print else None,
+        'source': 'The New York Times',
+        'multimedia': multimedia,
+        'headline': {
+            'main': headline,
+            'kicker': None,
+            'content_kicker': None,
+            'print_headline': headline if in_print else '',
+            'name': None,
+            'seo': None,
+            'sub': None
+        },
+        'keywords': keywords,
+        'pub_date': pub_date.strftime('%Y-%m-%dT%H:%M:%S+0000'),
+        'document_type': document_type,
+        'news_desk': news_desk,
+        'section_name': section_name,
+        'byline': create_byline(rng, authors, author_weights),
+        'type_of_material': type_of_material,
+        '_id': f'nyt://{document_type}/{article_uuid}',
+        'word_count': word_count,
+        'uri': f'nyt://{document_type}/{article_uuid}'
+    }
+
+
+def generate_archive(output_directory, start_year=2021, start_month=1, months=12,
+                     articles_per_month=4000, total_authors=3000, duplicate_rate=0.01, seed=42):
+    """
+    Write one NYT_<year>_<month>.json file per month in the output directory
+    Returns the list of written files
+    :param output_directory: directory where JSON files are written
+    :param start_year: year of the first month
+    :param start_month: first month
+    :param months: number of months to generate
+    :param articles_per_month: number of articles per month
+    :param total_authors: size of the pool of authors
+    :param duplicate_rate: fraction of the articles of the previous month repeated in the next one,
+                           as the archive does at month boundaries
+    :param seed: seed of the random generator, the same seed gives the same files
+    """
+
+    rng = random.Random(seed)
+    os.makedirs(output_directory, exist_ok=True)
+
+    authors = create_author_pool(rng, total_authors)
+
+    # Zipf-like distribution of articles per author
+    author_weights = []
+    cumulative = 0.0
+    for rank in range(1, len(authors) + 1):
+        cumulative += 1.0 / rank ** 0.8
+        author_weights.append(cumulative)
+
+    written_files = []
+    previous_docs = []
+    year, month = start_year, start_month
+    for _ in range(months):
+        docs = [create_article(rng, year, month, authors, author_weights) for _ in range(articles_per_month)]
+
+        # Overlap with the previous month
+        total_duplicates = min(len(previous_docs), int(articles_per_month * duplicate_rate))
+        docs.extend(rng.sample(previous_docs, total_duplicates))
+
+        archive = {
+            'copyright': 'Copyright (c) The New York Times Company. All Rights Reserved.',
+            'response': {
+                'docs': docs,
+                'meta': {'hits': len(docs)}
+            }
+        }
+
+        json_file = os.path.join(output_directory, f'NYT_{year}_{month}.json')
+        with open(json_file, 'w', encoding='utf8') as file:
+            json.dump(archive, file)
+        written_files.append(json_file)
+
+        previous_docs = docs[:articles_per_month]
+        month += 1
+        if month > 12:
+            year, month = year + 1, 1
+
+    return written_files
+
+
+def main():
+    """
+    Generate synthetic NYT Archive JSON files
+    """
+
+    parser = argparse.ArgumentParser(description='Generate synthetic NYT Archive API JSON files')
+    parser.add_argument('--output-dir', default='../input_data', help='directory where JSON files are written')
+    parser.add_argument('--start-year', type=int, default=2021)
+    parser.add_argument('--start-month', type=int, default=1)
+    parser.add_argument('--months', type=int, default=12, help='number of monthly files')
+    parser.add_argument('--articles-per-month', type=int, default=4000)
+    parser.add_argument('--authors', type=int, default=3000, help='size of the pool of authors')
+    parser.add_argument('--duplicate-rate', type=float, default=0.01,
+                        help='fraction of the previous month articles repeated in the next month')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    written_files = generate_archive(args.output_dir, args.start_year, args.start_month, args.months,
+                                     args.articles_per_month, args.authors, args.duplicate_rate, args.seed)
+    for json_file in written_files:
+        print(json_file)
+
+
+if __name__ == '__main__':
+    main()
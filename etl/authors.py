@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import re
+
+# Rules cleaning the 'byline_original' of an article into a comma separated list of authors.
+# Used by create_db.py on the whole 'article' DataFrame and by the API ingest of new articles,
+# so both split the authors the same way.
+# The strings to be cleaned were found by an inspection of the data contained on 'byline_original'.
+# The regular expressions are applied in this order.
+BYLINE_REPLACEMENTS = {
+    # Strings at the start
+    'By '                    : '',
+    'By ‘'                   : '',
+    'Show.$'                 : 'Show',
+    'Text by '               : '',
+    'Video by '              : '',
+    'Videos by '             : '',
+    'Written by '            : '',
+    'Compiled by '           : '',
+    'Artwork by '            : '',
+    'Produced by '           : '',
+    'Reporting by '          : '',
+    'Selected by '           : '',
+    'Photographs by '        : '',
+    'Interviews by '         : '',
+    'Introduction by '       : '',
+    'Photo Essay by '        : '',
+    'Illustrations by '      : '',
+    'Photographs, Text by '  : '',
+
+    # Strings in the middle
+    ' Text by '              : '',
+    ' Video by '             : '',
+    ' posters by '           : '',
+    ' Flowers by '           : '',
+    ' photographs by '       : '',
+
+    # Strings in the middle that need to be replaced with ','
+    r'\;'                    : ',',
+    ' and '                  : ', ',
+    ' with Text by '         : ', ',
+    ' with Photographs by '  : ', ',
+
+    # Strings at the end
+    ' for The New York Times': '',
+    ' For The New York Times': ''
+}
+
+_BYLINE_PATTERNS = [(re.compile(pattern), value) for pattern, value in BYLINE_REPLACEMENTS.items()]
+
+
+def clean_byline(byline):
+    """
+    Comma separated authors of a byline, e.g. 'By Jane Doe and John Roe' -> 'Jane Doe, John Roe'
+    :param byline: original byline of the article
+    """
+
+    for pattern, value in _BYLINE_PATTERNS:
+        byline = pattern.sub(value, byline)
+    return byline
+
+
+def split_authors(byline):
+    """
+    Names of the authors of a byline: split on ',', trimmed, one whitespace between words,
+    without empty names and repetitions
+    :param byline: original byline of the article
+    """
+
+    names = []
+    for name in clean_byline(byline or '').split(','):
+        name = re.sub(r'\s+', ' ', name.strip())
+        if name and name not in names:
+            names.append(name)
+    return names
@@ -4,6 +4,11 @@ import pymongo
 import os
 import json
 import pandas as pd
+import bson
+from dedup import SeenSet, article_key
+from mongo_indexes import add_name_fields, ensure_indexes
+from metrics import RunMetrics
+from profiling import profile_run, profiling_enabled
 
 # Gets variables values from configuration file config_vars.py
 # MONGODB_URL, MONGODB_NYT_DB_NAME, MONGODB_NYT_COL_NAME
@@ -13,24 +18,120 @@ import pandas as pd
 # # appending a path
 # sys.path.append('../')
 # import config_vars
+
+# Ingest projection defaults, overridden by config_vars.py when defined there
+# INGEST_DROP_FIELDS: comma separated fields dropped before the insert, dotted paths allowed
+# INGEST_DROP_REDUNDANT_TEXT: drop 'snippet' when equal to 'abstract' and the empty 'headline' fields
+INGEST_DROP_FIELDS = 'multimedia'
+INGEST_DROP_REDUNDANT_TEXT = False
+
+# Deduplication defaults, overridden by config_vars.py when defined there
+# DEDUP_ARTICLES: drop the articles already read from a previous file (same '_id'/'uri')
+# DEDUP_BLOOM_BITS: size in bits of the optional Bloom filter pre-check, 0 disables it
+DEDUP_ARTICLES = True
+DEDUP_BLOOM_BITS = 0
+
+# Run report default, overridden by config_vars.py when defined there
+# METRICS_PROMETHEUS_TEXTFILE: also write the steps metrics as a Prometheus textfile in OUTPUT_DATA_DIR
+METRICS_PROMETHEUS_TEXTFILE = False
+
+# Profiling default, overridden by config_vars.py when defined there
+# PROFILE_RUN: save a CPU profile and the top allocation sites of the run in OUTPUT_DATA_DIR
+# The environment variable NYT_PROFILE=1 switches it on too
+PROFILE_RUN = False
+
 from config_vars import *
 
+# Content version of the collections, read by 1_api to build the ETags of its responses:
+# one document {_id: collection name, version: n} per collection, incremented after every ingest
+CONTENT_VERSION_COLL_NAME = 'content_version'
+
+
+def slim_document(doc, drop_fields, drop_redundant_text=False):
+    """
+    Removes from one article the subtrees that nothing downstream reads.
+    The document is modified in place and also returned
+    :param doc: article document as read from the JSON file
+    :param drop_fields: list of field paths to drop, e.g. ['multimedia', 'headline.seo']
+    :param drop_redundant_text: if True drop 'snippet' when it repeats 'abstract'
+                                and the 'headline' fields without value
+    """
+
+    for field in drop_fields:
+        *parents, leaf = field.split('.')
+        node = doc
+        for parent in parents:
+            node = node.get(parent) if isinstance(node, dict) else None
+        if isinstance(node, dict):
+            node.pop(leaf, None)
+
+    if drop_redundant_text:
+        # convert_data restores 'snippet' from 'abstract' when exporting the CSV
+        if doc.get('snippet') and doc.get('snippet') == doc.get('abstract'):
+            del doc['snippet']
+
+        headline = doc.get('headline')
+        if isinstance(headline, dict):
+            for key in [key for key, value in headline.items() if value in (None, '')]:
+                del headline[key]
+
+    return doc
+
+
+def bump_content_version(db, collection_name):
+    """
+    Increments the content version of a collection after its documents changed,
+    so that the ETags of the API responses read from it change too
+    :param db: mongo database of the collection
+    :param collection_name: name of the changed collection
+    """
+
+    db[CONTENT_VERSION_COLL_NAME].update_one({'_id': collection_name}, {'$inc': {'version': 1}}, upsert=True)
+
+
+def size_reduction(raw_bytes, slim_bytes):
+    """
+    Percentage of bytes removed by the ingest projection, rounded to one decimal
+    :param raw_bytes: size of the documents as read from the JSON file
+    :param slim_bytes: size of the documents inserted in the collection
+    """
+
+    if raw_bytes == 0:
+        return 0.0
+    return round(100 * (raw_bytes - slim_bytes) / raw_bytes, 1)
+
 
-def json_to_csv(input_directory, output_directory_file):
+def json_to_csv(input_directory, output_directory_file, myclient=None, metrics=None):
     """
     Converts many JSON files with articles to one CSV file containing all articles
     :param input_directory: directory where JSON files are located to be loaded
     :param output_directory_file: file path and file name of resulted CSV file 
+    :param myclient: optional mongo client, by default one is connected to MONGODB_URL
+    :param metrics: optional RunMetrics recording the steps
     """
 
+    if metrics is None:
+        metrics = RunMetrics('json_to_csv')
+
     # Instantiate mongo client
-    myclient = pymongo.MongoClient(MONGODB_URL)
+    if myclient is None:
+        myclient = pymongo.MongoClient(MONGODB_URL)
     
     # Create database
     nyt_db = myclient[MONGODB_NYT_DB_NAME]
     
     # Database collection
     nyt_articles_coll = nyt_db[MONGODB_NYT_COL_NAME]
+
+    # Ingest projection
+    drop_fields = [field.strip() for field in str(INGEST_DROP_FIELDS).split(',') if field.strip()]
+    drop_redundant_text = str(INGEST_DROP_REDUNDANT_TEXT).lower() in ('true', '1', 'yes')
+    total_raw_bytes = 0
+    total_slim_bytes = 0
+
+    # Seen-set of the article identifiers, to drop the articles repeated across monthly files
+    dedup = str(DEDUP_ARTICLES).lower() in ('true', '1', 'yes')
+    seen_articles = SeenSet(bloom_bits=int(DEDUP_BLOOM_BITS))
     
     # Read json files and insert in MongoDB
     # Read data directory
@@ -52,58 +153,129 @@ def json_to_csv(input_directory, output_directory_file):
         print(json_file)
         
         # read one json file
-        try:
-            with open(json_file, encoding="utf8") as file:
-                file_data = json.load(file)
-        except Exception as e:
-            print(">>> An 'open file' exception : ", e, " occurred on file:", json_file, "\n")
+        with metrics.step('json_decode', file=filename) as step:
+            try:
+                with open(json_file, encoding="utf8") as file:
+                    file_data = json.load(file)
+                docs = file_data["response"]["docs"]
+                step['rows_out'] = len(docs)
+            except Exception as e:
+                print(">>> An 'open file' exception : ", e, " occurred on file:", json_file, "\n")
+                continue
+
+        # drop the articles already seen, the first occurrence is kept
+        with metrics.step('deduplication', rows_in=len(docs), file=filename) as step:
+            try:
+                if dedup:
+                    # the articles without identifier are all kept, they cannot be recognized
+                    keys = [article_key(doc) for doc in docs]
+                    is_new = iter(seen_articles.add_batch([key for key in keys if key is not None]))
+                    kept = [doc for doc, key in zip(docs, keys) if key is None or next(is_new)]
+                    duplicates = len(docs) - len(kept)
+                    docs = kept
+                    if duplicates:
+                        print(f"    {duplicates} duplicated articles dropped")
+                step['rows_out'] = len(docs)
+            except Exception as e:
+                print(">>> A 'deduplication' exception : ", e, " occurred on file:", json_file, "\n")
+                continue
+
+        if not docs:
             continue
 
-        # insert in the collection
+        # slim the documents before the insert and measure the BSON size reduction
+        with metrics.step('slim_documents', rows_in=len(docs), file=filename) as step:
+            try:
+                raw_bytes = sum(len(bson.encode(doc)) for doc in docs)
+                docs = [slim_document(doc, drop_fields, drop_redundant_text) for doc in docs]
+                slim_bytes = sum(len(bson.encode(doc)) for doc in docs)
+                step['rows_out'] = len(docs)
+            except Exception as e:
+                print(">>> A 'slim document' exception : ", e, " occurred on file:", json_file, "\n")
+                continue
+
+        # insert in the collection, with the normalized name fields of the authors
+        with metrics.step('insert_many', rows_in=len(docs), file=filename) as step:
+            try:
+                nyt_articles_coll.insert_many([add_name_fields(doc) for doc in docs])
+                step['rows_out'] = len(docs)
+            except Exception as e:
+                print(">>> An 'insert_many' exception : ", e, " occurred on file:", json_file, "\n")
+                continue
+
+        total_raw_bytes += raw_bytes
+        total_slim_bytes += slim_bytes
+        print(f"    {len(docs)} documents, {raw_bytes} -> {slim_bytes} bytes ({size_reduction(raw_bytes, slim_bytes)}% smaller)")
+
+    # the responses cached by the API clients are outdated
+    bump_content_version(nyt_db, MONGODB_NYT_COL_NAME)
+
+    # indexes of the author queries and of the groupings of the MongoDB API, see mongo_indexes.py
+    with metrics.step('create_indexes') as step:
         try:
-            nyt_articles_coll.insert_many(file_data["response"]["docs"])
+            step['rows_out'] = len(ensure_indexes(nyt_articles_coll))
         except Exception as e:
-            print(">>> An 'insert_many' exception : ", e, " occurred on file:", json_file, "\n")
-            continue
-            
+            print(">>> A 'create indexes' exception : ", e, "\n")
+
+    # print the number of duplicated articles dropped
+    if dedup:
+        print(f"Deduplication: {seen_articles.duplicates} duplicated articles dropped, {seen_articles.size} unique articles ({seen_articles.nbytes()} bytes seen-set)")
+
+    # print the size reduction of the ingest projection
+    print(f"Ingest projection: {total_raw_bytes} -> {total_slim_bytes} bytes ({size_reduction(total_raw_bytes, total_slim_bytes)}% smaller)")
     
     # print the total number of articles
-    total_articles = nyt_articles_coll.count_documents({})
+    with metrics.step('count_documents') as step:
+        total_articles = nyt_articles_coll.count_documents({})
+        step['rows_out'] = total_articles
     print("The number of articles in this collections is", total_articles)
     
     # Query the mongodb and
     # Create a DataFrame and Save it to .csv file
     # Creating a Cursor instance using aggregate() function
-    cursor = nyt_articles_coll.aggregate(
-        [
-            {
-                "$project": {
-                    '_id': 1,
-                    'abstract' : 1,
-                    'web_url' : 1,
-                    'snippet' : 1,
-                    'lead_paragraph' : 1,
-                    'print_section' : 1,
-                    'print_page' : 1,
-                    'a_source' : 1,
-                    'headline_main' : '$headline.main',
-                    'headline_print_headline' : '$headline.print_headline',
-                    'pub_date' : 1,
-                    'document_type' : 1,
-                    'news_desk' : 1,
-                    'section_name' : 1,
-                    'byline_original' : '$byline.original',
-                    'byline_organization' : '$byline.organization',
-                    'type_of_material' : 1,
-                    'word_count' : 1                
+    with metrics.step('export_aggregate', rows_in=total_articles) as step:
+        cursor = nyt_articles_coll.aggregate(
+            [
+                {
+                    "$project": {
+                        '_id': 1,
+                        'abstract' : 1,
+                        'web_url' : 1,
+                        'snippet' : { '$ifNull': ['$snippet', '$abstract'] },
+                        'lead_paragraph' : 1,
+                        'print_section' : 1,
+                        'print_page' : 1,
+                        'a_source' : 1,
+                        'headline_main' : '$headline.main',
+                        'headline_print_headline' : '$headline.print_headline',
+                        'pub_date' : 1,
+                        'document_type' : 1,
+                        'news_desk' : 1,
+                        'section_name' : 1,
+                        'byline_original' : '$byline.original',
+                        'byline_organization' : '$byline.organization',
+                        'type_of_material' : 1,
+                        'word_count' : 1,
+                        'keywords' : 1
+                    }
                 }
-            }
-        ]
-    )
+            ]
+        )
     
-    # Expand the cursor and construct the DataFrame 'articles'
-    df_raw =  pd.DataFrame(list(cursor))
-    df_raw.to_csv(output_directory_file, index=False)
+        # Expand the cursor and construct the DataFrame 'articles'
+        df_raw =  pd.DataFrame(list(cursor))
+        step['rows_out'] = len(df_raw)
+
+    # Keep the 'keywords' array as a JSON string in its CSV cell,
+    # create_db normalizes it into the 'keyword' and 'article_keyword' tables
+    if 'keywords' in df_raw.columns:
+        df_raw['keywords'] = df_raw['keywords'].apply(
+            lambda keywords: json.dumps(keywords if isinstance(keywords, list) else [])
+        )
+
+    with metrics.step('to_csv', rows_in=len(df_raw)) as step:
+        df_raw.to_csv(output_directory_file, index=False)
+        step['rows_out'] = len(df_raw)
 
 
 def main():
@@ -115,8 +287,17 @@ def main():
 	# To set the values edit config_vars.py
     input_directory = f'/{INPUT_DATA_DIR}'
     output_directory_file = f'/{OUTPUT_DATA_DIR}/{JSON_TO_CSV_FILE_NAME}'
-    json_to_csv(input_directory, output_directory_file)
+
+    # Metrics of every step, saved as a run report in the output directory
+    metrics = RunMetrics('convert_data')
+    json_to_csv(input_directory, output_directory_file, metrics=metrics)
+
+    metrics.print_summary()
+    prometheus = str(METRICS_PROMETHEUS_TEXTFILE).lower() in ('true', '1', 'yes')
+    print("Run report saved to", metrics.save(f'/{OUTPUT_DATA_DIR}', prometheus))
 
 
 if __name__ == '__main__':
-    main()
+    # Optional profiling of the whole run
+    with profile_run('convert_data', f'/{OUTPUT_DATA_DIR}', profiling_enabled(PROFILE_RUN)):
+        main()
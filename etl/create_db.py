@@ -1,16 +1,46 @@
 #!/usr/bin/env python3
 
 import os
+import json
 import pandas as pd
 import numpy as np
 import sqlite3
+from concurrent.futures import ProcessPoolExecutor
 
 # To import variable values from config_vars.py
 import sys
 # appending a path
 sys.path.append('../')
 import config_vars
+
+# Run report default, overridden by config_vars.py when defined there
+# METRICS_PROMETHEUS_TEXTFILE: also write the steps metrics as a Prometheus textfile in OUTPUT_DATA_DIR
+METRICS_PROMETHEUS_TEXTFILE = False
+
+# Profiling default, overridden by config_vars.py when defined there
+# PROFILE_RUN: save a CPU profile and the top allocation sites of the run in OUTPUT_DATA_DIR
+# The environment variable NYT_PROFILE=1 switches it on too
+PROFILE_RUN = False
+
+# Sharded database defaults, overridden by config_vars.py when defined there
+# SQLITE_SHARD_PERIOD: '' for one database file, 'year' or 'month' for one database file per period, see shards.py
+# SQLITE_SHARD_REFRESH: comma separated periods to rebuild, e.g. '2022'. Empty: every period of the input
+# SQLITE_SHARD_WORKERS: processes building the shards in parallel, 0 for the number of CPUs
+SQLITE_SHARD_PERIOD = ''
+SQLITE_SHARD_REFRESH = ''
+SQLITE_SHARD_WORKERS = 0
+
+# Database snapshots kept in the database directory, the published one included, see snapshots.py
+SQLITE_SNAPSHOTS_KEPT = 2
+
 from config_vars import *
+from metrics import RunMetrics
+from authors import BYLINE_REPLACEMENTS
+from shards import (shards_directory, shard_file_name, period_of, shard_id_base,
+                    read_manifest, write_manifest, DIRECTORY_NAME)
+from snapshots import (snapshot_version, snapshot_file_name, check_database, remove_database,
+                       publish_snapshot, remove_old_snapshots)
+from profiling import profile_run, profiling_enabled
 
 
 def create_df_article(df_Ar):
@@ -27,47 +57,15 @@ def create_df_article(df_Ar):
 	# Clean 'authors' column
 	# Create a new column of authors separated by comma
 
-	# These strings to be cleaned where found by an inspection of the data contained on 'byline_original'
-	dic = { # Strings at the start 
-			'By '                    : '',
-			'By ‘'                   : '',
-			'Show.$'                 : 'Show',     
-			'Text by '               : '',
-			'Video by '              : '',
-			'Videos by '             : '',
-			'Written by '            : '', 
-			'Compiled by '           : '',
-			'Artwork by '            : '',
-			'Produced by '           : '',
-			'Reporting by '          : '',
-			'Selected by '           : '',
-			'Photographs by '        : '',
-			'Interviews by '         : '',
-			'Interviews by '         : '',
-			'Introduction by '       : '',
-			'Photo Essay by '        : '',
-			'Illustrations by '      : '',
-			'Photographs, Text by '  : '',
-
-			# Strings in the middle
-			' Text by '              : '',
-			' Video by '             : '',
-			' posters by '           : '',
-			' Flowers by '           : '',
-			' photographs by '       : '',
-
-			# Strings in the middle that need to be replaced with ','
-			'\;'                     : ',',
-			' and '                  : ', ',
-			' with Text by '         : ', ',
-			' with Photographs by '  : ', ',
-
-			# Strings at the end
-			' for The New York Times': '',
-			' For The New York Times': ''
-		}
-
-	df_Ar['authors'] = df_Ar['byline_original'].replace(dic, regex=True)
+	# The cleaning rules are shared with the API ingest, see authors.py
+	df_Ar['authors'] = df_Ar['byline_original'].replace(BYLINE_REPLACEMENTS, regex=True)
+
+	# Drop the articles repeated across monthly files, before they get their own article_id
+	if '_id' in df_Ar.columns:
+		total_rows = len(df_Ar)
+		df_Ar = df_Ar.drop_duplicates(subset=['_id'], keep='first').reset_index(drop=True)
+		if len(df_Ar) < total_rows:
+			print(f"{total_rows - len(df_Ar)} duplicated articles dropped")
 
 	# Create a row index. from 0 to ...
 	# Reset index, BUT save old
@@ -155,6 +153,92 @@ def modify_df_article_author(df_Ar_Au, df_Au):
 	return df_Ar_Au
 
 
+def create_df_article_keyword(df_Ar_Kw, df_Ar):
+	"""
+	Crate a Dataframe 'article_keyword', where each row is a relation between one article_id and one keyword
+	The column 'keywords' holds, for each article, the JSON array of keyword objects written by convert_data
+	:param df_Ar_Kw: Dataframe containing the resulted "composite table" 'article_keyword'
+	:param df_Ar: Dataframe with the articles data, containing the column 'keywords'
+	"""
+
+	if 'keywords' not in df_Ar.columns:
+		return pd.DataFrame(columns=['article_id', 'name', 'value', 'rank'])
+
+	# Parse the JSON array of every article. Missing or broken cells give an empty list
+	def parse_keywords(cell):
+		try:
+			keywords = json.loads(cell)
+		except (TypeError, ValueError):
+			return []
+		return keywords if isinstance(keywords, list) else []
+
+	df_temp = df_Ar[['article_id', 'keywords']].copy()
+	df_temp['keywords'] = df_temp['keywords'].apply(parse_keywords)
+
+	# Explode: one row per keyword object, replicating the article_id
+	df_temp = df_temp.explode('keywords')
+	df_temp.dropna(subset=['keywords'], inplace=True)
+
+	df_Ar_Kw = pd.DataFrame({
+		'article_id': df_temp['article_id'].values,
+		'name'      : [kw.get('name')  for kw in df_temp['keywords']],
+		'value'     : [kw.get('value') for kw in df_temp['keywords']],
+		'rank'      : [kw.get('rank')  for kw in df_temp['keywords']]
+	})
+
+	## Clean name and value columns
+	df_Ar_Kw['name']  = df_Ar_Kw['name'].fillna('').astype(str).str.strip()
+	df_Ar_Kw['value'] = df_Ar_Kw['value'].fillna('').astype(str).str.strip()
+
+	# Drop the keywords without value
+	df_Ar_Kw['value'] = df_Ar_Kw['value'].replace('', np.nan)
+	df_Ar_Kw.dropna(subset=['value'], inplace=True)
+
+	# When the rank is missing use the position of the keyword inside the article
+	df_Ar_Kw['rank'] = pd.to_numeric(df_Ar_Kw['rank'], errors='coerce')
+	position = df_Ar_Kw.groupby('article_id').cumcount() + 1
+	df_Ar_Kw['rank'] = df_Ar_Kw['rank'].fillna(position).astype(int)
+
+	# Drop duplicates, one article keeps one rank per keyword
+	df_Ar_Kw = df_Ar_Kw.drop_duplicates(subset=['article_id', 'name', 'value'])
+
+	return df_Ar_Kw
+
+
+def create_df_keyword(df_Kw, df_Ar_Kw):
+	"""
+	Crate a Dataframe 'keyword', where each row contain the name and value of the keyword and the keyword_id
+	:param df_Kw: Dataframe containig the 'keyword' data.
+	:param df_Ar_Kw: Dataframe containing the "composite table" 'article_keyword'
+	"""
+
+	# Find unique keywords
+	df_Kw = df_Ar_Kw[['name', 'value']].drop_duplicates()
+
+	# Reset index, BUT without saving old
+	df_Kw = df_Kw.reset_index(drop=True).reset_index()
+
+	# Rename columns
+	df_Kw.rename(columns={'index': 'keyword_id'}, inplace=True)
+
+	return df_Kw
+
+
+def modify_df_article_keyword(df_Ar_Kw, df_Kw):
+	"""
+	Modify DataFrame 'article_keyword', replacing name and value of the keyword by its keyword_id
+	:param df_Ar_Kw: Dataframe containing the "composite table" 'article_keyword'
+	:param df_Kw: Dataframe containig the 'keyword' data.
+	"""
+
+	df_Ar_Kw = df_Ar_Kw.merge(df_Kw, on=['name', 'value'])
+
+	# Keep only the ids and the rank
+	df_Ar_Kw = df_Ar_Kw[['article_id', 'keyword_id', 'rank']]
+
+	return df_Ar_Kw
+
+
 def create_table_article(conn, df_Ar):
 	"""
 	Create table 'article' in the SQLite Database and 
@@ -190,6 +274,10 @@ def create_table_article(conn, df_Ar):
 			    authors          VARCHAR
 			);
 		''')
+		# Serves the queries of the articles of one section, e.g. the keywords count by section
+		cur.execute('''
+			CREATE INDEX IF NOT EXISTS idx_article_section ON article ( section_name, article_id );
+		''')
 		conn.commit()
 
 		try:
@@ -218,6 +306,10 @@ def create_table_author(conn, df_Au):
 			    author_name TEXT UNIQUE
 			);
 		''')
+		# The API looks up the authors case-insensitively (author_name = ? COLLATE NOCASE)
+		cur.execute('''
+			CREATE INDEX IF NOT EXISTS idx_author_name_nocase ON author ( author_name COLLATE NOCASE );
+		''')
 		conn.commit()
 
 		try:
@@ -257,6 +349,71 @@ def create_table_article_author(conn, df_Ar_Au):
 		print(">>> A 'SQLite error' error : ", er, '\n')
 
 
+def create_table_keyword(conn, df_Kw):
+	"""
+	Create table 'keyword' in the SQLite Database and 
+	populate it with the data stored in the 'keyword' Dataframe
+	:param conn: database connection reference
+	:param df_Kw: Dataframe with the keywords data
+	"""
+
+	try:
+		cur = conn.cursor()
+		cur.execute('''
+			CREATE TABLE IF NOT EXISTS keyword (
+			    keyword_id  INTEGER PRIMARY KEY AUTOINCREMENT,
+			    name        TEXT,
+			    value       TEXT,
+			    UNIQUE ( name, value )
+			);
+		''')
+		cur.execute('''
+			CREATE INDEX IF NOT EXISTS idx_keyword_value ON keyword ( value );
+		''')
+		conn.commit()
+
+		try:
+			df_Kw.to_sql('keyword', conn, if_exists='append', index = False)
+		except Exception as e:
+			print(">>> A 'df.to_sql' exception : ", e, "\n")
+	
+	except sqlite3.Error as er:
+		print(">>> A 'SQLite error' error : ", er, '\n')
+
+
+def create_table_article_keyword(conn, df_Ar_Kw):
+	"""
+	Create table 'article_keyword' in the SQLite Database and 
+	populate it with the data stored in the 'article_keyword' Dataframe
+	The primary key serves article -> keywords, the index serves keyword -> articles
+	:param conn: database connection reference
+	:param df_Ar_Kw: Dataframe with the article_keyword data
+	"""
+
+	try:
+		cur = conn.cursor()
+		cur.execute('''
+			CREATE TABLE IF NOT EXISTS article_keyword (
+			    article_id        INTEGER NOT NULL,
+			    keyword_id        INTEGER NOT NULL,
+			    rank              INTEGER,
+			    PRIMARY KEY ( article_id, keyword_id )
+			);
+		''')
+		cur.execute('''
+			CREATE INDEX IF NOT EXISTS idx_article_keyword_keyword ON article_keyword ( keyword_id, article_id );
+		''')
+		conn.commit()
+
+		try:
+			df_Ar_Kw.to_sql('article_keyword', conn, if_exists='append', index = False)
+		except Exception as e:
+			print(">>> A 'df.to_sql' exception : ", e, "\n")
+	
+	except sqlite3.Error as er:
+		print(">>> A 'SQLite error' error : ", er, '\n')
+
+
 def test_database(db_path, db_name, table_name):
 	"""
 	Only for test purposes.
@@ -283,12 +440,285 @@ def test_database(db_path, db_name, table_name):
 
 
 
+def create_single_db(df_Ar, metrics, db_path, db_name):
+	"""
+	Normalize the articles and create the database, one file with all the tables.
+	The database is built in a new snapshot file, published once its checks pass, see snapshots.py
+	:param df_Ar: Dataframe 'article'
+	:param metrics: RunMetrics of the run
+	:param db_path: database directory
+	:param db_name: database file name
+	"""
+
+	# Create df 'article_author'
+	with metrics.step('create_df_article_author', rows_in=len(df_Ar)) as step:
+		df_Ar_Au = pd.DataFrame()
+		df_Ar_Au = create_df_article_author(df_Ar_Au, df_Ar)
+		step['rows_out'] = len(df_Ar_Au)
+
+	# Create df 'author'
+	with metrics.step('create_df_author', rows_in=len(df_Ar_Au)) as step:
+		df_Au = pd.DataFrame()
+		df_Au =create_df_author(df_Au, df_Ar_Au)
+		step['rows_out'] = len(df_Au)
+
+	# Modify df 'article_author'
+	# Normalization
+	with metrics.step('modify_df_article_author', rows_in=len(df_Ar_Au)) as step:
+		df_Ar_Au = modify_df_article_author(df_Ar_Au, df_Au)
+		step['rows_out'] = len(df_Ar_Au)
+
+	# Create df 'article_keyword'
+	with metrics.step('create_df_article_keyword', rows_in=len(df_Ar)) as step:
+		df_Ar_Kw = pd.DataFrame()
+		df_Ar_Kw = create_df_article_keyword(df_Ar_Kw, df_Ar)
+		step['rows_out'] = len(df_Ar_Kw)
+
+	# Create df 'keyword'
+	with metrics.step('create_df_keyword', rows_in=len(df_Ar_Kw)) as step:
+		df_Kw = pd.DataFrame()
+		df_Kw = create_df_keyword(df_Kw, df_Ar_Kw)
+		step['rows_out'] = len(df_Kw)
+
+	# Modify df 'article_keyword'
+	# Normalization
+	with metrics.step('modify_df_article_keyword', rows_in=len(df_Ar_Kw)) as step:
+		df_Ar_Kw = modify_df_article_keyword(df_Ar_Kw, df_Kw)
+		step['rows_out'] = len(df_Ar_Kw)
+
+	# The keywords are stored normalized, not in the 'article' table
+	if 'keywords' in df_Ar.columns:
+		df_Ar = df_Ar.drop('keywords', axis=1)
+
+	## Create Database
+	# A new snapshot file: the database published, read by the API, is not touched during the build
+	snapshot_name = snapshot_file_name(db_name, snapshot_version())
+	remove_database(db_path + snapshot_name)
+	conn = sqlite3.connect(db_path + snapshot_name)
+
+	# Create and populate the tables
+	tables = [
+		('article',         create_table_article,         df_Ar),
+		('author',          create_table_author,          df_Au),
+		('article_author',  create_table_article_author,  df_Ar_Au),
+		('keyword',         create_table_keyword,         df_Kw),
+		('article_keyword', create_table_article_keyword, df_Ar_Kw)
+	]
+	for table_name, create_table, df in tables:
+		with metrics.step(f'create_table_{table_name}', rows_in=len(df)) as step:
+			create_table(conn, df)
+			step['rows_out'] = conn.execute(f'SELECT COUNT(*) FROM {table_name}').fetchone()[0]
+
+	# Close Database connection
+	conn.close()
+
+	# Publish the snapshot only when it is complete and sound
+	with metrics.step('check_snapshot') as step:
+		problems = check_database(db_path + snapshot_name, {table_name: len(df) for table_name, _, df in tables})
+		step['rows_out'] = len(problems)
+	if problems:
+		remove_database(db_path + snapshot_name)
+		raise SystemExit(f">>> The new database failed its checks, {db_path + db_name} is unchanged : {'; '.join(problems)}")
+
+	publish_snapshot(db_path, db_name, snapshot_name)
+	remove_old_snapshots(db_path, db_name, int(SQLITE_SNAPSHOTS_KEPT))
+	print(f"Database snapshot {snapshot_name} published as {db_path + db_name}")
+
+
+def create_author_directory(directory_file, df_Ar_Au):
+	"""
+	Add the new authors to the author directory of the shards, the authors already there keep their author_id.
+	Returns the Dataframe 'author' of all the authors of the directory
+	:param directory_file: author directory database file
+	:param df_Ar_Au: Dataframe 'article_author' with the column 'author_name'
+	"""
+
+	conn = sqlite3.connect(directory_file)
+	conn.execute('PRAGMA journal_mode = WAL')
+	create_table_author(conn, pd.DataFrame(columns=['author_id', 'author_name']))
+
+	df_Au = pd.read_sql('SELECT author_id, author_name FROM author', conn)
+	known_authors = set(df_Au.author_name)
+	new_authors = [name for name in df_Ar_Au.author_name.unique() if name not in known_authors]
+
+	# New authors numbered after the last one
+	first_id = int(df_Au.author_id.max()) + 1 if len(df_Au) else 0
+	df_New_Au = pd.DataFrame({
+		'author_id'  : range(first_id, first_id + len(new_authors)),
+		'author_name': new_authors
+	})
+	create_table_author(conn, df_New_Au)
+	conn.close()
+
+	return pd.concat([df_Au, df_New_Au], ignore_index=True)
+
+
+def create_keyword_directory(directory_file, df_Ar_Kw):
+	"""
+	Add the new keywords to the directory of the shards, the keywords already there keep their keyword_id.
+	Returns the Dataframe 'keyword' of all the keywords of the directory
+	:param directory_file: author directory database file, which holds the keywords too
+	:param df_Ar_Kw: Dataframe 'article_keyword' with the columns 'name' and 'value'
+	"""
+
+	conn = sqlite3.connect(directory_file)
+	conn.execute('PRAGMA journal_mode = WAL')
+	create_table_keyword(conn, pd.DataFrame(columns=['keyword_id', 'name', 'value']))
+
+	df_Kw = pd.read_sql('SELECT keyword_id, name, value FROM keyword', conn)
+	known_keywords = set(zip(df_Kw.name, df_Kw.value))
+	df_New_Kw = df_Ar_Kw[['name', 'value']].drop_duplicates()
+	df_New_Kw = df_New_Kw[[keyword not in known_keywords for keyword in zip(df_New_Kw.name, df_New_Kw.value)]]
+
+	# New keywords numbered after the last one
+	first_id = int(df_Kw.keyword_id.max()) + 1 if len(df_Kw) else 0
+	df_New_Kw = df_New_Kw.reset_index(drop=True)
+	df_New_Kw.insert(0, 'keyword_id', range(first_id, first_id + len(df_New_Kw)))
+	create_table_keyword(conn, df_New_Kw)
+	conn.close()
+
+	return pd.concat([df_Kw, df_New_Kw], ignore_index=True)
+
+
+def build_shard(shard_file, df_Ar, df_Ar_Au, df_Ar_Kw):
+	"""
+	Create the database file of one shard: its articles, their links to the authors of the directory
+	and to the keywords of the directory. The shard is a new snapshot file, published by the manifest
+	once all the shards are built and checked. Run in a worker process. Returns the manifest entry of the shard
+	:param shard_file: snapshot file of the shard
+	:param df_Ar: Dataframe 'article' of the period, with the article_id of the shard
+	:param df_Ar_Au: Dataframe 'article_author' of the period, with the author_id of the directory
+	:param df_Ar_Kw: Dataframe 'article_keyword' of the period, with the keyword_id of the directory
+	"""
+
+	if 'keywords' in df_Ar.columns:
+		df_Ar = df_Ar.drop('keywords', axis=1)
+
+	remove_database(shard_file)
+	conn = sqlite3.connect(shard_file)
+	conn.execute('PRAGMA journal_mode = WAL')
+	tables = [
+		('article',         create_table_article,         df_Ar),
+		('article_author',  create_table_article_author,  df_Ar_Au),
+		('article_keyword', create_table_article_keyword, df_Ar_Kw)
+	]
+	for _, create_table, df in tables:
+		create_table(conn, df)
+	conn.close()
+
+	problems = check_database(shard_file, {table_name: len(df) for table_name, _, df in tables})
+	if problems:
+		remove_database(shard_file)
+		raise ValueError(f">>> The shard {shard_file} failed its checks : {'; '.join(problems)}")
+
+	a_dates = df_Ar['a_date'].astype(str)
+	return {
+		'file'      : os.path.basename(shard_file),
+		'articles'  : len(df_Ar),
+		'first_date': a_dates.min(),
+		'last_date' : a_dates.max()
+	}
+
+
+def create_sharded_db(df_Ar, metrics, db_path, db_name):
+	"""
+	Create or refresh the time-sharded database, see shards.py: the authors are added to the author directory,
+	then the shards of the periods of the articles are rebuilt in parallel. The shards of the other periods
+	are not touched
+	:param df_Ar: Dataframe 'article'
+	:param metrics: RunMetrics of the run
+	:param db_path: database directory
+	:param db_name: database file name, the shards are named after it
+	"""
+
+	directory = shards_directory(db_path, db_name)
+	os.makedirs(directory, exist_ok=True)
+
+	manifest = read_manifest(directory) or {'period': SQLITE_SHARD_PERIOD, 'directory': DIRECTORY_NAME, 'shards': {}}
+	if manifest['period'] != SQLITE_SHARD_PERIOD:
+		print(f">>> The shards in {directory} are per '{manifest['period']}', not per '{SQLITE_SHARD_PERIOD}'. Remove them to change the period\n")
+		return
+
+	# Period of every article, only the periods to refresh are kept
+	df_Ar['period'] = [period_of(a_date, SQLITE_SHARD_PERIOD) for a_date in df_Ar['a_date']]
+	refresh = [period.strip() for period in str(SQLITE_SHARD_REFRESH).split(',') if period.strip()]
+	if refresh:
+		df_Ar = df_Ar[df_Ar['period'].isin(refresh)]
+	periods = sorted(df_Ar['period'].unique())
+	print(f"Shards to build: {', '.join(periods)}")
+
+	# Article ids of the shards: from the id base of the period on.
+	# The index is the article_id too, create_df_article_author() links the authors by index
+	df_Ar = df_Ar.copy()
+	df_Ar['article_id'] = [shard_id_base(period) for period in df_Ar['period']] + df_Ar.groupby('period').cumcount().values
+	df_Ar.index = df_Ar['article_id'].values
+
+	# Create df 'article_author'
+	with metrics.step('create_df_article_author', rows_in=len(df_Ar)) as step:
+		df_Ar_Au = pd.DataFrame()
+		df_Ar_Au = create_df_article_author(df_Ar_Au, df_Ar)
+		step['rows_out'] = len(df_Ar_Au)
+
+	# Add the new authors to the directory, shared by all the shards
+	with metrics.step('create_author_directory', rows_in=len(df_Ar_Au)) as step:
+		df_Au = create_author_directory(directory + DIRECTORY_NAME, df_Ar_Au)
+		step['rows_out'] = len(df_Au)
+
+	with metrics.step('modify_df_article_author', rows_in=len(df_Ar_Au)) as step:
+		df_Ar_Au = modify_df_article_author(df_Ar_Au, df_Au)
+		step['rows_out'] = len(df_Ar_Au)
+
+	# Create df 'article_keyword'
+	with metrics.step('create_df_article_keyword', rows_in=len(df_Ar)) as step:
+		df_Ar_Kw = pd.DataFrame()
+		df_Ar_Kw = create_df_article_keyword(df_Ar_Kw, df_Ar)
+		step['rows_out'] = len(df_Ar_Kw)
+
+	# Add the new keywords to the directory: every keyword is stored once, with an id shared by all the shards
+	with metrics.step('create_keyword_directory', rows_in=len(df_Ar_Kw)) as step:
+		df_Kw = create_keyword_directory(directory + DIRECTORY_NAME, df_Ar_Kw)
+		step['rows_out'] = len(df_Kw)
+
+	with metrics.step('modify_df_article_keyword', rows_in=len(df_Ar_Kw)) as step:
+		df_Ar_Kw = modify_df_article_keyword(df_Ar_Kw, df_Kw)
+		step['rows_out'] = len(df_Ar_Kw)
+
+	# Build the shards in parallel, in new snapshot files.
+	# When a shard fails, the manifest is not replaced: the API keeps reading the old shards
+	version = snapshot_version()
+	with metrics.step('build_shards', rows_in=len(df_Ar)) as step:
+		period_of_article = df_Ar['period']
+		shard_files, shard_articles, shard_links, shard_keywords = [], [], [], []
+		for period in periods:
+			df_Period = df_Ar[period_of_article == period].drop('period', axis=1)
+			shard_files.append(directory + snapshot_file_name(shard_file_name(db_name, period), version))
+			shard_articles.append(df_Period)
+			shard_links.append(df_Ar_Au[df_Ar_Au['article_id'].isin(df_Period['article_id'])])
+			shard_keywords.append(df_Ar_Kw[df_Ar_Kw['article_id'].isin(df_Period['article_id'])])
+
+		workers = int(SQLITE_SHARD_WORKERS) or os.cpu_count()
+		with ProcessPoolExecutor(max_workers=min(workers, max(len(periods), 1))) as executor:
+			entries = list(executor.map(build_shard, shard_files, shard_articles, shard_links, shard_keywords))
+
+		for period, entry in zip(periods, entries):
+			manifest['shards'][period] = entry
+		step['rows_out'] = sum(entry['articles'] for entry in entries)
+
+	# The API switches to the new shards when the manifest is replaced
+	write_manifest(directory, manifest)
+	for period in periods:
+		remove_old_snapshots(directory, shard_file_name(db_name, period), int(SQLITE_SNAPSHOTS_KEPT))
+	print(f"{len(entries)} shards built in {directory}")
+
+
 def main():
 	"""
 	Read a CSV file with the NYT articles extracted.
 	Normalizes the authors data in Dataframes
 	Create a database with three tables 'article', 'author' and 'article_author' this as a composite table
+	Normalizes the keywords data in the tables 'keyword' and 'article_keyword' this as a composite table
 	Populate the tables with the data stored in the Dataframes
+	With SQLITE_SHARD_PERIOD the database is split in one file per period, see create_sharded_db()
 	"""
 
 	# Variables
@@ -299,47 +729,38 @@ def main():
 	db_name = SQLITE_NYT_DB_NAME
 	
 
+	# Metrics of every step, saved as a run report in the output directory
+	metrics = RunMetrics('create_db')
+
 	## Create DataFrames and Normalize Data
 	# Create-transform df 'article'
-	df_Ar = pd.read_csv (input_filepath, low_memory=False)
-	df_Ar = create_df_article(df_Ar)
-	df_Ar.to_csv(output_filepath, index=False)
-
-	# Create df 'article_author'
-	df_Ar_Au = pd.DataFrame()
-	df_Ar_Au = create_df_article_author(df_Ar_Au, df_Ar)
-
-	# Create df 'author'
-	df_Au = pd.DataFrame()
-	df_Au =create_df_author(df_Au, df_Ar_Au)
+	with metrics.step('read_csv') as step:
+		df_Ar = pd.read_csv (input_filepath, low_memory=False)
+		step['rows_out'] = len(df_Ar)
 
-	# Modify df 'article_author'
-	# Normalization
-	df_Ar_Au = modify_df_article_author(df_Ar_Au, df_Au)
+	with metrics.step('create_df_article', rows_in=len(df_Ar)) as step:
+		df_Ar = create_df_article(df_Ar)
+		step['rows_out'] = len(df_Ar)
 
-	## Create Database
-	# Drop Database If Exists ==> Remove the file
-	if os.path.exists(db_path + db_name):
-		os.remove(db_path + db_name)
-
-	# Create Database
-	conn = sqlite3.connect(db_path + db_name)
+	with metrics.step('to_csv_clean', rows_in=len(df_Ar)) as step:
+		df_Ar.to_csv(output_filepath, index=False)
+		step['rows_out'] = len(df_Ar)
 
-	# Create Table 'article'
-	create_table_article(conn, df_Ar)
+	if SQLITE_SHARD_PERIOD:
+		create_sharded_db(df_Ar, metrics, db_path, db_name)
+	else:
+		create_single_db(df_Ar, metrics, db_path, db_name)
 
-	# Create Table 'author'
-	create_table_author(conn, df_Au)
-
-	# Create Table 'article_author'
-	create_table_article_author(conn, df_Ar_Au)
-
-	# Close Database connection
-	conn.close
+	# Save the run report
+	metrics.print_summary()
+	prometheus = str(METRICS_PROMETHEUS_TEXTFILE).lower() in ('true', '1', 'yes')
+	print("Run report saved to", metrics.save(f'/{OUTPUT_DATA_DIR}', prometheus))
 
 	# Only for test purposes
 	#test_database(db_path, db_name, table_name = 'author')
 
 
 if __name__ == '__main__':
-    main()
+    # Optional profiling of the whole run
+    with profile_run('create_db', f'/{OUTPUT_DATA_DIR}', profiling_enabled(PROFILE_RUN)):
+        main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+import hashlib
+import numpy as np
+
+
+def article_key(doc):
+    """
+    Returns the identifier used to detect a repeated article: '_id', or 'uri' when there is no '_id'.
+    None when the article has neither: it cannot be recognized, and is kept without deduplication
+    :param doc: article document as read from the JSON file
+    """
+
+    key = doc.get('_id') or doc.get('uri')
+    return str(key) if key else None
+
+
+def hash64(key):
+    """
+    Hashes an article identifier to an unsigned 64-bit integer
+    :param key: article identifier
+    """
+
+    return int.from_bytes(hashlib.blake2b(key.encode('utf8'), digest_size=8).digest(), 'little')
+
+
+class SeenSet:
+    """
+    Exact set of the article identifiers already seen while streaming the monthly files.
+    Every identifier is stored as a 64-bit hash (8 bytes per article) in a few sorted NumPy runs,
+    the runs are merged when they grow, like a log-structured merge tree, so the full dataset
+    is never sorted at once. An optional Bloom filter skips the run lookups for new articles.
+    """
+
+    def __init__(self, bloom_bits=0, bloom_hashes=4):
+        """
+        :param bloom_bits: size in bits of the Bloom filter pre-check, 0 disables it
+        :param bloom_hashes: number of hash functions of the Bloom filter
+        """
+
+        self.runs = []
+        self.size = 0
+        self.duplicates = 0
+        self.bloom_bits = int(bloom_bits)
+        self.bloom_hashes = int(bloom_hashes)
+        self.bloom = np.zeros((self.bloom_bits + 7) // 8, dtype=np.uint8) if self.bloom_bits > 0 else None
+
+    def _bloom_positions(self, keys):
+        # Double hashing: position_i = h1 + i * h2, both halves taken from the 64-bit key
+        h1 = keys & np.uint64(0xFFFFFFFF)
+        h2 = (keys >> np.uint64(32)) | np.uint64(1)
+        steps = np.arange(self.bloom_hashes, dtype=np.uint64)
+        return (h1[:, None] + steps[None, :] * h2[:, None]) % np.uint64(self.bloom_bits)
+
+    def _bloom_contains(self, keys):
+        positions = self._bloom_positions(keys)
+        bits = (self.bloom[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        return bits.all(axis=1)
+
+    def _bloom_add(self, keys):
+        positions = self._bloom_positions(keys).ravel()
+        np.bitwise_or.at(self.bloom, positions >> np.uint64(3), (1 << (positions & np.uint64(7))).astype(np.uint8))
+
+    def _runs_contain(self, keys):
+        found = np.zeros(len(keys), dtype=bool)
+        for run in self.runs:
+            pos = np.searchsorted(run, keys)
+            pos[pos == len(run)] = len(run) - 1
+            found |= run[pos] == keys
+        return found
+
+    def _add_run(self, keys):
+        self.runs.append(np.sort(keys))
+        # Merge the last runs while the older one is not much bigger than the newer one
+        while len(self.runs) > 1 and len(self.runs[-2]) <= 2 * len(self.runs[-1]):
+            newer = self.runs.pop()
+            older = self.runs.pop()
+            self.runs.append(np.sort(np.concatenate((older, newer)), kind='mergesort'))
+
+    def add_batch(self, ids):
+        """
+        Adds a batch of article identifiers and returns, for every one, True if it was not seen before.
+        Repeated identifiers inside the same batch count as duplicates too, the first one is kept
+        :param ids: list of article identifiers
+        """
+
+        if len(ids) == 0:
+            return []
+
+        keys = np.fromiter((hash64(key) for key in ids), dtype=np.uint64, count=len(ids))
+
+        # First occurrence inside the batch
+        is_new = np.zeros(len(keys), dtype=bool)
+        is_new[np.unique(keys, return_index=True)[1]] = True
+
+        # Only the keys that may have been seen are looked up in the runs
+        maybe_seen = is_new.copy()
+        if self.bloom is not None:
+            maybe_seen &= self._bloom_contains(keys)
+        if self.runs and maybe_seen.any():
+            is_new[maybe_seen] &= ~self._runs_contain(keys[maybe_seen])
+
+        new_keys = keys[is_new]
+        if len(new_keys):
+            self._add_run(new_keys)
+            if self.bloom is not None:
+                self._bloom_add(new_keys)
+
+        self.size += len(new_keys)
+        self.duplicates += len(keys) - len(new_keys)
+
+        return is_new.tolist()
+
+    def nbytes(self):
+        """
+        Memory used by the stored hashes and the Bloom filter, in bytes
+        """
+
+        return sum(run.nbytes for run in self.runs) + (self.bloom.nbytes if self.bloom is not None else 0)
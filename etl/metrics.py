@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import socket
+import resource
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of the process (Linux only), so one step measures its own peak
+    Returns True when the reset is supported
+    """
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_bytes():
+    """
+    Peak resident set size of the process in bytes, since the last reset when supported
+    """
+
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class RunMetrics:
+    """
+    Records, for every named step of one ETL run, wall time, CPU time, rows in and out,
+    rows per second and peak RSS, and writes them to a run report
+    """
+
+    def __init__(self, run_name):
+        """
+        :param run_name: name of the run, e.g. 'convert_data' or 'create_db'
+        """
+
+        self.run_name = run_name
+        self.started_at = datetime.now(timezone.utc)
+        self.run_start = time.perf_counter()
+        self.steps = []
+        self._open_steps = []
+
+    @contextmanager
+    def step(self, name, rows_in=None, **labels):
+        """
+        Measure the code inside the 'with' block as one step.
+        The yielded dict can be updated with 'rows_out' (and 'rows_in') by the block
+        :param name: name of the step
+        :param rows_in: number of rows the step reads
+        :param labels: extra information stored with the step, e.g. file='NYT_2021_1.json'
+        """
+
+        record = {'step': name, 'rows_in': rows_in, 'rows_out': None}
+        record.update(labels)
+
+        # The steps still open keep the peak reached so far before it is reset
+        current_peak = peak_rss_bytes()
+        for open_step in self._open_steps:
+            open_step['_peak'] = max(open_step['_peak'], current_peak)
+        reset_peak_rss()
+        record['_peak'] = 0
+
+        self._open_steps.append(record)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield record
+        finally:
+            wall_s = time.perf_counter() - wall_start
+            cpu_s = time.process_time() - cpu_start
+            self._open_steps.pop()
+
+            rows = record['rows_out'] if record['rows_out'] is not None else record['rows_in']
+            record['wall_s'] = round(wall_s, 6)
+            record['cpu_s'] = round(cpu_s, 6)
+            record['rows_per_s'] = round(rows / wall_s, 1) if rows is not None and wall_s > 0 else None
+            record['peak_rss_bytes'] = max(record.pop('_peak'), peak_rss_bytes())
+            self.steps.append(record)
+
+    def summary(self):
+        """
+        Steps aggregated by name, in order of first appearance.
+        Times and rows are added, the peak RSS is the maximum
+        """
+
+        summary = {}
+        for record in self.steps:
+            total = summary.setdefault(record['step'], {
+                'step': record['step'], 'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0,
+                'rows_in': None, 'rows_out': None, 'rows_per_s': None, 'peak_rss_bytes': 0
+            })
+            total['calls'] += 1
+            total['wall_s'] += record['wall_s']
+            total['cpu_s'] += record['cpu_s']
+            for key in ('rows_in', 'rows_out'):
+                if record[key] is not None:
+                    total[key] = (total[key] or 0) + record[key]
+            total['peak_rss_bytes'] = max(total['peak_rss_bytes'], record['peak_rss_bytes'])
+
+        for total in summary.values():
+            rows = total['rows_out'] if total['rows_out'] is not None else total['rows_in']
+            total['wall_s'] = round(total['wall_s'], 6)
+            total['cpu_s'] = round(total['cpu_s'], 6)
+            total['rows_per_s'] = round(rows / total['wall_s'], 1) if rows is not None and total['wall_s'] > 0 else None
+
+        return list(summary.values())
+
+    def report(self):
+        """
+        Run report as a dict
+        """
+
+        return {
+            'run': self.run_name,
+            'host': socket.gethostname(),
+            'started_at': self.started_at.isoformat(),
+            'total_wall_s': round(time.perf_counter() - self.run_start, 6),
+            'summary': self.summary(),
+            'steps': self.steps
+        }
+
+    def prometheus_text(self):
+        """
+        Summary of the steps in the Prometheus text exposition format, for the node_exporter textfile collector
+        """
+
+        gauges = [
+            ('wall_seconds', 'wall_s', 'Wall time of the ETL step in seconds'),
+            ('cpu_seconds', 'cpu_s', 'CPU time of the ETL step in seconds'),
+            ('rows_in', 'rows_in', 'Rows read by the ETL step'),
+            ('rows_out', 'rows_out', 'Rows written by the ETL step'),
+            ('rows_per_second', 'rows_per_s', 'Rows per second of the ETL step'),
+            ('peak_rss_bytes', 'peak_rss_bytes', 'Peak resident set size during the ETL step in bytes')
+        ]
+
+        summary = self.summary()
+        lines = []
+        for metric, key, help_text in gauges:
+            lines.append(f'# HELP nyt_etl_step_{metric} {help_text}')
+            lines.append(f'# TYPE nyt_etl_step_{metric} gauge')
+            for total in summary:
+                if total[key] is not None:
+                    lines.append(f'nyt_etl_step_{metric}{{run="{self.run_name}",step="{total["step"]}"}} {total[key]}')
+
+        lines.append('# HELP nyt_etl_run_last_timestamp_seconds Start time of the last ETL run')
+        lines.append('# TYPE nyt_etl_run_last_timestamp_seconds gauge')
+        lines.append(f'nyt_etl_run_last_timestamp_seconds{{run="{self.run_name}"}} {self.started_at.timestamp()}')
+        return '\n'.join(lines) + '\n'
+
+    def save(self, output_directory, prometheus=False):
+        """
+        Write the run report run_report_<run>_<timestamp>.json to the output directory,
+        and the Prometheus textfile nyt_etl_<run>.prom when requested
+        Returns the path of the run report
+        :param output_directory: directory where the files are written
+        :param prometheus: also write the Prometheus textfile
+        """
+
+        timestamp = self.started_at.strftime('%Y%m%d_%H%M%S')
+        report_file = os.path.join(output_directory, f'run_report_{self.run_name}_{timestamp}.json')
+        with open(report_file, 'w') as file:
+            json.dump(self.report(), file, indent=2)
+
+        if prometheus:
+            # Written to a temporary file and renamed, the collector never reads a partial file
+            prom_file = os.path.join(output_directory, f'nyt_etl_{self.run_name}.prom')
+            with open(prom_file + '.tmp', 'w') as file:
+                file.write(self.prometheus_text())
+            os.replace(prom_file + '.tmp', prom_file)
+
+        return report_file
+
+    def print_summary(self):
+        """
+        Print the summary of the steps
+        """
+
+        print(f"{'step':<32} {'calls':>5} {'wall s':>9} {'cpu s':>9} {'rows out':>10} {'rows/s':>11} {'peak MB':>8}")
+        for total in self.summary():
+            rows_out = total['rows_out'] if total['rows_out'] is not None else ''
+            rows_per_s = total['rows_per_s'] if total['rows_per_s'] is not None else ''
+            print(f"{total['step']:<32} {total['calls']:>5} {total['wall_s']:>9.3f} {total['cpu_s']:>9.3f} "
+                  f"{rows_out:>10} {rows_per_s:>11} {total['peak_rss_bytes'] / 2**20:>8.1f}")
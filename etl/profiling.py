@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import os
+import io
+import pstats
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+
+def profiling_enabled(config_value=False):
+    """
+    True when the profiling mode is switched on by the environment variable NYT_PROFILE
+    or by the configuration value PROFILE_RUN
+    :param config_value: value of PROFILE_RUN in config_vars.py
+    """
+
+    return any(
+        str(value).lower() in ('1', 'true', 'yes')
+        for value in (os.environ.get('NYT_PROFILE', ''), config_value)
+    )
+
+
+@contextmanager
+def profile_run(run_name, output_directory, enabled=True, top=40, frames=10):
+    """
+    Profile the code inside the 'with' block: CPU with cProfile and allocations with tracemalloc.
+    Saves in the output directory:
+    - profile_<run>_<timestamp>.prof  cProfile stats, open them with snakeviz or pstats
+    - profile_<run>_<timestamp>.txt   top functions by cumulative time and top allocation sites
+    :param run_name: name of the run, e.g. 'convert_data'
+    :param output_directory: directory where the artifacts are saved
+    :param enabled: when False the block runs without profiling
+    :param top: number of functions and allocation sites in the text report
+    :param frames: frames stored by tracemalloc for every allocation
+    """
+
+    if not enabled:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    tracemalloc.start(frames)
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        base_name = os.path.join(output_directory, f'profile_{run_name}_{timestamp}')
+        profiler.dump_stats(base_name + '.prof')
+
+        stream = io.StringIO()
+        stream.write(f'===== CPU profile: top {top} functions by cumulative time =====\n')
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(top)
+
+        stream.write(f'\n===== tracemalloc: peak {peak_bytes / 2**20:.1f} MB, '
+                     f'still allocated {current_bytes / 2**20:.1f} MB =====\n')
+        stream.write(f'===== Top {top} allocation sites still allocated at the end of the run =====\n')
+        snapshot = snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>')
+        ])
+        for statistic in snapshot.statistics('lineno')[:top]:
+            stream.write(f'{statistic}\n')
+
+        with open(base_name + '.txt', 'w') as file:
+            file.write(stream.getvalue())
+        print("Profile saved to", base_name + '.prof', 'and', base_name + '.txt')
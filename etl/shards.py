@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import os
+import json
+
+# Layout of the time-sharded SQLite database, shared by create_db.py and the API.
+# The articles of every period (year or month) are stored in their own database file, a shard, with their
+# links to the authors and to their keywords. The authors and the keywords are stored once, in the author
+# directory, with ids shared by all the shards. The manifest lists the shards with the first and last date
+# of their articles:
+#   <db name>_shards/
+#       shards.json            manifest
+#       authors.db             author directory, tables 'author' and 'keyword'
+#       <db name>_2021.<version>.db
+#                              shard, tables 'article', 'article_author', 'article_keyword'
+# Every build of a shard is a new snapshot file (see snapshots.py), published by replacing the manifest.
+# The article ids of a shard start at shard_id_base(period), so they are unique across the shards
+# and a shard is rebuilt without renumbering the others.
+
+MANIFEST_NAME = 'shards.json'
+DIRECTORY_NAME = 'authors.db'
+
+# Length of the period key taken from the start of a date 'YYYY-MM-DD'
+PERIOD_KEY_LENGTH = {'year': 4, 'month': 7}
+
+# Article ids available to every shard
+SHARD_ID_RANGE = 10 ** 8
+
+
+def shards_directory(db_dir, db_name):
+    """
+    Directory of the shards of a database
+    :param db_dir: directory of the database, ending with '/'
+    :param db_name: file name of the unsharded database, e.g. 'nyt_db.db'
+    """
+
+    return f'{db_dir}{os.path.splitext(db_name)[0]}_shards/'
+
+
+def shard_file_name(db_name, period):
+    """
+    File name of the shard of a period, without the version of its snapshots
+    :param db_name: file name of the unsharded database, e.g. 'nyt_db.db'
+    :param period: period key, e.g. '2021' or '2021-01'
+    """
+
+    return f'{os.path.splitext(db_name)[0]}_{period}.db'
+
+
+def period_of(a_date, period='year'):
+    """
+    Period key of a date: 'YYYY' for years, 'YYYY-MM' for months. '0000' for a missing or invalid date
+    :param a_date: date as 'YYYY-MM-DD'
+    :param period: 'year' or 'month'
+    """
+
+    key = str(a_date)[:PERIOD_KEY_LENGTH[period]]
+    if not key.replace('-', '').isdigit() or len(key) != PERIOD_KEY_LENGTH[period]:
+        return '0000' if period == 'year' else '0000-00'
+    return key
+
+
+def shard_id_base(period):
+    """
+    First article id of the shard of a period
+    :param period: period key, e.g. '2021' or '2021-01'
+    """
+
+    return int(period.replace('-', '')) * SHARD_ID_RANGE
+
+
+def is_sharded(path):
+    """
+    True when the path is a directory of shards
+    :param path: database file or directory of shards
+    """
+
+    return os.path.isfile(os.path.join(path, MANIFEST_NAME))
+
+
+def read_manifest(directory):
+    """
+    Manifest of a directory of shards, None when there is none
+    :param directory: directory of shards
+    """
+
+    try:
+        with open(os.path.join(directory, MANIFEST_NAME), encoding='utf8') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def write_manifest(directory, manifest):
+    """
+    Replace the manifest of a directory of shards at once: its readers see the old or the new one
+    :param directory: directory of shards
+    :param manifest: dict with 'period', 'directory' and 'shards'
+    """
+
+    path = os.path.join(directory, MANIFEST_NAME)
+    with open(path + '.tmp', 'w', encoding='utf8') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(path + '.tmp', path)
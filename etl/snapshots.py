@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import os
+import glob
+import sqlite3
+from datetime import datetime
+
+# Versioned snapshots of the SQLite database, shared by create_db.py and the API.
+# create_db never writes to the database file the API reads: it builds a new snapshot file
+# named after its version, checks it, and publishes it at once, by replacing a symbolic link
+# for the single database file, or the manifest for the shards (see shards.py):
+#   nyt_db.db                                 -> nyt_db.20240101_020000_000000.db
+#   nyt_db.20240101_020000_000000.db          snapshot in use
+#   nyt_db.20231231_020000_000000.db          previous snapshot, still read by the API while it switches
+# A failed build or check leaves the published snapshot as it is.
+# The API opens the snapshot the link points to (os.path.realpath): a new snapshot is a new file
+# with its own WAL, so the API opens it beside the old one and switches without a restart.
+
+VERSION_FORMAT = '%Y%m%d_%H%M%S_%f'
+
+
+def snapshot_version():
+    """
+    Version of a new snapshot, the time of the build
+    """
+
+    return datetime.now().strftime(VERSION_FORMAT)
+
+
+def snapshot_file_name(file_name, version):
+    """
+    File name of a snapshot
+    :param file_name: published file name, e.g. 'nyt_db.db'
+    :param version: version of the snapshot, see snapshot_version()
+    """
+
+    stem, extension = os.path.splitext(file_name)
+    return f'{stem}.{version}{extension}'
+
+
+def snapshot_files(directory, file_name):
+    """
+    Snapshot files of a published file, oldest first
+    :param directory: directory of the snapshots
+    :param file_name: published file name, e.g. 'nyt_db.db'
+    """
+
+    stem, extension = os.path.splitext(file_name)
+    pattern = os.path.join(glob.escape(directory), f'{glob.escape(stem)}.*{extension}')
+    prefix_length = len(stem) + 1
+    return sorted(
+        path for path in glob.glob(pattern)
+        if os.path.basename(path)[prefix_length:-len(extension) or None].replace('_', '').isdigit()
+    )
+
+
+def check_database(db_file, expected_rows):
+    """
+    Integrity checks of a new snapshot before it is published. Returns the list of the problems found
+    :param db_file: database file
+    :param expected_rows: dict of table name: number of rows the table must hold
+    """
+
+    problems = []
+    conn = sqlite3.connect(db_file)
+    try:
+        result = [row[0] for row in conn.execute('PRAGMA integrity_check')]
+        if result != ['ok']:
+            problems.extend(result)
+        for table_name, expected in expected_rows.items():
+            rows = conn.execute(f'SELECT COUNT(*) FROM {table_name}').fetchone()[0]
+            if rows != expected:
+                problems.append(f"table '{table_name}' holds {rows} rows, {expected} expected")
+    except sqlite3.Error as er:
+        problems.append(str(er))
+    finally:
+        conn.close()
+    return problems
+
+
+def remove_database(db_file):
+    """
+    Remove a database file and its WAL files
+    :param db_file: database file
+    """
+
+    for suffix in ['', '-wal', '-shm']:
+        if os.path.exists(db_file + suffix):
+            os.remove(db_file + suffix)
+
+
+def publish_snapshot(directory, file_name, snapshot_name):
+    """
+    Point the published file to a snapshot at once, by replacing a symbolic link: its readers open
+    the old or the new snapshot, never a partial one. Where symbolic links are not available, the snapshot
+    is renamed to the published file
+    :param directory: directory of the snapshots
+    :param file_name: published file name, e.g. 'nyt_db.db'
+    :param snapshot_name: file name of the snapshot
+    """
+
+    path = os.path.join(directory, file_name)
+    link = path + '.link'
+    if os.path.lexists(link):
+        os.remove(link)
+    try:
+        # Relative target: the link is valid wherever the directory is mounted
+        os.symlink(snapshot_name, link)
+    except OSError as e:
+        print(">>> A 'symlink' exception, the snapshot replaces the database file : ", e, "\n")
+        remove_database(path)
+        os.replace(os.path.join(directory, snapshot_name), path)
+        return
+    if os.path.exists(path) and not os.path.islink(path):
+        # A database file of the time before the snapshots: its WAL files must not stay beside the link
+        for suffix in ['-wal', '-shm']:
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    os.replace(link, path)
+
+
+def remove_old_snapshots(directory, file_name, keep=2):
+    """
+    Remove the old snapshots of a published file, keeping the newest ones and the published one.
+    The previous snapshot is kept by default: the API reads it until it has switched to the new one
+    :param directory: directory of the snapshots
+    :param file_name: published file name, e.g. 'nyt_db.db'
+    :param keep: number of snapshots kept
+    """
+
+    published = os.path.realpath(os.path.join(directory, file_name))
+    files = snapshot_files(directory, file_name)
+    for path in files[:max(len(files) - keep, 0)]:
+        if os.path.realpath(path) != published:
+            remove_database(path)
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The tests import the modules of the repository as the APIs do: from the root and from 0_api
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT_DIR, os.path.join(ROOT_DIR, '0_api')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
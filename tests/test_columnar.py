@@ -0,0 +1,137 @@
+import os
+import sys
+import time
+import random
+import sqlite3
+import importlib
+
+import pytest
+
+pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+from fastapi.testclient import TestClient
+
+from conftest import ROOT_DIR
+
+# Every aggregate of the columnar engine (columnar.py) must return the rows of the SQL query it replaces:
+# the endpoints are called with the engine, then with their registered SQL query, over a small synthetic
+# database built by etl/create_db.py, before and after inserts applied to the engine by columnar_insert()
+
+SECTIONS = ['U.S.', 'World', 'Arts', 'Técnica', None]
+FIRST_NAMES = ['John', 'Mary', 'José', 'Anna', 'li', 'Émile', 'Zoë']
+LAST_NAMES = ['Smith', 'Brown', 'Müller', "o'Neil", 'Garcia', 'Jo_nes']
+
+AUTHOR_SEARCHES = ['jo', 'JO', 'ann', 'é', 'É', '_', '%', "o'n", 'smith', 'zz', 'new']
+AUTHOR_BATCHES = [
+    {'authors': ['smith', 'MARY', 'zz']},
+    {'authors': ['é', 'smith'], 'author_ids': [1, 2, 3, 999]},
+    {'author_ids': [5, 5, 7]}
+]
+PAGED_PATHS = ['/top_authors_by_section', '/most_prolific_authors_by_section', '/count_pairs_authors_collaboration']
+
+
+def build_database(path, articles=300, seed=7):
+    from common import load_etl_modules
+    load_etl_modules()
+    import create_db
+
+    rng = random.Random(seed)
+    names = sorted({f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}' for _ in range(60)})
+    # The same name in other cases, and an author without name
+    names += [name.upper() for name in names[:3]] + [None]
+    df_Ar = pd.DataFrame({
+        'article_id': range(1, articles + 1),
+        'section_name': [rng.choice(SECTIONS) for _ in range(articles)],
+        'word_count': [None if rng.random() < 0.05 else rng.randint(0, 3000) for _ in range(articles)],
+        'headline_main': 'h',
+        'a_date': '2021-01-01'
+    })
+    df_Au = pd.DataFrame({'author_id': range(1, len(names) + 1), 'author_name': names})
+    links = sorted({(article_id, rng.randint(1, len(names)))
+                    for article_id in range(1, articles + 1) for _ in range(rng.choice([1, 1, 2, 3]))})
+    df_Ar_Au = pd.DataFrame(links, columns=['article_id', 'author_id'])
+
+    conn = sqlite3.connect(path)
+    create_db.create_table_article(conn, df_Ar)
+    create_db.create_table_author(conn, df_Au)
+    create_db.create_table_article_author(conn, df_Ar_Au)
+    create_db.create_table_keyword(conn, pd.DataFrame(columns=['keyword_id', 'name', 'value']))
+    create_db.create_table_article_keyword(conn, pd.DataFrame(columns=['article_id', 'keyword_id', 'rank']))
+    conn.close()
+
+
+@pytest.fixture(scope='module')
+def api(tmp_path_factory):
+    work_dir = tmp_path_factory.mktemp('columnar')
+    db_path = str(work_dir / 'nyt_db.db')
+    # The settings and the app module are restored for the tests collected after this one
+    with pytest.MonkeyPatch.context() as mp:
+        mp.syspath_prepend(os.path.join(ROOT_DIR, 'benchmarks'))
+        build_database(db_path)
+        mp.setenv('NYT_DB_PATH', db_path)
+        mp.setenv('NYT_SLOW_QUERY_DIR', str(work_dir))
+        mp.setenv('NYT_COLUMNAR', '1')
+        mp.delitem(sys.modules, 'main', raising=False)
+        main = importlib.import_module('main')
+        try:
+            with TestClient(main.app) as client:
+                # The engine is loaded by the warm-up, after the startup
+                for _ in range(100):
+                    if client.get('/ready').status_code == 200:
+                        break
+                    time.sleep(0.1)
+                assert main.columnar is not None
+                yield main, client
+        finally:
+            sys.modules.pop('main', None)
+
+
+def both_paths(main, request):
+    # Response of the columnar engine, then of the SQL query
+    engine = main.columnar
+    try:
+        with_engine = request().json()
+        main.columnar = None
+        with_sql = request().json()
+    finally:
+        main.columnar = engine
+    return with_engine, with_sql
+
+
+def check_aggregates(main, client):
+    for author in AUTHOR_SEARCHES:
+        for path in ['/articles_count_by_author', '/articles_count_by_section_by_author']:
+            with_engine, with_sql = both_paths(main, lambda: client.get(path, params={'author': author}))
+            assert with_engine == with_sql, (path, author)
+    for batch in AUTHOR_BATCHES:
+        for path in ['/articles_count_by_author_batch', '/articles_count_by_section_by_author_batch']:
+            with_engine, with_sql = both_paths(main, lambda: client.post(path, json=batch))
+            assert with_engine == with_sql, (path, batch)
+    for path in PAGED_PATHS:
+        with_engine, with_sql = both_paths(main, lambda: client.get(path, params={'limit': 10000}))
+        assert with_engine == with_sql, path
+        assert with_engine
+
+
+def test_columnar_matches_sql(api):
+    check_aggregates(*api)
+
+
+def test_columnar_matches_sql_after_inserts(api):
+    main, client = api
+    engine = main.columnar
+    articles = [
+        {'abstract': 'a', 'section_name': 'Arts', 'headline_main': 'h', 'byline': 'By John Smith and New Author', 'word_count': 5000},
+        {'abstract': 'a', 'section_name': 'Técnica', 'headline_main': 'h', 'byline': 'By new author', 'word_count': 10},
+        {'abstract': 'a', 'section_name': 'World', 'headline_main': 'h', 'byline': 'By Mary Brown'}
+    ]
+    response = client.post('/insert_articles', json=articles)
+    assert response.status_code == 200, response.text
+    response = client.post('/insert_new_article_with_new_author',
+                           params={'abstract': 'a', 'section_name': 'World', 'headline_main': 'h', 'authors': 'Newer Author'})
+    assert response.status_code == 200, response.text
+
+    # Applied to the engine in place, not reloaded from the database
+    assert main.columnar is engine
+    assert client.get('/articles_count_by_author', params={'author': 'new author'}).json()
+    check_aggregates(main, client)
@@ -0,0 +1,39 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from api_common.http_cache import ConditionalGet, etag_matches
+
+
+def client_of_app():
+    app = FastAPI()
+
+    async def content_version():
+        return 1
+
+    app.middleware('http')(ConditionalGet(content_version))
+
+    @app.get('/items')
+    async def items():
+        return [1, 2]
+
+    return TestClient(app)
+
+
+def test_etag_matches():
+    assert etag_matches('W/"1-a"', 'W/"1-a"')
+    assert etag_matches('"0-b", "1-a"', 'W/"1-a"')
+    assert not etag_matches('W/"0-a"', 'W/"1-a"')
+    assert not etag_matches(None, 'W/"1-a"')
+    assert not etag_matches('*', 'W/"1-a"')
+
+
+def test_unchanged_response_is_not_modified():
+    client = client_of_app()
+    etag = client.get('/items').headers['etag']
+    assert client.get('/items', headers={'If-None-Match': etag}).status_code == 304
+
+
+def test_unknown_path_is_not_found_whatever_if_none_match():
+    client = client_of_app()
+    assert client.get('/nonexistent', headers={'If-None-Match': '*'}).status_code == 404
+    assert client.get('/items', headers={'If-None-Match': '*'}).status_code == 200
@@ -0,0 +1,50 @@
+import time
+import sqlite3
+import asyncio
+
+import pytest
+
+from sqlite_pool import SQLitePool, QueryTimeout
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / 'numbers.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE number (value INTEGER PRIMARY KEY)')
+    conn.executemany('INSERT INTO number (value) VALUES (?)', [(value,) for value in range(100000)])
+    conn.commit()
+    conn.close()
+    return path
+
+
+async def stream_all(pool, sql, batch_size, timeout_s, pause_s=0.0):
+    await pool.open()
+    try:
+        values = []
+        async for rows in pool.stream(sql, batch_size=batch_size, timeout_s=timeout_s):
+            values.extend(row['value'] for row in rows)
+            # Client reading the batch slowly
+            await asyncio.sleep(pause_s)
+        return values
+    finally:
+        await pool.close()
+
+
+def test_stream_budget_ignores_slow_consumer(db_path):
+    # 20 batches read in 1 s by the client, far more than the budget, while SQLite needs a few ms
+    start = time.monotonic()
+    values = asyncio.run(stream_all(SQLitePool(db_path, readers=1), 'SELECT value FROM number WHERE value % 50 = 0',
+                                    batch_size=100, timeout_s=0.5, pause_s=0.05))
+    assert time.monotonic() - start > 0.5
+    assert values == list(range(0, 100000, 50))
+
+
+def test_stream_timeout_reports_configured_budget(db_path):
+    # Rows produced slowly by SQLite itself, without end
+    sql = '''
+        WITH RECURSIVE counter(value) AS (SELECT 1 UNION ALL SELECT value + 1 FROM counter)
+        SELECT value FROM counter WHERE value % 50000 = 0
+    '''
+    with pytest.raises(QueryTimeout, match=r'time budget of 0\.2 s$'):
+        asyncio.run(stream_all(SQLitePool(db_path, readers=1), sql, batch_size=10, timeout_s=0.2))